@@ -25,13 +25,31 @@ Implementation of the OMERO.features AbstractAPI
 
 from AbstractAPI import (
     AbstractFeatureRow, AbstractFeatureStore, AbstractFeatureStoreManager)
+import Ice
 import omero
 import omero.clients
 from omero.rtypes import unwrap, wrap
 
-from itertools import izip
+from itertools import chain, imap, islice, izip, product
+from multiprocessing.pool import ThreadPool
+import collections
+import copy
+import hashlib
 import json
+import multiprocessing
+import os
+import Queue
+import random
 import re
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import logging
 log = logging.getLogger(__name__)
@@ -41,6 +59,28 @@ DEFAULT_NAMESPACE = 'omero.features/0.1'
 DEFAULT_FEATURE_SUBSPACE = 'features'
 DEFAULT_ANNOTATION_SUBSPACE = 'source'
 
+# Target maximum size of a single Ice message in bytes
+MAX_MESSAGE_SIZE = 16777216
+
+# Maximum number of values in a single query IN list or batch of saved
+# objects
+QUERY_CHUNK_SIZE = 1000
+
+# Maximum number of terms in a single table query condition, longer
+# conditions can overflow the parser stack on the server
+MAX_QUERY_TERMS = 256
+
+# Distance metrics supported by FeatureTable.knn
+KNN_METRICS = ('euclidean', 'sqeuclidean', 'cityblock', 'cosine')
+
+# Minimum number of consecutive offsets which are read as a range of rows
+# instead of as individual coordinates
+MIN_RANGE_READ = 64
+
+# Upper bound on the number of bytes used to encode the length of an Ice
+# sequence or string
+_ICE_SIZE_BYTES = 5
+
 FEATURE_NAME_RE = r'^[A-Za-z0-9][A-Za-z0-9_ \-\(\)\[\]\{\}\.]*$'
 
 # Column type strings
@@ -58,6 +98,11 @@ _COLUMN_METADATA = 'metadata'
 _COLUMN_MULTIPLE_FEATURE = 'multifeature'
 # Column contains a single feature (which may be an ArrayColumn)
 _COLUMN_SINGLE_FEATURE = 'feature'
+# Column contains a digest of the feature values in each row
+_COLUMN_DIGEST = 'digest'
+
+# Name of the optional feature digest column
+DIGEST_COLUMN_NAME = '_digest'
 
 
 class TableStoreException(Exception):
@@ -221,6 +266,785 @@ class FeatureRow(AbstractFeatureRow):
              self._infonames, self._infovalues))
 
 
+def _check_numpy():
+    """
+    Raise an exception if numpy is not available
+    """
+    if numpy is None:
+        raise TableUsageException('This method requires numpy')
+
+
+def _column_row_size(col):
+    """
+    Estimate the number of bytes used by a single row of a column
+    """
+    size = getattr(col, 'size', None) or 1
+    if isinstance(col, omero.grid.StringColumn):
+        return size + _ICE_SIZE_BYTES
+    if isinstance(col, omero.grid.BoolColumn):
+        return 1
+    if isinstance(col, omero.grid.FloatArrayColumn):
+        return 4 * size + _ICE_SIZE_BYTES
+    if isinstance(col, (omero.grid.DoubleArrayColumn,
+                        omero.grid.LongArrayColumn)):
+        return 8 * size + _ICE_SIZE_BYTES
+    return 8 * size
+
+
+def _column_dtype(col):
+    """
+    Get the numpy dtype and shape used to store a single row of a column
+    """
+    if isinstance(col, omero.grid.StringColumn):
+        return 'S%d' % col.size, ()
+    if isinstance(col, omero.grid.BoolColumn):
+        return 'bool', ()
+    if isinstance(col, omero.grid.DoubleColumn):
+        return 'float64', ()
+    if isinstance(col, omero.grid.DoubleArrayColumn):
+        return 'float64', (col.size,)
+    if isinstance(col, omero.grid.FloatArrayColumn):
+        return 'float32', (col.size,)
+    if isinstance(col, omero.grid.LongArrayColumn):
+        return 'int64', (col.size,)
+    if isinstance(col, omero.grid.MaskColumn):
+        raise TableUsageException('MaskColumns are not supported')
+    return 'int64', ()
+
+
+def _digest(values):
+    """
+    Calculate a digest of a row of feature values
+    """
+    return hashlib.sha1(
+        struct.pack('<%dd' % len(values), *values)).hexdigest()
+
+
+def _digest_rows(values):
+    """
+    Calculate digests of each row of a 2D numpy array of feature values,
+    equivalent to calling :func:`_digest` on each row
+    """
+    values = numpy.ascontiguousarray(values, dtype='<f8')
+    return [hashlib.sha1(r).hexdigest() for r in values]
+
+
+def _balanced_join(terms, op):
+    """
+    Join query terms with a binary operator as a balanced tree so that the
+    nesting depth of the expression grows logarithmically with the number
+    of terms
+
+    :param terms: A non-empty list of terms
+    :param op: The operator, e.g. '|'
+    """
+    if len(terms) == 1:
+        return terms[0]
+    mid = len(terms) // 2
+    return '(%s %s %s)' % (
+        _balanced_join(terms[:mid], op), op, _balanced_join(terms[mid:], op))
+
+
+def _allocate_sample(sizes, fraction, rng):
+    """
+    Divide a sample of round(fraction * sum(sizes)) items between groups in
+    proportion to their sizes using largest remainder rounding, ties are
+    broken randomly
+
+    :param sizes: The number of items in each group
+    :param fraction: The fraction of items to sample
+    :param rng: A random.Random instance
+    :return: The number of items to sample from each group
+    """
+    quotas = [fraction * size for size in sizes]
+    counts = [int(q) for q in quotas]
+    remaining = int(round(fraction * sum(sizes))) - sum(counts)
+    order = sorted(xrange(len(sizes)),
+                   key=lambda i: (counts[i] - quotas[i], rng.random()))
+    for i in order[:max(remaining, 0)]:
+        counts[i] += 1
+    return counts
+
+
+class ThroughputCounter(object):
+    """
+    Counts the number of items processed and the time taken
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, count, seconds):
+        self.count += count
+        self.seconds += seconds
+
+    def rate(self):
+        """
+        The number of items processed per second
+        """
+        if self.seconds > 0:
+            return self.count / self.seconds
+        return 0.0
+
+    def __repr__(self):
+        return '%s(%s: %d in %.3fs, %.1f/s)' % (
+            self.__class__.__name__, self.name, self.count, self.seconds,
+            self.rate())
+
+
+def _prefetch(func, items, depth):
+    """
+    Call func on each item in a background thread, keeping up to depth
+    results ready ahead of the consumer. Results are yielded in order, an
+    exception in func is raised in the consumer.
+    """
+    results = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def run():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put((True, func(item)))
+        except Exception as e:
+            put((False, e))
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            r = results.get()
+            if r is None:
+                break
+            if not r[0]:
+                raise r[1]
+            yield r[1]
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ChunkSizeTuner(object):
+    """
+    Adapts the number of rows read in each call to the server so that each
+    call takes approximately a target time, based on the observed throughput
+    """
+
+    def __init__(self, chunk_size, min_rows=1, max_rows=None,
+                 target_seconds=1.0, smoothing=0.5):
+        """
+        :param chunk_size: The initial number of rows
+        :param min_rows: The minimum number of rows
+        :param max_rows: The maximum number of rows
+        :param target_seconds: The target duration of each call
+        :param smoothing: Weight given to the previous throughput estimate
+               when a new observation is made, between 0 and 1
+        """
+        self.min_rows = max(min_rows, 1)
+        self.max_rows = max_rows
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self.rate = None
+        self.chunk_size = self._limit(chunk_size)
+
+    def _limit(self, n):
+        n = max(n, self.min_rows)
+        if self.max_rows:
+            n = min(n, self.max_rows)
+        return int(n)
+
+    def observe(self, rows, seconds):
+        """
+        Record the time taken to read a number of rows and update the
+        chunk size. The chunk size changes by at most a factor of 2 for
+        each observation.
+        """
+        if rows < 1 or seconds <= 0:
+            return
+        rate = rows / float(seconds)
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = self.smoothing * self.rate + (
+                1 - self.smoothing) * rate
+        target = self.rate * self.target_seconds
+        target = min(max(target, self.chunk_size // 2), self.chunk_size * 2)
+        self.chunk_size = self._limit(target)
+
+
+class PendingSpill(object):
+    """
+    Pending rows which have been moved out of memory into a temporary file,
+    these are read back through a numpy memory map. Strings are stored as
+    unicode and read back as UTF-8 encoded byte strings.
+    """
+
+    def __init__(self, cols, dir=None):
+        """
+        :param cols: The table columns
+        :param dir: The directory for the temporary file, default is the
+               system temporary directory
+        """
+        _check_numpy()
+        self.strcols = set(n for n in xrange(len(cols)) if isinstance(
+            cols[n], omero.grid.StringColumn))
+        self.dtype = numpy.dtype([
+            ('c%d' % n, 'U%d' % cols[n].size, ()) if n in self.strcols else
+            ('c%d' % n,) + _column_dtype(cols[n]) for n in xrange(len(cols))])
+        fd, self.path = tempfile.mkstemp(suffix='.pending', dir=dir)
+        self.fh = os.fdopen(fd, 'wb')
+        self.nrows = 0
+        self.offset = 0
+
+    def __len__(self):
+        """
+        The number of rows which have not yet been read
+        """
+        return self.nrows - self.offset
+
+    def append(self, cols):
+        """
+        Append the values of a set of columns to the file
+        """
+        n = len(cols[0].values)
+        arr = numpy.empty(n, dtype=self.dtype)
+        for c, (name, col) in enumerate(izip(self.dtype.names, cols)):
+            if c in self.strcols:
+                arr[name] = [v if isinstance(v, unicode) else
+                             v.decode('utf-8') for v in col.values]
+            else:
+                arr[name] = col.values
+        arr.tofile(self.fh)
+        self.fh.flush()
+        self.nrows += n
+
+    def read(self, cols, maxrows):
+        """
+        Fill a set of columns with the next rows from the file, the read
+        position is not advanced until :meth:`advance` is called
+
+        :param cols: The columns to be filled
+        :param maxrows: The maximum number of rows
+        :return: The number of rows
+        """
+        n = min(len(self), maxrows)
+        arr = numpy.memmap(self.path, dtype=self.dtype, mode='r',
+                           offset=self.offset * self.dtype.itemsize,
+                           shape=(n,))
+        for c, (name, col) in enumerate(izip(self.dtype.names, cols)):
+            col.values = arr[name].tolist()
+            if c in self.strcols:
+                col.values = [v.encode('utf-8') for v in col.values]
+        del arr
+        return n
+
+    def advance(self, n):
+        self.offset += n
+
+    def close(self):
+        """
+        Close and delete the file
+        """
+        self.fh.close()
+        os.remove(self.path)
+
+
+class MetadataIndex(object):
+    """
+    An in-memory index of the metadata columns of a table, mapping metadata
+    values to row offsets so that rows can be found without querying the
+    server
+    """
+
+    def __init__(self, names):
+        """
+        :param names: The names of the metadata columns
+        """
+        self.names = tuple(names)
+        self.nrows = 0
+        self.keys = {}
+        self.columns = dict((name, {}) for name in self.names)
+
+    def __len__(self):
+        return self.nrows
+
+    def add(self, values):
+        """
+        Index rows appended to the end of the table
+
+        :param values: A list of values for each metadata column
+        """
+        if len(values) != len(self.names):
+            raise TableUsageException(
+                'Expected %d metadata columns' % len(self.names))
+        start = self.nrows
+        for name, colvals in izip(self.names, values):
+            index = self.columns[name]
+            for n, v in enumerate(colvals, start):
+                index.setdefault(v, []).append(n)
+        for n, key in enumerate(izip(*values), start):
+            self.keys.setdefault(key, []).append(n)
+        if values:
+            self.nrows += len(values[0])
+
+    def lookup(self, items):
+        """
+        Find the rows matching all metadata values
+
+        :param items: A list of (name, value) pairs, value may be a list of
+               alternative values or None to match anything
+        :return: A sorted list of row offsets
+        """
+        items = [(k, v) for k, v in items if v is not None]
+        if set(k for k, v in items) == set(self.names) and not any(
+                isinstance(v, (tuple, list)) for k, v in items):
+            d = dict(items)
+            return list(self.keys.get(tuple(d[k] for k in self.names), []))
+
+        matches = None
+        for k, v in items:
+            index = self._get_column_index(k)
+            if not isinstance(v, (tuple, list)):
+                v = [v]
+            rows = set()
+            for w in v:
+                if w is not None:
+                    rows.update(index.get(w, []))
+            if matches is None:
+                matches = rows
+            else:
+                matches &= rows
+            if not matches:
+                return []
+        if matches is None:
+            return range(self.nrows)
+        return sorted(matches)
+
+    def _get_column_index(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise TableUsageException('Unknown metadata column: %s' % name)
+
+
+def _distances(features, query, metric):
+    """
+    Calculate the distances between each row of a 2D array and a vector,
+    NaN distances are replaced by infinity
+
+    :param features: A 2D numpy array
+    :param query: A 1D numpy array
+    :param metric: One of KNN_METRICS
+    """
+    if metric == 'cosine':
+        norms = numpy.sqrt(numpy.einsum('ij,ij->i', features, features))
+        norms *= numpy.sqrt(query.dot(query))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            d = 1 - features.dot(query) / norms
+    else:
+        diff = features - query
+        if metric == 'cityblock':
+            d = numpy.abs(diff).sum(axis=1)
+        else:
+            d = numpy.einsum('ij,ij->i', diff, diff)
+            if metric == 'euclidean':
+                d = numpy.sqrt(d)
+    d[numpy.isnan(d)] = numpy.inf
+    return d
+
+
+class RandomProjectionIndex(object):
+    """
+    An approximate nearest neighbour index. Each row of features is hashed
+    to a bit signature using random hyperplanes, rows whose signatures are
+    closest to that of a query are candidate neighbours.
+
+    The index covers the first len(index) rows of a table in order so it can
+    be extended as rows are appended. table_id is the ID of the table's
+    OriginalFile, this is saved with the index.
+    """
+
+    def __init__(self, nfeatures, nbits=64, seed=None):
+        """
+        :param nfeatures: The number of features in each row
+        :param nbits: The number of bits in each signature
+        :param seed: Seed for the random hyperplanes
+        """
+        _check_numpy()
+        rng = numpy.random.RandomState(seed)
+        self.planes = rng.standard_normal((nbits, nfeatures))
+        self.mean = None
+        self.codes = numpy.empty((0, (nbits + 7) // 8), dtype=numpy.uint8)
+        self.table_id = None
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def _hash(self, features):
+        projected = numpy.nan_to_num(features - self.mean).dot(self.planes.T)
+        return numpy.packbits(projected > 0, axis=-1)
+
+    def add(self, features):
+        """
+        Index rows appended to the end of the table
+
+        :param features: A 2D array of feature values
+        """
+        if self.mean is None:
+            # Centre the hyperplanes on the first rows, otherwise all
+            # non-negative features fall on the same side of most planes
+            with numpy.errstate(invalid='ignore'):
+                self.mean = numpy.nan_to_num(features.mean(axis=0))
+        self.codes = numpy.concatenate((self.codes, self._hash(features)))
+
+    def replace(self, offsets, features):
+        """
+        Rehash rows which have been replaced in the table
+
+        :param offsets: A list of row offsets
+        :param features: A 2D array of the new feature values of these rows
+        """
+        self.codes[offsets] = self._hash(features)
+
+    def candidates(self, query, n):
+        """
+        Get the offsets of the rows whose signatures are closest to that of
+        the query
+
+        :param query: A 1D array of feature values
+        :param n: The maximum number of candidates
+        :return: A sorted list of row offsets
+        """
+        if not len(self):
+            return []
+        distances = numpy.unpackbits(
+            self.codes ^ self._hash(query), axis=1).sum(axis=1)
+        nearest = numpy.argsort(distances, kind='mergesort')[:n]
+        return sorted(int(i) for i in nearest)
+
+    def save(self, path):
+        """
+        Save the index to a numpy .npz file
+        """
+        with open(path, 'wb') as f:
+            numpy.savez(
+                f, planes=self.planes, codes=self.codes,
+                mean=self.mean if self.mean is not None else [],
+                table_id=self.table_id if self.table_id is not None else -1)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved by :meth:`save`
+        """
+        _check_numpy()
+        data = numpy.load(path)
+        try:
+            planes = numpy.array(data['planes'])
+            codes = numpy.array(data['codes'])
+            mean = numpy.array(data['mean'])
+            table_id = -1
+            if 'table_id' in data.files:
+                table_id = int(data['table_id'])
+        finally:
+            data.close()
+        index = cls(planes.shape[1], planes.shape[0])
+        index.planes = planes
+        index.codes = codes
+        if mean.size:
+            index.mean = mean
+        if table_id > -1:
+            index.table_id = table_id
+        return index
+
+
+class FeatureStatistics(object):
+    """
+    Streaming summary statistics for each feature. Chunks of rows are
+    combined using the parallel algorithm of Chan et al. so that the
+    variance is numerically stable and memory use is independent of the
+    number of rows. NaNs are counted and otherwise ignored.
+    """
+
+    def __init__(self, nfeatures, edges=None):
+        """
+        :param nfeatures: The number of features
+        :param edges: Optional histogram bin edges, either one sequence for
+               all features or a 2D array with a row of edges for each
+               feature. Values outside the edges are not counted.
+        """
+        _check_numpy()
+        self.count = numpy.zeros(nfeatures, dtype=numpy.int64)
+        self.nan = numpy.zeros(nfeatures, dtype=numpy.int64)
+        self.mean = numpy.zeros(nfeatures)
+        self.m2 = numpy.zeros(nfeatures)
+        self.min = numpy.full(nfeatures, numpy.inf)
+        self.max = numpy.full(nfeatures, -numpy.inf)
+        self.edges = None
+        self.histogram = None
+        if edges is not None:
+            edges = numpy.asarray(edges, dtype=numpy.float64)
+            self.edges = numpy.empty((nfeatures, edges.shape[-1]))
+            self.edges[:] = edges
+            self.histogram = numpy.zeros(
+                (nfeatures, edges.shape[-1] - 1), dtype=numpy.int64)
+
+    def update(self, features):
+        """
+        Add a chunk of rows
+
+        :param features: A 2D array of feature values
+        """
+        if not features.shape[0]:
+            return
+        isnan = numpy.isnan(features)
+        n = (~isnan).sum(axis=0)
+        self.nan += isnan.sum(axis=0)
+        valid = n > 0
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(valid, numpy.nansum(features, axis=0) / n, 0)
+        m2 = numpy.nansum((features - mean) ** 2, axis=0)
+        self._combine(n, mean, m2)
+        self.min = numpy.fmin(self.min, numpy.where(
+            isnan, numpy.inf, features).min(axis=0))
+        self.max = numpy.fmax(self.max, numpy.where(
+            isnan, -numpy.inf, features).max(axis=0))
+        if self.histogram is not None:
+            self.histogram += self._histogram(features)
+
+    def merge(self, other):
+        """
+        Add the statistics from another FeatureStatistics
+        """
+        self._combine(other.count, other.mean, other.m2)
+        self.nan += other.nan
+        self.min = numpy.fmin(self.min, other.min)
+        self.max = numpy.fmax(self.max, other.max)
+        if self.histogram is not None and other.histogram is not None:
+            self.histogram += other.histogram
+
+    def _combine(self, n, mean, m2, rows=Ellipsis):
+        count = self.count[rows]
+        total = count + n
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean[rows]
+            self.mean[rows] = numpy.where(
+                total > 0, self.mean[rows] + delta * n / total, 0)
+            self.m2[rows] = numpy.where(
+                total > 0,
+                self.m2[rows] + m2 + delta ** 2 * count * n / total, 0)
+        self.count[rows] = total
+
+    def _histogram(self, features):
+        hist = numpy.zeros_like(self.histogram)
+        nbins = hist.shape[1]
+        for f, edges in enumerate(self.edges):
+            x = features[:, f]
+            bins = numpy.searchsorted(edges, x, side='right') - 1
+            # The last bin includes the upper edge
+            bins[x == edges[-1]] = nbins - 1
+            bins = bins[(bins >= 0) & (bins < nbins)]
+            hist[f] = numpy.bincount(bins, minlength=nbins)
+        return hist
+
+    def variance(self, ddof=1):
+        """
+        The variance of each feature, NaN if there are not enough values
+        """
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(
+                self.count > ddof, self.m2 / (self.count - ddof), numpy.nan)
+
+    def std(self, ddof=1):
+        """
+        The standard deviation of each feature
+        """
+        return numpy.sqrt(self.variance(ddof))
+
+    def results(self):
+        """
+        Get the statistics as a dict of arrays with one element per feature
+        """
+        empty = self.count == 0
+        r = {
+            'count': self.count,
+            'nan': self.nan,
+            'mean': numpy.where(empty, numpy.nan, self.mean),
+            'std': self.std(),
+            'min': numpy.where(empty, numpy.nan, self.min),
+            'max': numpy.where(empty, numpy.nan, self.max),
+        }
+        if self.histogram is not None:
+            r['histogram'] = self.histogram
+            r['edges'] = self.edges
+        return r
+
+
+class GroupedFeatureStatistics(FeatureStatistics):
+    """
+    Streaming summary statistics for each feature in each group of rows,
+    the statistics are 2D arrays with a row for each group. Memory use is
+    proportional to the number of groups.
+    """
+
+    def __init__(self, nfeatures):
+        """
+        :param nfeatures: The number of features
+        """
+        super(GroupedFeatureStatistics, self).__init__(nfeatures)
+        self.nfeatures = nfeatures
+        self.keys = []
+        self.groups = {}
+        self.size = numpy.zeros(0, dtype=numpy.int64)
+        for name in ('count', 'nan', 'mean', 'm2', 'min', 'max'):
+            setattr(self, name, numpy.empty(
+                (0, nfeatures), dtype=getattr(self, name).dtype))
+
+    def _add_groups(self, keys):
+        n = len(keys)
+        for key in keys:
+            self.groups[key] = len(self.keys)
+            self.keys.append(key)
+        self.size = numpy.concatenate((
+            self.size, numpy.zeros(n, dtype=numpy.int64)))
+        for name, fill in (('count', 0), ('nan', 0), ('mean', 0), ('m2', 0),
+                           ('min', numpy.inf), ('max', -numpy.inf)):
+            a = getattr(self, name)
+            new = numpy.empty((n, self.nfeatures), dtype=a.dtype)
+            new.fill(fill)
+            setattr(self, name, numpy.concatenate((a, new)))
+
+    def update(self, keys, features):
+        """
+        Add a chunk of rows
+
+        :param keys: A numpy array of group keys, one per row, this may be
+               a structured array. Keys are stored as tuples.
+        :param features: A 2D array of feature values
+        """
+        if not features.shape[0]:
+            return
+        ukeys, inverse = numpy.unique(keys, return_inverse=True)
+        ukeys = [k if isinstance(k, tuple) else (k,) for k in ukeys.tolist()]
+        self._add_groups([k for k in ukeys if k not in self.groups])
+        gids = numpy.array([self.groups[k] for k in ukeys])
+
+        # Sort the rows by group so each group can be reduced in one call
+        order = numpy.argsort(inverse, kind='mergesort')
+        inverse = inverse[order]
+        features = features[order]
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], inverse[1:] != inverse[:-1])))
+        rows = gids[inverse[starts]]
+        sizes = numpy.diff(numpy.append(starts, len(inverse)))
+
+        isnan = numpy.isnan(features)
+        n = numpy.add.reduceat(~isnan, starts, axis=0).astype(numpy.int64)
+        sums = numpy.add.reduceat(
+            numpy.where(isnan, 0, features), starts, axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(n > 0, sums / n, 0)
+        dev = numpy.where(isnan, 0, features - numpy.repeat(mean, sizes, 0))
+        m2 = numpy.add.reduceat(dev ** 2, starts, axis=0)
+
+        self.size[rows] += sizes
+        self.nan[rows] += numpy.add.reduceat(isnan, starts, axis=0)
+        self._combine(n, mean, m2, rows)
+        self.min[rows] = numpy.fmin(self.min[rows], numpy.minimum.reduceat(
+            numpy.where(isnan, numpy.inf, features), starts, axis=0))
+        self.max[rows] = numpy.fmax(self.max[rows], numpy.maximum.reduceat(
+            numpy.where(isnan, -numpy.inf, features), starts, axis=0))
+
+    def results(self):
+        """
+        Get the statistics as a dict of 2D arrays with a row for each group,
+        sorted by key. 'keys' is the list of group keys and 'size' the
+        number of rows in each group.
+        """
+        order = sorted(xrange(len(self.keys)), key=self.keys.__getitem__)
+        r = dict((k, v[order]) for k, v in super(
+            GroupedFeatureStatistics, self).results().iteritems())
+        r['size'] = self.size[order]
+        r['keys'] = [self.keys[i] for i in order]
+        return r
+
+
+class FeatureGroupBy(object):
+    """
+    Group the rows of a feature table by metadata columns, see
+    :meth:`FeatureTable.groupby`
+    """
+
+    def __init__(self, table, names, conditions=None):
+        """
+        :param table: The :class:`FeatureTable`
+        :param names: The names of the metadata columns to group by
+        :param conditions: Optional query conditions on the metadata
+               columns, see :meth:`FeatureTable.filter_raw`
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        unknown = set(names).difference(table.metadata_names())
+        if unknown:
+            raise TableUsageException(
+                'Unknown metadata columns: %s' % ', '.join(sorted(unknown)))
+        self.table = table
+        self.names = list(names)
+        self.conditions = conditions
+
+    def agg(self, *stats):
+        """
+        Calculate statistics for each group, rows are streamed one chunk at
+        a time
+
+        :param stats: The names of the statistics, any of size (the number
+               of rows), count (the number of values excluding NaNs), nan,
+               mean, std, min and max. Default is all.
+        :return: A dict containing 'keys', the group keys sorted in
+                 ascending order (a tuple of values for each group column),
+                 and an array for each statistic. size is 1D, the other
+                 statistics are 2D with a row for each group and a column
+                 for each feature.
+        """
+        allowed = ('size', 'count', 'nan', 'mean', 'std', 'min', 'max')
+        if not stats:
+            stats = allowed
+        unknown = set(stats).difference(allowed)
+        if unknown:
+            raise TableUsageException(
+                'Unknown statistics: %s' % ', '.join(sorted(unknown)))
+
+        acc = GroupedFeatureStatistics(len(self.table.feature_names()))
+        for meta, features in self.table.filter_iter(
+                self.conditions, 'numpy'):
+            if len(self.names) == 1:
+                keys = meta[self.names[0]]
+            else:
+                keys = numpy.empty(len(meta), dtype=[
+                    (n, meta.dtype[n]) for n in self.names])
+                for n in self.names:
+                    keys[n] = meta[n]
+            acc.update(keys, features)
+        r = acc.results()
+        d = dict((k, r[k]) for k in stats)
+        d['keys'] = r['keys']
+        return d
+
+
 class PermissionsHandler(object):
     """
     Handles permissions checks on objects handled by OMERO.features.
@@ -329,7 +1153,7 @@ def open_table(session, ofileid, ann_space=None, defaultcoltype=None):
 
 
 def new_table(session, name, ft_space, ann_space, metadesc, coldesc,
-              parent=None):
+              parent=None, digest=False):
     """
     Create a new table, optionally attach it to an existing object
 
@@ -341,9 +1165,11 @@ def new_table(session, name, ft_space, ann_space, metadesc, coldesc,
            metadata and feature names, see :meth:`FeatureTable::new_table`
     :param parent: The parent OMERO object that this table should be
            attached to in the form 'Type:Id'
+    :param digest: If True store a digest of each row of features, see
+           :meth:`FeatureTable::new_table`
     """
     ft = FeatureTable(session, name, ft_space, ann_space)
-    ft.new_table(metadesc, coldesc)
+    ft.new_table(metadesc, coldesc, digest)
     if parent:
         otype, oid = parent.split(':')
         oid = long(oid)
@@ -378,11 +1204,33 @@ class FeatureTable(AbstractFeatureStore):
         self.metacols = None
         self.singleftcols = None
         self.multiftcols = None
+        self.digestcol = None
         self.pendingcols = None
+        self.pendingbytes = 0
+        self.pendingtime = None
+        self.pendingspill = None
+        self.pending_max_rows = None
+        self.pending_max_bytes = None
+        self.pending_max_age = None
+        self.pending_spill = False
+        self.pending_spill_dir = None
+        self.pending_spill_timeout = None
         self.table = None
         self.metanames = None
         self.ftnames = None
         self.chunk_size = None
+        self.read_prefetch = 0
+        self.read_handles = 1
+        self.read_tables = None
+        self.read_stats = None
+        self.chunk_tuner = None
+        self.chunk_tuner_args = None
+        self.metaindex = None
+        self.metaindex_refresh = True
+        self.knnindex = None
+        self.knnindex_path = None
+        self.knnindex_replaced = set()
+        self.max_message_size = MAX_MESSAGE_SIZE
         self.editable = None
 
     def _owns_table(func):
@@ -401,6 +1249,10 @@ class FeatureTable(AbstractFeatureStore):
         """
         Close the table
         """
+        if self.read_tables:
+            for t in self.read_tables:
+                t.close()
+            self.read_tables = None
         if self.table:
             self.table.close()
             self.table = None
@@ -409,8 +1261,17 @@ class FeatureTable(AbstractFeatureStore):
             self.metacols = None
             self.singleftcols = None
             self.multiftcols = None
+            self.digestcol = None
             self.ftnames = None
             self.editable = None
+            self.metaindex = None
+            self.knnindex = None
+            self.knnindex_replaced = set()
+        if self.pendingspill:
+            log.warn('Discarding %d spilled pending rows',
+                     len(self.pendingspill))
+            self.pendingspill.close()
+            self.pendingspill = None
 
     def get_table(self):
         """
@@ -437,7 +1298,8 @@ class FeatureTable(AbstractFeatureStore):
         Creates a json block for a column's description field
         """
         assert columntype in (
-            _COLUMN_METADATA, _COLUMN_MULTIPLE_FEATURE, _COLUMN_SINGLE_FEATURE)
+            _COLUMN_METADATA, _COLUMN_MULTIPLE_FEATURE, _COLUMN_SINGLE_FEATURE,
+            _COLUMN_DIGEST)
         return json.dumps({'columntype': columntype})
 
     def _get_column_type(self, col):
@@ -463,6 +1325,7 @@ class FeatureTable(AbstractFeatureStore):
         self.metacols = []
         self.singleftcols = []
         self.multiftcols = []
+        self.digestcol = None
 
         for n in xrange(len(self.cols)):
             col = self.cols[n]
@@ -483,6 +1346,8 @@ class FeatureTable(AbstractFeatureStore):
                         'Mixing single and multiple feature columns '
                         'is not supported')
                 self.multiftcols.append(n)
+            elif coltype == _COLUMN_DIGEST:
+                self.digestcol = n
             else:
                 raise OmeroTableException(
                     'Unknown metadata/feature column type')
@@ -491,7 +1356,7 @@ class FeatureTable(AbstractFeatureStore):
         self.singleftcols = tuple(self.singleftcols)
         self.multiftcols = tuple(self.multiftcols)
 
-    def new_table(self, metadesc, coldesc):
+    def new_table(self, metadesc, coldesc, digest=False):
         """
         Create a new table
 
@@ -500,6 +1365,9 @@ class FeatureTable(AbstractFeatureStore):
             for valid type strings. String columns require an additional width
             parameter.
         :param coldesc: A list of feature column names
+        :param digest: If True add a column containing a digest of the
+            feature values in each row, this is used to skip unchanged rows
+            when replacing rows with :meth:`store_many`
         """
         if self.table:
             raise TableUsageException('Table already open')
@@ -567,6 +1435,10 @@ class FeatureTable(AbstractFeatureStore):
         coldef.append(omero.grid.DoubleArrayColumn(
             names, d, len(coldesc)))
 
+        if digest:
+            d = self._get_column_json(_COLUMN_DIGEST)
+            coldef.append(omero.grid.StringColumn(DIGEST_COLUMN_NAME, d, 40))
+
         try:
             self.table.initialize(coldef)
         except omero.InternalException:
@@ -671,6 +1543,76 @@ class FeatureTable(AbstractFeatureStore):
                 cols[n].values.append(values[p:q])
                 p = q
 
+        if self.digestcol is not None:
+            cols[self.digestcol].values.append(_digest(values))
+
+    def _arrays_to_cols(self, cols, meta, values):
+        """
+        Fill a set of columns with multiple rows at once, handles the mix of
+        metadata and feature column types. Any existing column values are
+        replaced.
+
+        :param cols: The columns to be filled
+        :param meta: Either a numpy structured array with fields named after
+               the metadata columns, or a sequence of metadata rows
+        :param values: A 2D array of feature values, one row per metadata row
+        :return: The number of rows
+        """
+        _check_numpy()
+        meta_len = len(self.metacols)
+        if getattr(meta, 'dtype', None) is not None and meta.dtype.names:
+            metavals = [meta[name].tolist() for name in self.metadata_names()]
+        elif isinstance(meta, numpy.ndarray):
+            if meta.ndim != 2 or meta.shape[1] != meta_len:
+                raise TableUsageException(
+                    'Expected %d metadata values' % meta_len)
+            metavals = meta.T.tolist()
+        else:
+            metavals = [list(m) for m in izip(*meta)]
+            if meta and len(metavals) != meta_len:
+                raise TableUsageException(
+                    'Expected %d metadata values' % meta_len)
+        nrows = len(meta)
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if nrows == 0 and values.size == 0:
+            for col in cols:
+                col.values = []
+            return 0
+        ft_len = len(self.singleftcols) if self.singleftcols else sum(
+            cols[n].size for n in self.multiftcols)
+        if values.ndim != 2 or values.shape[1] != ft_len:
+            raise TableUsageException('Expected %d feature values' % ft_len)
+        if values.shape[0] != nrows:
+            raise TableUsageException(
+                'Expected %d rows of feature values' % nrows)
+
+        for n, m in izip(self.metacols, xrange(meta_len)):
+            cols[n].values = metavals[m]
+
+        if self.singleftcols:
+            for n, v in izip(self.singleftcols, xrange(ft_len)):
+                cols[n].values = values[:, v].tolist()
+        else:
+            p = 0
+            for n in self.multiftcols:
+                q = p + cols[n].size
+                cols[n].values = values[:, p:q].tolist()
+                p = q
+
+        if self.digestcol is not None:
+            cols[self.digestcol].values = _digest_rows(values)
+        return nrows
+
+    def _empty_columns(self):
+        """
+        Create a copy of the table headers with no values
+        """
+        cols = [copy.copy(c) for c in self.cols]
+        for col in cols:
+            col.values = []
+        return cols
+
     def _colrow_to_vals(self, rowvalues):
         """
         Split a column row into metadata and feature fields, handles
@@ -688,6 +1630,15 @@ class FeatureTable(AbstractFeatureStore):
 
     @_owns_table
     def store(self, meta, values, replace=True):
+        """
+        Store a single row
+
+        :param meta: The metadata values
+        :param values: The feature values
+        :param replace: If True replace the last existing row with the same
+               metadata. If the table has a digest column and the stored
+               feature values are unchanged the row is not rewritten.
+        """
         for col in self.cols:
             col.values = []
 
@@ -704,16 +1655,501 @@ class FeatureTable(AbstractFeatureStore):
                 offset = max(offsets)
 
         if offset > -1:
+            if self.digestcol is not None:
+                # Skip the update if the feature values are unchanged
+                stored = self.table.slice([self.digestcol], [offset])
+                if (stored.columns[0].values[0] ==
+                        self.cols[self.digestcol].values[0]):
+                    log.debug('Skipping unchanged row %d', offset)
+                    return
             data = omero.grid.Data(rowNumbers=[offset], columns=self.cols)
             self.table.update(data)
+            self._index_replaced([offset])
         else:
             self.table.addData(self.cols)
+            self._index_appended(self.cols)
+
+    @_owns_table
+    def store_many(self, meta, values, replace=False):
+        """
+        Store multiple rows, the columns are filled directly from the arrays
+        and sent in as few calls to the server as possible
+
+        :param meta: Either a numpy structured array with fields named after
+               the metadata columns, or a sequence of metadata rows
+        :param values: A 2D array of feature values, one row per metadata row
+        :param replace: If True replace existing rows with matching metadata,
+               the offsets of all rows are resolved in a single pass over the
+               metadata columns and all matching rows are sent in one update.
+               If the table has a digest column rows whose feature values are
+               unchanged are skipped. As with :meth:`store` only the last row
+               with each set of metadata values is stored.
+        :return: The number of rows written
+        """
+        cols = self._empty_columns()
+        n = self._arrays_to_cols(cols, meta, values)
+        if not n:
+            return n
+
+        appends = n
+        if replace:
+            keys = list(izip(*(cols[c].values for c in self.metacols)))
+            last = dict((k, i) for i, k in enumerate(keys))
+            if len(last) < n:
+                keep = sorted(last.itervalues())
+                log.debug('Ignoring %d rows with repeated metadata',
+                          n - len(keep))
+                cols = self._select_rows(cols, keep)
+                keys = [keys[i] for i in keep]
+                n = len(keep)
+            skip = set()
+            if self.digestcol is None:
+                offsets = self._find_offsets(keys)
+            else:
+                offsets, digests = self._find_offsets(keys, digests=True)
+                newdigests = cols[self.digestcol].values
+                skip = set(i for i in xrange(n) if offsets[i] > -1 and
+                           digests[i] == newdigests[i])
+                if skip:
+                    log.debug('Skipping %d unchanged rows', len(skip))
+            updates = [i for i in xrange(n)
+                       if offsets[i] > -1 and i not in skip]
+            if updates:
+                updcols = cols
+                if len(updates) < n:
+                    updcols = self._select_rows(cols, updates)
+                self._write_ranges(
+                    updcols, self._get_write_ranges(updcols),
+                    rownumbers=[offsets[i] for i in updates],
+                    raise_error=True)
+            appends = [i for i in xrange(n) if offsets[i] < 0]
+            if len(appends) < n:
+                cols = self._select_rows(cols, appends)
+            appends = len(appends)
+            n = len(updates) + appends
+
+        if appends:
+            self._write_ranges(
+                cols, self._get_write_ranges(cols), raise_error=True)
+        return n
+
+    @_owns_table
+    def store_stream(self, rows, batch_size=1000, queue_size=2):
+        """
+        Append a stream of rows. Batches of rows are converted into columns
+        in a background thread so that conversion of the next batch overlaps
+        with writing the current batch to the server.
+
+        :param rows: An iterable of (meta, values) pairs, see :meth:`store`
+        :param batch_size: The number of rows in each write
+        :param queue_size: The maximum number of converted batches waiting to
+               be written
+        :return: A dict of ThroughputCounters for the 'convert' and 'write'
+                 stages, and the sustained rate of the whole stream 'total'
+        """
+        stats = dict((k, ThroughputCounter(k)) for k in (
+            'convert', 'write', 'total'))
+        batches = Queue.Queue(queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def convert():
+            try:
+                it = iter(rows)
+                while not stop.is_set():
+                    batch = list(islice(it, batch_size))
+                    if not batch:
+                        break
+                    t = time.time()
+                    meta, values = zip(*batch)
+                    cols = self._empty_columns()
+                    n = self._arrays_to_cols(cols, meta, values)
+                    stats['convert'].add(n, time.time() - t)
+                    put((n, cols))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(None)
+
+        start = time.time()
+        converter = threading.Thread(target=convert)
+        converter.daemon = True
+        converter.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                t = time.time()
+                self._write_ranges(item[1], self._get_write_ranges(item[1]),
+                                   raise_error=True)
+                stats['write'].add(item[0], time.time() - t)
+        finally:
+            stop.set()
+            converter.join()
+        if errors:
+            raise errors[0]
+
+        stats['total'].add(stats['write'].count, time.time() - start)
+        log.info('Stream stored: %s', stats)
+        return stats
+
+    def _get_row_sizes(self, cols):
+        """
+        Estimate the number of bytes used by each row of a set of columns,
+        using the actual lengths of any strings
+
+        :return: A list of row sizes, or a single integer if all rows are the
+                 same size
+        """
+        nrows = len(cols[0].values)
+        fixed = 0
+        strcols = []
+        for col in cols:
+            if isinstance(col, omero.grid.StringColumn):
+                strcols.append(col)
+                fixed += _ICE_SIZE_BYTES
+            else:
+                fixed += _column_row_size(col)
+        if not strcols:
+            return fixed
+        sizes = [fixed] * nrows
+        for col in strcols:
+            sizes = [n + len(v) for n, v in izip(sizes, col.values)]
+        return sizes
+
+    def _get_write_ranges(self, cols, max_bytes=None):
+        """
+        Split a set of columns into ranges of rows which fit into a single
+        Ice message
+
+        :param cols: The columns
+        :param max_bytes: The maximum message size, default is
+               :meth:`get_max_message_size`
+        :return: A list of (start, stop) row ranges
+        """
+        if max_bytes is None:
+            max_bytes = self.get_max_message_size()
+        nrows = len(cols[0].values)
+        sizes = self._get_row_sizes(cols)
+        if not isinstance(sizes, list):
+            step = max(max_bytes // sizes, 1)
+            return [(n, min(n + step, nrows)) for n in xrange(0, nrows, step)]
+
+        ranges = []
+        start = 0
+        total = 0
+        for n in xrange(nrows):
+            if total + sizes[n] > max_bytes and n > start:
+                ranges.append((start, n))
+                start = n
+                total = 0
+            total += sizes[n]
+        if start < nrows:
+            ranges.append((start, nrows))
+        return ranges
+
+    def _write_ranges(self, cols, ranges, threads=1, rownumbers=None,
+                      raise_error=False, deadline=None):
+        """
+        Write ranges of rows from a set of columns with one call per range
+
+        :param cols: The columns
+        :param ranges: A list of (start, stop) row ranges
+        :param threads: The number of ranges to send concurrently, if this
+               is greater than 1 the rows may be written out of order
+        :param rownumbers: If provided update these existing rows instead of
+               appending
+        :param raise_error: If True raise the first exception instead of
+               returning it
+        :param deadline: If given ranges are not sent after this time (as
+               returned by time.time()), they are returned as not written
+        :return: A list of the ranges which were not written and the first
+                 exception, or an empty list and None
+        """
+        concurrent = threads > 1 and len(ranges) > 1
+        index = self.metaindex if rownumbers is None else None
+
+        def write(r):
+            if deadline is not None and time.time() >= deadline:
+                return False
+            try:
+                rcols = self._slice_rows(cols, r[0], r[1])
+                if rownumbers is None:
+                    self.table.addData(rcols)
+                else:
+                    self.table.update(omero.grid.Data(
+                        rowNumbers=rownumbers[r[0]:r[1]], columns=rcols))
+                    self._index_replaced(rownumbers[r[0]:r[1]])
+            except Ice.Exception as e:
+                return e
+            if index is not None and not concurrent:
+                self._index_appended(rcols)
+
+        if concurrent:
+            pool = ThreadPool(min(threads, len(ranges)))
+            try:
+                errors = pool.map(write, ranges)
+            finally:
+                pool.close()
+                pool.join()
+            # The order of the appended rows is unknown
+            if index is not None:
+                self._refresh_metadata_index()
+        else:
+            errors = []
+            for r in ranges:
+                e = write(r)
+                errors.append(e)
+                if e:
+                    errors.extend([e] * (len(ranges) - len(errors)))
+                    break
+
+        failed = [r for r, err in izip(ranges, errors) if err is not None]
+        error = next((err for err in errors if err), None)
+        if raise_error and error:
+            raise error
+        return failed, error
+
+    def _slice_rows(self, cols, start, stop):
+        """
+        Get a contiguous range of rows from a set of columns, the columns
+        are returned unchanged if the range covers all rows
+        """
+        if start == 0 and stop >= len(cols[0].values):
+            return cols
+        sliced = []
+        for col in cols:
+            c = copy.copy(col)
+            c.values = col.values[start:stop]
+            sliced.append(c)
+        return sliced
+
+    def _select_rows(self, cols, rows):
+        """
+        Create a copy of a set of columns containing a subset of rows
+
+        :param cols: The columns
+        :param rows: The indices of the rows to be copied
+        """
+        selected = []
+        for col in cols:
+            c = copy.copy(col)
+            c.values = [col.values[r] for r in rows]
+            selected.append(c)
+        return selected
+
+    def _read_metadata_columns(self, start=0, stop=None, digest=False):
+        """
+        Read only the metadata columns from a range of rows
+
+        :param start: The first row
+        :param stop: The end row (exclusive), default is the end of the table
+        :param digest: If True also read the digest column, this is
+               returned after the metadata columns
+        :return: A list of values for each metadata column
+        """
+        if stop is None:
+            stop = self.table.getNumberOfRows()
+        colnums = list(self.metacols)
+        if digest:
+            colnums.append(self.digestcol)
+        values = [[] for c in colnums]
+        chunk_size = self._get_columns_chunk_size(colnums)
+        for n in xrange(start, stop, chunk_size):
+            data = self.table.read(colnums, n, min(n + chunk_size, stop))
+            for c, v in izip(data.columns, values):
+                v.extend(c.values)
+        return values
+
+    def _find_offsets(self, keys, digests=False):
+        """
+        Find the offsets of rows matching a batch of metadata keys using a
+        single pass over the metadata columns
+
+        :param keys: An iterable of tuples of metadata values
+        :param digests: If True also return the digests of the matching rows
+        :return: A list of the last matching offset for each key, or -1 if
+                 there is no match. If digests is True a tuple of this list
+                 and a list of digests (None if there is no match).
+        """
+        if self.metaindex is not None:
+            return self._find_offsets_indexed(keys, digests)
+        metavals = self._read_metadata_columns(digest=digests)
+        if digests:
+            rowdigests = metavals.pop()
+        rows = dict((k, n) for n, k in enumerate(izip(*metavals)))
+        offsets = [rows.get(tuple(k), -1) for k in keys]
+        if digests:
+            return offsets, [rowdigests[o] if o > -1 else None
+                             for o in offsets]
+        return offsets
+
+    def build_metadata_index(self, refresh=True):
+        """
+        Download the metadata columns and build an in-memory index so that
+        :meth:`fetch_by_metadata` and related methods can find rows without
+        a query on the server. Rows appended through this object are added
+        to the index.
+
+        :param refresh: If True check for rows appended by other clients
+               before each lookup, this costs one small call to the server
+        :return: The :class:`MetadataIndex`
+        """
+        self.metaindex = MetadataIndex(self.metadata_names())
+        self.metaindex_refresh = refresh
+        self._refresh_metadata_index()
+        return self.metaindex
+
+    def drop_metadata_index(self):
+        """
+        Discard the in-memory metadata index
+        """
+        self.metaindex = None
+
+    def _refresh_metadata_index(self):
+        """
+        Add any rows which are not yet in the metadata index
+        """
+        nrows = self.table.getNumberOfRows()
+        start = len(self.metaindex)
+        if nrows > start:
+            log.debug('Indexing metadata rows %d-%d', start, nrows)
+            self.metaindex.add(self._read_metadata_columns(start, nrows))
+
+    def _index_appended(self, cols):
+        """
+        Add rows which have just been appended to the table to the metadata
+        index. If the table contains rows which are not in the index, for
+        instance rows appended by another client, the index is refreshed
+        from the table instead.
+
+        :param cols: The columns which were appended
+        """
+        if self.metaindex is None:
+            return
+        nrows = len(cols[0].values)
+        if len(self.metaindex) == self.table.getNumberOfRows() - nrows:
+            self.metaindex.add([cols[n].values for n in self.metacols])
+        else:
+            self._refresh_metadata_index()
+
+    def _index_replaced(self, offsets):
+        """
+        Record rows which have been replaced so that they are rehashed in
+        the nearest neighbour index before it is next used
+        """
+        if self.knnindex is not None:
+            self.knnindex_replaced.update(offsets)
+
+    def _lookup_offsets(self, meta):
+        """
+        Get the offsets of the rows matching metadata using the index
+        """
+        if self.metaindex_refresh:
+            self._refresh_metadata_index()
+        return self.metaindex.lookup(self._get_metadata_items(meta))
+
+    def _find_offsets_indexed(self, keys, digests=False):
+        """
+        Find the offsets of rows matching metadata keys using the metadata
+        index, only the digests of the matching rows are read.
+        See :meth:`_find_offsets`
+        """
+        self._refresh_metadata_index()
+        offsets = [self.metaindex.keys.get(tuple(k), [-1])[-1] for k in keys]
+        if not digests:
+            return offsets
+        found = sorted(set(o for o in offsets if o > -1))
+        rowdigests = {}
+        step = max(self.get_max_message_size() // _column_row_size(
+            self.cols[self.digestcol]), 1)
+        for n in xrange(0, len(found), step):
+            chunk = found[n:n + step]
+            data = self.table.slice([self.digestcol], chunk)
+            rowdigests.update(izip(chunk, data.columns[0].values))
+        return offsets, [rowdigests.get(o) for o in offsets]
+
+    def set_pending_limits(self, max_rows=None, max_bytes=None,
+                           max_age=None, spill=False, spill_dir=None,
+                           spill_timeout=None):
+        """
+        Automatically flush pending data when a limit is reached
+
+        :param max_rows: The maximum number of pending rows
+        :param max_bytes: The maximum estimated size of the pending rows
+        :param max_age: The maximum time in seconds since the oldest pending
+               row was added, this is only checked when a row is added
+        :param spill: If True and an automatic flush fails the pending rows
+               are moved into a temporary file, and included in the next
+               flush. This keeps client memory bounded when the server is
+               slow or unavailable
+        :param spill_dir: The directory for the spill file, default is the
+               system temporary directory
+        :param spill_timeout: If spill is True stop an automatic flush
+               which has taken more than this number of seconds after the
+               current chunk, and move the unwritten rows into the spill
+               file. This stops a slow server from blocking the caller.
+        """
+        self.pending_max_rows = max_rows
+        self.pending_max_bytes = max_bytes
+        self.pending_max_age = max_age
+        self.pending_spill = spill
+        self.pending_spill_dir = spill_dir
+        self.pending_spill_timeout = spill_timeout
+
+    def set_read_options(self, prefetch=None, handles=None, autotune=None,
+                         min_chunk_size=1, max_chunk_size=None,
+                         target_latency=1.0):
+        """
+        Configure how table data is read
+
+        :param prefetch: The number of chunks to read ahead in a background
+               thread so that reading from the server overlaps with decoding
+               the previous chunk, 0 to disable
+        :param handles: The number of table handles used to read chunks
+               concurrently, additional handles are opened when required
+        :param autotune: If True adapt the number of rows read in each call
+               from the observed throughput, see :meth:`get_chunk_size`
+        :param min_chunk_size: The minimum number of rows when autotuning
+        :param max_chunk_size: The maximum number of rows when autotuning,
+               this is always limited by the maximum message size
+        :param target_latency: The target duration in seconds of each read
+               when autotuning
+        """
+        if prefetch is not None:
+            self.read_prefetch = prefetch
+        if handles is not None:
+            if handles < 1:
+                raise TableUsageException('At least one handle is required')
+            self.read_handles = handles
+        if autotune is not None:
+            self.chunk_tuner = None
+            self.chunk_tuner_args = None
+            if autotune:
+                self.chunk_tuner_args = (
+                    min_chunk_size, max_chunk_size, target_latency)
+
+    def _get_row_size(self):
+        """
+        Estimate the number of bytes used by a single row
+        """
+        return sum(_column_row_size(c) for c in self.cols)
 
     @_owns_table
     def store_pending(self, meta, values):
         """
         Append data to a pending table, do not write to server (replace is
-        not supported)
+        not supported). The data will be automatically written if any
+        limits set by :meth:`set_pending_limits` are reached.
 
         :param meta: See :meth:`store`
         :param values: See :meth:`store`
@@ -722,65 +2158,308 @@ class FeatureTable(AbstractFeatureStore):
             self.pendingcols = self.table.getHeaders()
             for col in self.pendingcols:
                 col.values = []
+        if self.pendingtime is None:
+            self.pendingtime = time.time()
 
         self._vals_to_cols(self.pendingcols, meta, values)
+        self.pendingbytes += self._get_row_size()
+
+        if self._pending_limit_reached():
+            self._auto_flush()
+
+    def _pending_limit_reached(self):
+        """
+        Check whether the in-memory pending data has reached a limit
+        """
+        nrows = len(self.pendingcols[0].values)
+        return (
+            (self.pending_max_rows and nrows >= self.pending_max_rows) or
+            (self.pending_max_bytes and
+             self.pendingbytes >= self.pending_max_bytes) or
+            (self.pending_max_age and
+             time.time() - self.pendingtime >= self.pending_max_age))
+
+    def _auto_flush(self):
+        """
+        Flush pending data, if this fails or times out and spilling is
+        enabled move the unwritten in-memory data into the spill file
+        """
+        timeout = None
+        if self.pending_spill:
+            timeout = self.pending_spill_timeout
+        try:
+            self.store_flush(timeout=timeout)
+        except Ice.Exception as e:
+            if not self.pending_spill:
+                raise
+            log.warn('Failed to flush pending data, spilling to disk: %s', e)
+        else:
+            if not self.pendingcols:
+                return
+            log.warn('Flushing pending data timed out, spilling to disk')
+        if self.pendingcols:
+            if not self.pendingspill:
+                self.pendingspill = PendingSpill(
+                    self.pendingcols, self.pending_spill_dir)
+            self.pendingspill.append(self.pendingcols)
+        self.pendingcols = None
+        self.pendingbytes = 0
+        self.pendingtime = None
 
     @_owns_table
-    def store_flush(self):
+    def store_flush(self, threads=1, timeout=None):
         """
-        Write any pending table data
+        Write any pending table data, including data in the spill file.
+        Data is split into chunks which fit into a single Ice message.
+
+        If a write fails the unwritten rows are kept so that the flush can
+        be retried.
 
+        :param threads: The number of chunks to send concurrently, if this is
+               greater than 1 the rows may be written out of order
+        :param timeout: If given no more chunks are sent once this number of
+               seconds has passed, the unwritten rows are kept
         :return: The number of rows written
         """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
         n = 0
+        if self.pendingspill:
+            cols = self._empty_columns()
+            chunk_size = max(
+                self.get_max_message_size() // self._get_row_size(), 1)
+            while len(self.pendingspill):
+                if deadline is not None and time.time() >= deadline:
+                    return n
+                m = self.pendingspill.read(cols, chunk_size)
+                self.table.addData(cols)
+                self._index_appended(cols)
+                self.pendingspill.advance(m)
+                n += m
+            self.pendingspill.close()
+            self.pendingspill = None
         if self.pendingcols:
-            self.table.addData(self.pendingcols)
-            n = len(self.pendingcols[0].values)
+            ranges = self._get_write_ranges(self.pendingcols)
+            failed, error = self._write_ranges(
+                self.pendingcols, ranges, threads, deadline=deadline)
+            if failed:
+                unwritten = [r for f in failed for r in xrange(f[0], f[1])]
+                n += len(self.pendingcols[0].values) - len(unwritten)
+                self.pendingcols = self._select_rows(
+                    self.pendingcols, unwritten)
+                if error:
+                    raise error
+                self.pendingbytes = len(unwritten) * self._get_row_size()
+                return n
+            n += len(self.pendingcols[0].values)
         self.pendingcols = None
+        self.pendingbytes = 0
+        self.pendingtime = None
         return n
 
     def fetch_by_metadata(self, meta):
         values = self.fetch_by_metadata_raw(meta)
         return [self.feature_row(v) for v in values]
 
-    def fetch_by_metadata_raw(self, meta):
+    def fetch_by_metadata_raw(self, meta, raw=True):
+        """
+        Retrieve rows by matching metadata
+
+        :param meta: See :meth:`fetch_by_metadata`
+        :param raw: See :meth:`filter_raw`
+        """
+        if self.metaindex is not None:
+            return self._read_rows(self._lookup_offsets(meta), raw)
+        conditions = self._get_metadata_conditions(meta)
+        return self.filter_raw(conditions, raw)
+
+    def fetch_by_metadata_iter(self, meta, raw=True):
+        """
+        Retrieve rows by matching metadata one chunk at a time
+
+        :param meta: See :meth:`fetch_by_metadata`
+        :param raw: See :meth:`filter_iter`
+        """
+        if self.metaindex is not None:
+            return self._iter_rows(self._lookup_offsets(meta), raw)
+        conditions = self._get_metadata_conditions(meta)
+        return self.filter_iter(conditions, raw)
+
+    def fetch_many(self, keys, raw=True, threads=None,
+                   max_terms=MAX_QUERY_TERMS):
+        """
+        Retrieve rows matching any of a large number of metadata keys.
+        If there is a metadata index (:meth:`build_metadata_index`) it is
+        used to find the rows, otherwise the keys are split into queries
+        of at most max_terms terms which are run concurrently. The matching
+        offsets are merged and read in a single chunked read.
+
+        :param keys: A sequence of metadata keys, each in any form accepted
+               by :meth:`fetch_by_metadata`
+        :param raw: See :meth:`filter_raw`
+        :param threads: The number of queries to run concurrently, default
+               is the number of read handles (see :meth:`set_read_options`)
+        :param max_terms: The maximum number of terms in each query
+        :return: The matching rows in table order, each row is returned
+                 once even if it matches several keys
+        """
+        if self.metaindex is not None:
+            if self.metaindex_refresh:
+                self._refresh_metadata_index()
+            offsets = set()
+            for key in keys:
+                offsets.update(self.metaindex.lookup(
+                    self._get_metadata_items(key)))
+        else:
+            conditions = self._get_batched_conditions(keys, max_terms)
+            offsets = set()
+            for o in self._run_queries(conditions, threads):
+                offsets.update(o)
+        return self._read_rows(sorted(offsets), raw)
+
+    def _get_batched_conditions(self, keys, max_terms):
+        """
+        Convert metadata keys into a list of query conditions. Each key
+        becomes an AND of one OR group for each column, so the number of
+        terms grows with the sum of the lengths of any lists of values
+        rather than their product. If a key has more than max_terms values
+        in total its lists are split so that each part has at most
+        max_terms, duplicate keys are removed, and the keys are ORed
+        together in balanced groups of at most max_terms terms.
+
+        :return: A list of conditions, [''] if any key matches all rows
+        """
+        seen = set()
+        batches = [[]]
+        nterms = 0
+        for key in keys:
+            columns = []
+            for k, v in self._get_metadata_items(key):
+                if v is None:
+                    continue
+                vs = []
+                vseen = set()
+                for w in (v if isinstance(v, (tuple, list)) else [v]):
+                    if w is not None and w not in vseen:
+                        vseen.add(w)
+                        vs.append(w)
+                columns.append((k, vs))
+            if not columns:
+                return ['']
+            # Share max_terms between the columns, shortest first so that
+            # any terms a short column doesn't need go to the longer ones
+            sizes = {}
+            remaining = max_terms
+            order = sorted(xrange(len(columns)), key=lambda i: len(
+                columns[i][1]))
+            for j, i in enumerate(order):
+                sizes[i] = max(1, min(len(columns[i][1]),
+                                      remaining // (len(columns) - j)))
+                remaining -= sizes[i]
+            items = [(k, [ws[n:n + sizes[i]]
+                          for n in xrange(0, len(ws), sizes[i])])
+                     for i, (k, ws) in enumerate(columns)]
+            names = [k for k, v in items]
+            for vss in product(*(v for k, v in items)):
+                split = tuple(izip(names, (tuple(vs) for vs in vss)))
+                if split in seen:
+                    continue
+                seen.add(split)
+                c = ' & '.join(
+                    _balanced_join([self._get_condition(k, w) for w in vs],
+                                   '|') for k, vs in split)
+                if len(split) > 1:
+                    c = '(%s)' % c
+                n = sum(len(vs) for k, vs in split)
+                if batches[-1] and nterms + n > max_terms:
+                    batches.append([])
+                    nterms = 0
+                batches[-1].append(c)
+                nterms += n
+        return [_balanced_join(b, '|') for b in batches if b]
+
+    def _run_queries(self, conditions, threads=None):
+        """
+        Run several queries, concurrently if threads > 1 using the read
+        handles in turn
+
+        :param conditions: A list of query conditions
+        :param threads: The number of concurrent queries, default is the
+               number of read handles
+        :return: A list of the offsets matching each condition
+        """
+        if not conditions:
+            return []
+        if '' in conditions:
+            return [range(self.table.getNumberOfRows())]
+        if threads is None:
+            threads = self.read_handles
+        tables = self._get_read_tables() if threads > 1 else [self.table]
+        nrows = self.table.getNumberOfRows()
+
+        def query(args):
+            n, c = args
+            return tables[n % len(tables)].getWhereList(c, {}, 0, nrows, 0)
+
+        if threads > 1 and len(conditions) > 1:
+            pool = ThreadPool(min(threads, len(conditions)))
+            try:
+                return pool.map(query, enumerate(conditions))
+            finally:
+                pool.close()
+                pool.join()
+        return map(query, enumerate(conditions))
+
+    def _get_metadata_items(self, meta):
+        """
+        Convert a metadata dict or list into a list of (name, value) pairs
+        """
         try:
-            kvs = meta.iteritems()
+            return meta.items()
         except AttributeError:
             meta_len = len(self.metadata_names())
             if len(meta) != meta_len:
                 raise TableUsageException(
                     'Expected %d metadata values' % meta_len)
-            kvs = zip(self.metadata_names(), meta)
+            return zip(self.metadata_names(), meta)
 
+    def _get_metadata_conditions(self, meta):
+        """
+        Convert a metadata dict or list into a query condition
+        """
         conditions = []
-        for kv in kvs:
+        for kv in self._get_metadata_items(meta):
             c = self._get_condition(kv[0], kv[1])
             if c:
                 conditions.append(c)
-        conditions = ' & '.join(conditions)
-        values = self.filter_raw(conditions)
-        return values
+        return ' & '.join(conditions)
 
     def filter(self, conditions):
         log.warn('The filter/query syntax is still under development')
         values = self.filter_raw(conditions)
         return [self.feature_row(v) for v in values]
 
-    def filter_raw(self, conditions):
+    def filter_raw(self, conditions, raw=True):
         """
         Query a feature table, return data as rows
 
-        :param conditions: The query conditions
+        :param conditions: The query conditions, either a condition string
+               or a structured query from :mod:`features.query`
                Note the query syntax is still to be decided
+        :param raw: If 'numpy' return a numpy structured array of metadata
+               and a 2D float64 array of features, see :meth:`read_numpy`
         :return: A list of tuples containing the values for each row
         """
-        if conditions:
-            offsets = self.table.getWhereList(
-                conditions, {}, 0, self.table.getNumberOfRows(), 0)
-        else:
-            offsets = range(self.table.getNumberOfRows())
-        values = self.chunked_table_read(offsets, self.get_chunk_size())
+        return self._read_rows(self._get_offsets(conditions), raw)
+
+    def _read_rows(self, offsets, raw=True):
+        """
+        Read rows by offset, see :meth:`filter_raw`
+        """
+        if raw == 'numpy':
+            return self.read_numpy(offsets)
+        values = self.chunked_table_read(offsets)
 
         # Convert into row-wise storage
         if not values:
@@ -789,6 +2468,563 @@ class FeatureTable(AbstractFeatureStore):
             assert len(offsets) == len(v)
         return zip(*values)
 
+    def filter_iter(self, conditions, raw=True):
+        """
+        Query a feature table, return data one chunk at a time so that
+        tables larger than memory can be processed
+
+        :param conditions: The query conditions, see :meth:`filter_raw`
+        :param raw: If 'columns' yield a list of values for each column, if
+               'numpy' yield a numpy structured array of metadata and a 2D
+               array of features (see :meth:`read_numpy`), otherwise yield a
+               list of row tuples
+        :return: A generator of chunks of rows
+        """
+        return self._iter_rows(self._get_offsets(conditions), raw)
+
+    def _iter_rows(self, offsets, raw=True):
+        """
+        Read rows by offset one chunk at a time, see :meth:`filter_iter`
+        """
+        for values in self._iter_table_read(offsets):
+            if raw == 'columns':
+                yield values
+            elif raw == 'numpy':
+                meta, features = self._empty_numpy(len(values[0]))
+                self._fill_numpy(values, meta, features, 0)
+                yield meta, features
+            else:
+                yield zip(*values)
+
+    def filter_features(self, predicate, conditions=None, raw=True):
+        """
+        Query a feature table using a predicate on feature values which is
+        evaluated on the client, one chunk at a time
+
+        :param predicate: A :class:`features.query.FeaturePredicate`, e.g.
+               ``(Feature('area') > 500) & (Feature('intensity') < 0.2)``
+        :param conditions: Optional query conditions on the metadata
+               columns which are evaluated on the server first, see
+               :meth:`filter_raw`
+        :param raw: If 'numpy' return a numpy structured array of metadata
+               and a 2D float64 array of features, otherwise a list of row
+               tuples as returned by :meth:`filter_raw`
+        """
+        _check_numpy()
+        names = self.feature_names()
+        metas = []
+        features = []
+        rows = []
+        for values in self.filter_iter(conditions, 'columns'):
+            meta, fts = self._empty_numpy(len(values[0]))
+            self._fill_numpy(values, meta, fts, 0)
+            mask = predicate.evaluate(fts, names)
+            if raw == 'numpy':
+                metas.append(meta[mask])
+                features.append(fts[mask])
+            else:
+                chunk = zip(*values)
+                rows.extend(chunk[i] for i in numpy.flatnonzero(mask))
+        if raw != 'numpy':
+            return rows
+        if not metas:
+            return self._empty_numpy(0)
+        return numpy.concatenate(metas), numpy.concatenate(features)
+
+    def knn(self, query, k=10, metric='euclidean', conditions=None,
+            raw=True, approximate=False, candidates=None):
+        """
+        Find the k rows whose features are nearest to a query vector. This is
+        an exact search over chunks of rows unless approximate is True. Rows
+        with NaN distances are ignored.
+
+        :param query: A sequence of feature values
+        :param k: The number of neighbours
+        :param metric: The distance metric, one of KNN_METRICS
+        :param conditions: Optional query conditions on the metadata
+               columns, see :meth:`filter_raw`
+        :param raw: If 'numpy' return the metadata and features as numpy
+               arrays (see :meth:`read_numpy`), otherwise as a list of row
+               tuples
+        :param approximate: If True only compare the query with candidate
+               rows from the index created by :meth:`build_knn_index`
+        :param candidates: The number of candidate rows for an approximate
+               search, default 10 * k
+        :return: A tuple of an array of distances in ascending order and the
+                 matching rows
+        """
+        _check_numpy()
+        if metric not in KNN_METRICS:
+            raise TableUsageException('Unknown metric: %s' % metric)
+        query = numpy.asarray(query, dtype=numpy.float64).ravel()
+        ft_len = len(self.feature_names())
+        if query.shape[0] != ft_len:
+            raise TableUsageException('Expected %d feature values' % ft_len)
+
+        if approximate:
+            if self.knnindex is None:
+                raise TableUsageException(
+                    'No nearest neighbour index, see build_knn_index')
+            if conditions:
+                raise TableUsageException(
+                    'Conditions are not supported for approximate searches')
+            self._update_knn_index()
+            offsets = self.knnindex.candidates(query, candidates or 10 * k)
+            chunks = self._iter_rows(offsets, 'columns')
+        else:
+            chunks = self.filter_iter(conditions, 'columns')
+
+        return self._smallest_k(
+            chunks, lambda features: _distances(features, query, metric),
+            k, raw)
+
+    def top_k(self, feature_name, k=10, where=None, largest=True,
+              predicate=None, raw=True):
+        """
+        Find the k rows with the largest (or smallest) values of a feature.
+        Rows are streamed one chunk at a time and only the best k rows are
+        kept. Rows where the feature is NaN are ignored.
+
+        :param feature_name: The name of the feature
+        :param k: The number of rows
+        :param where: Optional query conditions on the metadata columns,
+               see :meth:`filter_raw`
+        :param largest: If True find the largest values, otherwise the
+               smallest
+        :param predicate: Optional :class:`features.query.FeaturePredicate`
+               which rows must match, see :meth:`filter_features`
+        :param raw: See :meth:`knn`
+        :return: A tuple of an array of the feature values, in descending
+                 order if largest is True otherwise ascending, and the
+                 matching rows
+        """
+        _check_numpy()
+        names = self.feature_names()
+        try:
+            i = names.index(feature_name)
+        except ValueError:
+            raise TableUsageException('Unknown feature: %s' % feature_name)
+
+        def score(features):
+            s = -features[:, i] if largest else features[:, i].copy()
+            if predicate:
+                s[~predicate.evaluate(features, names)] = numpy.nan
+            return s
+
+        result = self._smallest_k(
+            self.filter_iter(where, 'columns'), score, k, raw)
+        values = -result[0] if largest else result[0]
+        return (values,) + result[1:]
+
+    def _smallest_k(self, chunks, score, k, raw):
+        """
+        Find the k rows with the smallest scores, only the best k rows are
+        kept while chunks are processed
+
+        :param chunks: An iterable of lists of values for each column
+        :param score: A function which takes a 2D array of features and
+               returns an array of scores, rows with NaN or infinite scores
+               are ignored
+        :param k: The number of rows
+        :param raw: If 'numpy' return the metadata and features as numpy
+               arrays (see :meth:`read_numpy`), otherwise as a list of row
+               tuples
+        :return: A tuple of the scores in ascending order and the rows
+        """
+        bestd = numpy.empty(0)
+        best = self._empty_numpy(0) if raw == 'numpy' else []
+        for values in chunks:
+            meta, features = self._empty_numpy(len(values[0]))
+            self._fill_numpy(values, meta, features, 0)
+            d = score(features)
+            valid = numpy.flatnonzero(numpy.isfinite(d))
+            d = numpy.concatenate((bestd, d[valid]))
+            keep = numpy.arange(len(d))
+            if len(d) > k:
+                keep = numpy.argpartition(d, k - 1)[:k]
+            bestd = d[keep]
+            if raw == 'numpy':
+                best = (numpy.concatenate((best[0], meta[valid]))[keep],
+                        numpy.concatenate((best[1], features[valid]))[keep])
+            else:
+                rows = zip(*values)
+                rows = best + [rows[j] for j in valid]
+                best = [rows[j] for j in keep]
+
+        order = numpy.argsort(bestd, kind='mergesort')
+        if raw == 'numpy':
+            return bestd[order], best[0][order], best[1][order]
+        return bestd[order], [best[j] for j in order]
+
+    def aggregate(self, conditions=None, bins=None, hist_range=None):
+        """
+        Calculate summary statistics for each feature, rows are streamed
+        one chunk at a time so memory use doesn't depend on the number of
+        rows
+
+        :param conditions: Optional query conditions on the metadata
+               columns, see :meth:`filter_raw`
+        :param bins: Optionally calculate histograms, either bin edges (see
+               :class:`FeatureStatistics`) or the number of bins. If this is
+               a number and hist_range is not given an additional pass over
+               the rows is made to find the range of each feature.
+        :param hist_range: (min, max) range of the histograms
+        :return: A :class:`FeatureStatistics`
+        """
+        _check_numpy()
+        ft_len = len(self.feature_names())
+        edges = None
+        stats = None
+        if bins is not None:
+            if not numpy.isscalar(bins):
+                edges = bins
+            elif hist_range is not None:
+                edges = numpy.linspace(hist_range[0], hist_range[1], bins + 1)
+            else:
+                # Use the range of each feature
+                stats = self.aggregate(conditions)
+                lo = numpy.where(stats.count > 0, stats.min, 0)
+                hi = numpy.where(stats.max > lo, stats.max, lo + 1)
+                edges = lo[:, None] + (hi - lo)[:, None] * numpy.linspace(
+                    0, 1, bins + 1)
+
+        acc = FeatureStatistics(ft_len, edges)
+        if stats is not None:
+            # Only the histograms need another pass
+            acc.merge(stats)
+            for meta, features in self.filter_iter(conditions, 'numpy'):
+                acc.histogram += acc._histogram(features)
+            return acc
+        for meta, features in self.filter_iter(conditions, 'numpy'):
+            acc.update(features)
+        return acc
+
+    def groupby(self, names, conditions=None):
+        """
+        Group rows by the values of metadata columns, for example the mean
+        of each feature for each image::
+
+            table.groupby('ImageID').agg('mean')
+
+        :param names: A metadata column name or list of names
+        :param conditions: Optional query conditions on the metadata
+               columns, see :meth:`filter_raw`
+        :return: A :class:`FeatureGroupBy`, call agg() to calculate the
+                 statistics
+        """
+        return FeatureGroupBy(self, names, conditions)
+
+    def describe(self, conditions=None, bins=None, hist_range=None):
+        """
+        Calculate summary statistics for each feature, see :meth:`aggregate`
+
+        :return: A dict of feature names to dicts of statistics: count
+                 (excluding NaNs), nan, mean, std, min, max, and if bins was
+                 given histogram and edges
+        """
+        r = self.aggregate(conditions, bins, hist_range).results()
+        names = self.feature_names()
+        d = {}
+        for i, name in enumerate(names):
+            d[name] = dict((k, v[i]) for k, v in r.iteritems())
+        return d
+
+    def build_knn_index(self, nbits=64, seed=None, path=None):
+        """
+        Create an approximate nearest neighbour index for :meth:`knn`.
+        OMERO.tables can't hold additional data so the index is kept in
+        memory and optionally in a local file. If the file exists the index
+        is loaded and only rows appended since it was saved are added, the
+        file must have been saved for this table. Appended rows are added
+        to the index, and rows replaced through this object are rehashed,
+        before each approximate search. Rows replaced by other clients are
+        not detected.
+
+        :param nbits: The number of bits in each row signature
+        :param seed: Seed for the random projections
+        :param path: Optional path of a file to store the index in
+        :return: The :class:`RandomProjectionIndex`
+        """
+        ft_len = len(self.feature_names())
+        tid = unwrap(self.table.getOriginalFile().getId())
+        if path and os.path.exists(path):
+            index = RandomProjectionIndex.load(path)
+            if index.planes.shape[1] != ft_len or index.table_id != tid:
+                raise TableUsageException(
+                    'Index %s does not match this table' % path)
+        else:
+            index = RandomProjectionIndex(ft_len, nbits, seed)
+            index.table_id = tid
+        self.knnindex = index
+        self.knnindex_path = path
+        self.knnindex_replaced = set()
+        self._update_knn_index()
+        return index
+
+    def _update_knn_index(self):
+        """
+        Add any rows which are not yet in the nearest neighbour index and
+        rehash rows which have been replaced
+        """
+        nrows = self.table.getNumberOfRows()
+        start = len(self.knnindex)
+        if nrows < start:
+            raise TableUsageException(
+                'Nearest neighbour index has more rows than the table')
+        replaced = sorted(o for o in self.knnindex_replaced if o < start)
+        if nrows == start and not replaced:
+            return
+        if replaced:
+            log.debug('Rehashing features of %d replaced rows', len(replaced))
+            n = 0
+            for meta, features in self._iter_rows(replaced, 'numpy'):
+                self.knnindex.replace(replaced[n:n + len(features)], features)
+                n += len(features)
+        if nrows > start:
+            log.debug('Indexing features of rows %d-%d', start, nrows)
+            for meta, features in self._iter_rows(
+                    range(start, nrows), 'numpy'):
+                self.knnindex.add(features)
+        self.knnindex_replaced = set()
+        if self.knnindex_path:
+            self.knnindex.save(self.knnindex_path)
+
+    def count(self, conditions=None, predicate=None):
+        """
+        Count the rows matching a query without reading any feature values,
+        or if a feature predicate is given only the columns containing the
+        features used by the predicate
+
+        Columns are read whole, so in the standard layout where all features
+        are stored in a single array column a predicate on one feature
+        still reads every feature value of each matching row.
+
+        :param conditions: Optional query conditions on the metadata
+               columns, see :meth:`filter_raw`, or a metadata dict or list
+               as accepted by :meth:`fetch_by_metadata` in which case the
+               metadata index is used if there is one
+        :param predicate: Optional :class:`features.query.FeaturePredicate`
+        :return: The number of matching rows
+        """
+        if isinstance(conditions, (dict, list, tuple)):
+            if self.metaindex is not None:
+                offsets = self._lookup_offsets(conditions)
+            else:
+                offsets = self._get_offsets(
+                    self._get_metadata_conditions(conditions))
+        elif conditions:
+            offsets = self._get_offsets(conditions)
+        else:
+            offsets = None
+
+        if not predicate:
+            if offsets is not None:
+                return len(offsets)
+            return self.table.getNumberOfRows()
+
+        _check_numpy()
+        names = sorted(predicate.feature_names())
+        locations = self._get_feature_locations(names)
+        colnums = sorted(set(c for c, p in locations))
+        chunk_size = self._get_columns_chunk_size(colnums)
+        n = 0
+        if offsets is None:
+            offsets = self._get_offsets(None)
+        for chunk in self._plan_reads(offsets, chunk_size):
+            if isinstance(chunk, tuple):
+                data = self.table.read(colnums, chunk[0], chunk[1])
+            else:
+                data = self.table.slice(colnums, chunk)
+            columns = dict(izip(colnums, (numpy.asarray(
+                c.values, dtype=numpy.float64) for c in data.columns)))
+            features = numpy.empty((len(data.columns[0].values), len(names)))
+            for i, (c, p) in enumerate(locations):
+                features[:, i] = columns[c] if p is None else columns[c][:, p]
+            n += int(predicate.evaluate(features, names).sum())
+        return n
+
+    def exists(self, meta):
+        """
+        Check whether any rows match metadata, uses the metadata index if
+        there is one (see :meth:`build_metadata_index`)
+
+        :param meta: See :meth:`fetch_by_metadata`
+        :return: True if there is at least one matching row
+        """
+        if self.metaindex is not None:
+            return len(self._lookup_offsets(meta)) > 0
+        return len(self._get_offsets(self._get_metadata_conditions(meta))) > 0
+
+    def sample(self, fraction=None, n=None, stratify_by=None, seed=None,
+               conditions=None, raw=True):
+        """
+        Read a random sample of rows, only the sampled rows are read
+
+        :param fraction: The fraction of rows to sample, exactly one of
+               fraction or n is required
+        :param n: The number of rows to sample
+        :param stratify_by: Optionally sample from each group of rows with
+               the same values of these metadata columns. n then applies
+               to each group, whereas fraction applies to all rows and the
+               sampled rows are divided between the groups in proportion to
+               their sizes, so small groups are still sampled. The groups
+               are found using the metadata index if there is one,
+               otherwise the metadata columns are read.
+        :param seed: Seed for the random number generator
+        :param conditions: Optional query conditions on the metadata
+               columns, only matching rows are sampled, see
+               :meth:`filter_raw`
+        :param raw: See :meth:`filter_raw`
+        :return: The sampled rows in table order
+        """
+        if (fraction is None) == (n is None):
+            raise TableUsageException('Exactly one of fraction or n required')
+        if fraction is not None and not 0 <= fraction <= 1:
+            raise TableUsageException('fraction must be between 0 and 1')
+
+        if stratify_by:
+            groups = self._get_strata(stratify_by, conditions)
+        elif conditions:
+            groups = [self._get_offsets(conditions)]
+        else:
+            groups = [xrange(self.table.getNumberOfRows())]
+
+        rng = random.Random(seed)
+        if n is not None:
+            sizes = [min(n, len(group)) for group in groups]
+        else:
+            sizes = _allocate_sample(
+                [len(group) for group in groups], fraction, rng)
+        offsets = []
+        for group, k in izip(groups, sizes):
+            offsets.extend(rng.sample(group, k))
+        return self._read_rows(sorted(offsets), raw)
+
+    def _get_strata(self, names, conditions=None):
+        """
+        Group row offsets by the values of metadata columns
+
+        :param names: A metadata column name or list of names
+        :param conditions: Optional query conditions, only matching rows
+               are included
+        :return: A list of sorted lists of offsets, one for each group in
+                 order of the group values
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        metanames = self.metadata_names()
+        unknown = set(names).difference(metanames)
+        if unknown:
+            raise TableUsageException(
+                'Unknown metadata columns: %s' % ', '.join(sorted(unknown)))
+        positions = [metanames.index(name) for name in names]
+
+        groups = {}
+        if self.metaindex is not None and not conditions:
+            if self.metaindex_refresh:
+                self._refresh_metadata_index()
+            for key, offsets in self.metaindex.keys.iteritems():
+                groups.setdefault(tuple(key[p] for p in positions), []).extend(
+                    offsets)
+            for offsets in groups.itervalues():
+                offsets.sort()
+        else:
+            allowed = None
+            if conditions:
+                allowed = set(self._get_offsets(conditions))
+            metavals = self._read_metadata_columns()
+            keys = izip(*(metavals[p] for p in positions))
+            for offset, key in enumerate(keys):
+                if allowed is None or offset in allowed:
+                    groups.setdefault(key, []).append(offset)
+        return [groups[k] for k in sorted(groups)]
+
+    def _get_feature_locations(self, names):
+        """
+        Find the columns containing features
+
+        :param names: A list of feature names
+        :return: A list of (column number, position) for each feature,
+                 position is the index in an array column of multiple
+                 features or None
+        """
+        locations = {}
+        if self.singleftcols:
+            for n in self.singleftcols:
+                locations[self.cols[n].name] = (n, None)
+        else:
+            for n in self.multiftcols:
+                for p, name in enumerate(self.cols[n].name.split(',')):
+                    locations[name] = (n, p)
+        try:
+            return [locations[name] for name in names]
+        except KeyError as e:
+            raise TableUsageException('Unknown feature: %s' % e)
+
+    def read_numpy(self, offsets):
+        """
+        Read rows into numpy arrays, the arrays are allocated once and
+        filled directly from each chunk of columns
+
+        :param offsets: The row offsets
+        :return: A tuple of a numpy structured array with a field for each
+                 metadata column, and a 2D float64 array of feature values
+        """
+        meta, features = self._empty_numpy(len(offsets))
+        p = 0
+        for values in self._iter_table_read(offsets):
+            p = self._fill_numpy(values, meta, features, p)
+        return meta, features
+
+    def _empty_numpy(self, nrows):
+        """
+        Allocate arrays for the metadata and features of nrows rows
+        """
+        _check_numpy()
+        metadtype = numpy.dtype([
+            (self.cols[n].name,) + _column_dtype(self.cols[n])
+            for n in self.metacols])
+        ft_len = len(self.singleftcols) if self.singleftcols else sum(
+            self.cols[n].size for n in self.multiftcols)
+        return (numpy.empty(nrows, dtype=metadtype),
+                numpy.empty((nrows, ft_len), dtype=numpy.float64))
+
+    def _fill_numpy(self, values, meta, features, start):
+        """
+        Copy a chunk of column values into the metadata and feature arrays
+
+        :param values: A list of values for each column
+        :param meta: The metadata structured array
+        :param features: The 2D feature array
+        :param start: The first row to be filled
+        :return: The row after the last filled row
+        """
+        stop = start + len(values[0])
+        for n, name in izip(self.metacols, meta.dtype.names):
+            meta[name][start:stop] = values[n]
+        if self.singleftcols:
+            for i, n in enumerate(self.singleftcols):
+                features[start:stop, i] = values[n]
+        else:
+            p = 0
+            for n in self.multiftcols:
+                q = p + self.cols[n].size
+                features[start:stop, p:q] = values[n]
+                p = q
+        return stop
+
+    def _get_offsets(self, conditions):
+        """
+        Get the offsets of all rows matching a query condition, or all rows
+        if conditions is empty
+        """
+        if hasattr(conditions, 'compile'):
+            conditions = conditions.compile()
+        if conditions:
+            return self.table.getWhereList(
+                conditions, {}, 0, self.table.getNumberOfRows(), 0)
+        return xrange(self.table.getNumberOfRows())
+
     def feature_row(self, rowvalues):
         """
         Create a FeatureRow object
@@ -804,41 +3040,261 @@ class FeatureTable(AbstractFeatureStore):
 
     def get_chunk_size(self):
         """
-        Ice has a maximum message size. Use a very rough heuristic to decide
-        how many table rows to read in one go
+        Ice has a maximum message size. Calculate how many table rows to read
+        in one go from the size of each row, including the widths of string
+        columns, and :meth:`get_max_message_size`.
 
-        Assume only doubles are stored (8 bytes), and keep the table chunk size
-        to <16MB
+        If autotuning is enabled (see :meth:`set_read_options`) the number
+        of rows is adapted from the observed read throughput, but is never
+        more than this limit.
         """
         if not self.chunk_size:
-            # Use size for ArrayColumns, otherwise 1
-            rowsize = sum(getattr(c, 'size', 1) for c in self.cols)
-            self.chunk_size = max(16777216 / (rowsize * 8), 1)
+            self.chunk_size = max(
+                self.get_max_message_size() // self._get_row_size(), 1)
+
+        if self.chunk_tuner_args:
+            if not self.chunk_tuner:
+                min_rows, max_rows, target = self.chunk_tuner_args
+                max_rows = min(max_rows or self.chunk_size, self.chunk_size)
+                self.chunk_tuner = ChunkSizeTuner(
+                    max_rows, min_rows, max_rows, target)
+            return self.chunk_tuner.chunk_size
 
         return self.chunk_size
 
-    def chunked_table_read(self, offsets, chunk_size):
+    def _get_columns_chunk_size(self, colnums):
+        """
+        Calculate how many table rows to read in one go when only some
+        columns are read, see :meth:`get_chunk_size`
+
+        :param colnums: The indices of the columns to be read
+        """
+        rowsize = sum(_column_row_size(self.cols[c]) for c in colnums)
+        return max(self.get_max_message_size() // rowsize, 1)
+
+    def get_max_message_size(self):
+        """
+        Get the maximum number of bytes to send or receive in one call, this
+        is the smaller of self.max_message_size and the Ice.MessageSizeMax
+        property of the session's communicator (with a margin for protocol
+        overheads)
+        """
+        size = self.max_message_size
+        try:
+            props = self.session.ice_getCommunicator().getProperties()
+        except AttributeError:
+            return size
+        kb = props.getPropertyAsIntWithDefault('Ice.MessageSizeMax', 1024)
+        if kb > 0:
+            size = min(size, kb * 1024 * 9 // 10)
+        return size
+
+    def chunked_table_read(self, offsets, chunk_size=None):
         """
         Read part of a table in chunks to avoid the Ice maximum message size
+
+        :param offsets: The row offsets to read
+        :param chunk_size: The number of rows to read in each call, see
+               :meth:`_iter_table_read`
         """
         values = None
 
-        log.info('Chunk size: %d', chunk_size)
-        for n in xrange(0, len(offsets), chunk_size):
-            log.info('Chunk offset: %d+%d', n, chunk_size)
-            data = self.table.readCoordinates(offsets[n:(n + chunk_size)])
+        for chunk in self._iter_table_read(offsets, chunk_size):
             if values is None:
-                values = [c.values for c in data.columns]
+                values = chunk
             else:
-                for c, v in izip(data.columns, values):
-                    v.extend(c.values)
+                for c, v in izip(chunk, values):
+                    v.extend(c)
 
         return values
 
+    def _iter_table_read(self, offsets, chunk_size=None):
+        """
+        Read part of a table in chunks, yielding a list of values for each
+        column in each chunk. Runs of consecutive offsets are read as ranges.
+
+        If self.read_prefetch is set chunks are read ahead in a background
+        thread. The number of rows and the time spent waiting for the server
+        and processing each chunk are recorded in self.read_stats.
+
+        :param offsets: The row offsets to read
+        :param chunk_size: The number of rows to read in each call, default
+               is :meth:`get_chunk_size`. If no chunk size is given and
+               autotuning is enabled (see :meth:`set_read_options`) the size
+               of each chunk is adapted as the table is read.
+        """
+        tuner = None
+        if chunk_size is None:
+            chunk_size = self.get_chunk_size()
+            tuner = self.chunk_tuner
+        log.info('Chunk size: %d', chunk_size)
+
+        def read(chunk, table=self.table):
+            t = time.time()
+            if isinstance(chunk, tuple):
+                log.info('Chunk range: %d-%d', chunk[0], chunk[1])
+                data = table.read(range(len(self.cols)), chunk[0], chunk[1])
+                nrows = chunk[1] - chunk[0]
+            else:
+                log.info('Chunk coordinates: %d', len(chunk))
+                data = table.readCoordinates(chunk)
+                nrows = len(chunk)
+            if tuner:
+                tuner.observe(nrows, time.time() - t)
+            return data
+
+        # If autotuning is enabled the size of each chunk is taken from the
+        # tuner as the chunk is planned
+        if tuner:
+            plan = iter(self._plan_reads(offsets, lambda: tuner.chunk_size))
+        else:
+            plan = iter(self._plan_reads(offsets, chunk_size))
+        first = []
+        if self.read_handles > 1:
+            first = list(islice(plan, 2))
+            plan = chain(first, plan)
+        if len(first) > 1:
+            results = self._parallel_reads(read, plan)
+        elif self.read_prefetch > 0:
+            results = _prefetch(read, plan, self.read_prefetch)
+        else:
+            results = imap(read, plan)
+
+        wait = ThroughputCounter('wait')
+        decode = ThroughputCounter('decode')
+        self.read_stats = {'wait': wait, 'decode': decode}
+        t = time.time()
+        for data in results:
+            t1 = time.time()
+            values = [c.values for c in data.columns]
+            wait.add(len(values[0]), t1 - t)
+            yield values
+            t = time.time()
+            decode.add(len(values[0]), t - t1)
+        log.info('Read: %s %s', wait, decode)
+
+    def _parallel_reads(self, read, plan):
+        """
+        Read chunks concurrently using multiple handles to the same table,
+        results are yielded in the order of the plan. Up to
+        read_handles + read_prefetch chunks are read ahead.
+
+        :param read: A function read(chunk, table)
+        :param plan: An iterable of chunks, see :meth:`_plan_reads`
+        """
+        tables = Queue.Queue()
+        for t in self._get_read_tables():
+            tables.put(t)
+
+        def read_chunk(chunk):
+            t = tables.get()
+            try:
+                return read(chunk, t)
+            finally:
+                tables.put(t)
+
+        pool = ThreadPool(self.read_handles)
+        try:
+            chunks = iter(plan)
+            pending = collections.deque(
+                pool.apply_async(read_chunk, (chunk,)) for chunk in islice(
+                    chunks, self.read_handles + self.read_prefetch))
+            while pending:
+                result = pending.popleft().get()
+                for chunk in islice(chunks, 1):
+                    pending.append(pool.apply_async(read_chunk, (chunk,)))
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _get_read_tables(self):
+        """
+        Get read_handles handles to this table, opening additional handles
+        if necessary
+        """
+        if self.read_tables is None:
+            self.read_tables = []
+        nextra = self.read_handles - 1
+        if len(self.read_tables) < nextra:
+            tid = unwrap(self.table.getOriginalFile().getId())
+            while len(self.read_tables) < nextra:
+                t = self.session.sharedResources().openTable(
+                    omero.model.OriginalFileI(tid, False))
+                if not t:
+                    raise OmeroTableException(
+                        'Failed to open table ID:%d' % tid)
+                self.read_tables.append(t)
+        return [self.table] + self.read_tables[:nextra]
+
+    @staticmethod
+    def _plan_reads(offsets, chunk_size, min_run=MIN_RANGE_READ):
+        """
+        Split a list of offsets into chunks of at most chunk_size rows.
+        Runs of at least min_run consecutive offsets (or chunk_size if this is
+        smaller, but at least 2) become (start, stop) range tuples, other
+        offsets are grouped into lists of coordinates. The order of the
+        offsets is preserved.
+
+        The chunks are generated lazily. chunk_size may be a function
+        returning the current chunk size, this is called as each chunk is
+        planned so the size can change during a read.
+        """
+        if callable(chunk_size):
+            get_size = chunk_size
+        else:
+            def get_size():
+                return chunk_size
+        coords = []
+
+        def plan_run(start, stop):
+            size = get_size()
+            if stop - start >= max(min(min_run, size), 2):
+                if coords:
+                    yield list(coords)
+                    del coords[:]
+                while start < stop:
+                    size = get_size()
+                    yield (start, min(start + size, stop))
+                    start += size
+            else:
+                for n in xrange(start, stop):
+                    coords.append(n)
+                    if len(coords) >= get_size():
+                        yield list(coords)
+                        del coords[:]
+
+        start = None
+        for o in offsets:
+            if start is None:
+                start = stop = o
+            elif o != stop:
+                for chunk in plan_run(start, stop):
+                    yield chunk
+                start = o
+            stop = o + 1
+        if start is not None:
+            for chunk in plan_run(start, stop):
+                yield chunk
+        if coords:
+            yield coords
+
     def get_objects(self, object_type, kvs):
         """
         Retrieve OMERO objects
+
+        Lists of values longer than QUERY_CHUNK_SIZE are split across
+        multiple queries
         """
+        for k, v in kvs.iteritems():
+            if isinstance(v, list) and len(v) > QUERY_CHUNK_SIZE:
+                results = []
+                for n in xrange(0, len(v), QUERY_CHUNK_SIZE):
+                    ckvs = dict(kvs)
+                    ckvs[k] = v[n:(n + QUERY_CHUNK_SIZE)]
+                    results.extend(self.get_objects(object_type, ckvs))
+                return results
+
         params = omero.sys.ParametersI()
 
         qs = self.session.getQueryService()
@@ -891,6 +3347,83 @@ class FeatureTable(AbstractFeatureStore):
         link = self.session.getUpdateService().saveAndReturnObject(link)
         return link
 
+    def create_file_annotations(self, object_type, object_ids, ns, ofile):
+        """
+        Link a file annotation to multiple objects. Existing links are found
+        in one pass, and a single new annotation is linked to all objects
+        which don't already have one. Links are saved in batches of
+        QUERY_CHUNK_SIZE, the annotation is saved with the first batch so a
+        failure doesn't leave an unlinked annotation.
+
+        Unlike :meth:`create_file_annotation`, which creates an annotation
+        for each object, the new annotation is shared by all the objects.
+
+        :param object_type: The object type
+        :param object_ids: A list of object IDs
+        :param ns: The namespace
+        :param ofile: The originalFile
+        :return: A dict of object ID: link
+        """
+        fid = unwrap(ofile.getId())
+        object_ids = [long(i) for i in object_ids]
+        links = self._file_annotations_exist(object_type, object_ids, ns, fid)
+        missing = sorted(set(object_ids).difference(links.iterkeys()))
+        if not missing:
+            return links
+
+        objs = self.get_objects(object_type, {'id': missing})
+        if len(objs) != len(missing):
+            raise OmeroTableException('Failed to get %d objects of type %s' % (
+                len(missing) - len(objs), object_type))
+
+        ann = omero.model.FileAnnotationI()
+        ann.setNs(wrap(ns))
+        ann.setFile(ofile)
+
+        objtype = getattr(omero.model, '%sI' % object_type)
+        linktype = getattr(omero.model, '%sAnnotationLinkI' % object_type)
+        us = self.session.getUpdateService()
+        for n in xrange(0, len(missing), QUERY_CHUNK_SIZE):
+            newlinks = []
+            for oid in missing[n:(n + QUERY_CHUNK_SIZE)]:
+                link = linktype()
+                link.setParent(objtype(oid, False))
+                link.setChild(ann)
+                newlinks.append(link)
+            saved = us.saveAndReturnArray(newlinks)
+            for link in saved:
+                links[unwrap(link.getParent().getId())] = link
+            if not n:
+                ann = omero.model.FileAnnotationI(
+                    unwrap(saved[0].getChild().getId()), False)
+        return links
+
+    def _file_annotations_exist(self, object_type, object_ids, ns, file_id):
+        """
+        Find existing file annotation links for multiple objects
+
+        :return: A dict of object ID: link
+        """
+        q = ('FROM %sAnnotationLink ial WHERE ial.parent.id IN (:parents) '
+             'AND ial.child.ns=:ns AND ial.child.file.id=:file') % object_type
+        qs = self.session.getQueryService()
+        object_ids = list(object_ids)
+        links = {}
+        for n in xrange(0, len(object_ids), QUERY_CHUNK_SIZE):
+            params = omero.sys.ParametersI()
+            params.add('parents', wrap(
+                [long(i) for i in object_ids[n:(n + QUERY_CHUNK_SIZE)]]))
+            params.addString('ns', ns)
+            params.addLong('file', file_id)
+            for link in qs.findAllByQuery(q, params):
+                oid = unwrap(link.getParent().getId())
+                if oid in links:
+                    log.warn('Multiple links found: ns:%s %s:%d file:%d',
+                             ns, object_type, oid, file_id)
+                else:
+                    links[oid] = link
+        return links
+
     def _file_annotation_exists(self, object_type, object_id, ns, file_id):
         q = ('FROM %sAnnotationLink ial WHERE ial.parent.id=:parent AND '
              'ial.child.ns=:ns AND ial.child.file.id=:file') % object_type
@@ -942,6 +3475,20 @@ class FeatureTable(AbstractFeatureStore):
             'AnnotationLink') and not s.startswith('_')]
 
 
+def _timed_call(args):
+    """
+    Call func(arg) and measure the time taken, used to run feature
+    calculations in a process pool
+
+    :param args: A tuple (func, arg)
+    :return: A tuple (arg, result, seconds)
+    """
+    func, arg = args
+    t = time.time()
+    result = func(arg)
+    return arg, result, time.time() - t
+
+
 class LRUCache(object):
     """
     A naive least-recently-used cache. Removal is O(n)
@@ -1006,7 +3553,7 @@ class FeatureTableManager(AbstractFeatureStoreManager):
         self.cachesize = kwargs.get('cachesize', 10)
         self.fss = LRUClosableCache(kwargs.get('cachesize', 10))
 
-    def create(self, featureset_name, metadesc, names):
+    def create(self, featureset_name, metadesc, names, digest=False):
         try:
             ownerid = self.session.getAdminService().getEventContext().userId
             fs = self.get(featureset_name, ownerid)
@@ -1018,7 +3565,7 @@ class FeatureTableManager(AbstractFeatureStoreManager):
 
         coldesc = names
         fs = new_table(self.session, featureset_name, self.ft_space,
-                       self.ann_space, metadesc, coldesc)
+                       self.ann_space, metadesc, coldesc, digest=digest)
         self.fss.insert((featureset_name, ownerid), fs)
         return fs
 
@@ -1044,5 +3591,75 @@ class FeatureTableManager(AbstractFeatureStoreManager):
             self.fss.insert(k, fs)
         return fs
 
+    def compute_and_store(self, featureset_name, func, ids, processes=None,
+                          ordered=False, batch_size=1000, chunksize=1,
+                          ownerid=None):
+        """
+        Calculate features in a pool of processes and store them in a
+        featureset. All results are collected by a single writer which
+        stores them in batches.
+
+        :param featureset_name: The featureset identifier
+        :param func: A function func(id) which calculates the features for
+               an object (e.g. an image) and returns a list of
+               (meta, values) rows. This must be picklable, i.e. a module
+               level function
+        :param ids: An iterable of object IDs to be passed to func
+        :param processes: The number of worker processes, default is the
+               number of CPUs. If 0 run func in this process
+        :param ordered: If True store results in the order of ids, otherwise
+               store them as soon as they are available
+        :param batch_size: The minimum number of rows in each write
+        :param chunksize: The number of ids sent to a worker at a time
+        :param ownerid: The featureset owner, see :meth:`get`
+        :return: A dict of ThroughputCounters: 'compute' (ids and total
+                 worker time), 'write' (rows and time spent writing) and
+                 'total' (rows and wall time)
+        """
+        fs = self.get(featureset_name, ownerid)
+        stats = dict((k, ThroughputCounter(k)) for k in (
+            'compute', 'write', 'total'))
+        start = time.time()
+        args = ((func, i) for i in ids)
+
+        pool = None
+        if processes == 0:
+            results = imap(_timed_call, args)
+        else:
+            pool = multiprocessing.Pool(processes)
+            if ordered:
+                results = pool.imap(_timed_call, args, chunksize)
+            else:
+                results = pool.imap_unordered(_timed_call, args, chunksize)
+
+        metas = []
+        values = []
+
+        def write():
+            t = time.time()
+            fs.store_many(metas, values)
+            stats['write'].add(len(metas), time.time() - t)
+            del metas[:]
+            del values[:]
+
+        try:
+            for i, rows, seconds in results:
+                stats['compute'].add(1, seconds)
+                for meta, value in rows:
+                    metas.append(meta)
+                    values.append(value)
+                if len(metas) >= batch_size:
+                    write()
+            if metas:
+                write()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        stats['total'].add(stats['write'].count, time.time() - start)
+        log.info('Computed and stored %s: %s', featureset_name, stats)
+        return stats
+
     def close(self):
         self.fss.close()
@@ -1,4 +1,5 @@
 import OmeroTablesFeatureStore
+import query
 import utils
 
-__all__ = ['OmeroTablesFeatureStore', 'utils']
+__all__ = ['OmeroTablesFeatureStore', 'query', 'utils']
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Structured queries on metadata columns which compile to OMERO.tables
+(PyTables) conditions
+
+Queries can be combined with ``&``, ``|`` and ``~``, for example::
+
+    q = In('ImageID', [1, 2, 3, 4, 10], ranges=True) & ~Eq('Well', 'A01')
+    rows = table.filter_raw(q)
+
+Feature values can't be queried on the server, instead predicates on named
+features are evaluated on the client::
+
+    p = (Feature('area') > 500) & (Feature('intensity') < 0.2)
+    rows = table.filter_features(p, q)
+"""
+
+from abc import ABCMeta, abstractmethod
+import operator
+
+from OmeroTablesFeatureStore import TableUsageException, _balanced_join
+
+
+# Minimum number of consecutive integers in an In query which are
+# compiled into a range instead of individual equality terms
+MIN_IN_RANGE = 3
+
+
+def _literal(value):
+    """
+    Convert a value into a condition literal
+    """
+    if isinstance(value, basestring):
+        return '"%s"' % value.replace('"', '\\"')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _never(column):
+    """
+    A condition which never matches, including NaN values
+    """
+    return '(%s<%s)' % (column, column)
+
+
+class Query(object):
+    """
+    Base class for queries
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def compile(self):
+        """
+        Compile this query into a condition string
+        """
+        pass
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __str__(self):
+        return self.compile()
+
+
+class Eq(Query):
+    """
+    column == value
+    """
+
+    def __init__(self, column, value):
+        self.column = column
+        self.value = value
+
+    def compile(self):
+        return '(%s==%s)' % (self.column, _literal(self.value))
+
+
+class In(Query):
+    """
+    column is one of a set of values
+    """
+
+    def __init__(self, column, values, ranges=False):
+        """
+        :param column: The column name
+        :param values: The values to match
+        :param ranges: If True compile runs of consecutive integers into
+               ranges, this is only correct for integer columns
+        """
+        self.column = column
+        self.values = values
+        self.ranges = ranges
+
+    def compile(self):
+        values = sorted(set(self.values))
+        if not values:
+            return _never(self.column)
+        terms = []
+        run = []
+        for v in values:
+            if not self.ranges or not _is_integer(v):
+                terms.append(Eq(self.column, v).compile())
+                continue
+            if run and v != run[-1] + 1:
+                terms.extend(self._compile_run(run))
+                run = []
+            run.append(v)
+        terms.extend(self._compile_run(run))
+        return _balanced_join(terms, '|')
+
+    def _compile_run(self, run):
+        if len(run) >= MIN_IN_RANGE:
+            return [Range(self.column, run[0], run[-1] + 1).compile()]
+        return [Eq(self.column, v).compile() for v in run]
+
+
+class Range(Query):
+    """
+    low <= column < high, either bound may be None
+    """
+
+    def __init__(self, column, low=None, high=None):
+        if low is None and high is None:
+            raise TableUsageException('Range requires at least one bound')
+        self.column = column
+        self.low = low
+        self.high = high
+
+    def intersect(self, other):
+        """
+        Combine with another range on the same column, the result may be
+        empty
+        """
+        assert self.column == other.column
+        low = self.low if other.low is None else (
+            other.low if self.low is None else max(self.low, other.low))
+        high = self.high if other.high is None else (
+            other.high if self.high is None else min(self.high, other.high))
+        return Range(self.column, low, high)
+
+    def empty(self):
+        return (self.low is not None and self.high is not None and
+                self.low >= self.high)
+
+    def compile(self):
+        if self.empty():
+            return _never(self.column)
+        terms = []
+        if self.low is not None:
+            terms.append('(%s<=%s)' % (_literal(self.low), self.column))
+        if self.high is not None:
+            terms.append('(%s<%s)' % (self.column, _literal(self.high)))
+        return _balanced_join(terms, '&')
+
+
+class Not(Query):
+    """
+    Negate a query
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+    def compile(self):
+        return '~%s' % self.query.compile()
+
+
+class And(Query):
+    """
+    All queries must match. Ranges on the same column are merged.
+    """
+
+    def __init__(self, *queries):
+        if not queries:
+            raise TableUsageException('At least one query is required')
+        self.queries = queries
+
+    def compile(self):
+        queries = []
+        ranges = {}
+        for q in _flatten(self.queries, And):
+            if isinstance(q, Range):
+                if q.column in ranges:
+                    ranges[q.column] = ranges[q.column].intersect(q)
+                    continue
+                ranges[q.column] = q
+                # Placeholder to preserve the order of the terms
+                q = q.column
+            queries.append(q)
+        terms = [ranges[t].compile() if isinstance(t, basestring) else
+                 t.compile() for t in queries]
+        return _balanced_join(_unique(terms), '&')
+
+
+class Or(Query):
+    """
+    Any query must match. Equality and In queries on the same column are
+    merged into a single In query, ranges are enabled if they are enabled
+    for any of the In queries on the column.
+    """
+
+    def __init__(self, *queries):
+        if not queries:
+            raise TableUsageException('At least one query is required')
+        self.queries = queries
+
+    def compile(self):
+        queries = []
+        values = {}
+        ranges = set()
+        for q in _flatten(self.queries, Or):
+            if isinstance(q, (Eq, In)):
+                if isinstance(q, In) and q.ranges:
+                    ranges.add(q.column)
+                if q.column in values:
+                    values[q.column].extend(_values(q))
+                    continue
+                values[q.column] = list(_values(q))
+                q = q.column
+            queries.append(q)
+        terms = [In(t, values[t], t in ranges).compile()
+                 if isinstance(t, basestring) else t.compile()
+                 for t in queries]
+        return _balanced_join(_unique(terms), '|')
+
+
+def _values(q):
+    if isinstance(q, Eq):
+        return [q.value]
+    return q.values
+
+
+def _flatten(queries, cls):
+    """
+    Expand nested queries of the same class
+    """
+    for q in queries:
+        if isinstance(q, cls):
+            for r in _flatten(q.queries, cls):
+                yield r
+        else:
+            yield q
+
+
+def _unique(terms):
+    """
+    Remove duplicate terms, preserving the order
+    """
+    seen = set()
+    unique = []
+    for t in terms:
+        if t not in seen:
+            seen.add(t)
+            unique.append(t)
+    return unique
+
+
+class FeaturePredicate(object):
+    """
+    Base class for predicates on feature values, evaluated on a 2D array of
+    features with one row per table row
+    """
+
+    __metaclass__ = ABCMeta
+
+    def evaluate(self, features, names):
+        """
+        Evaluate the predicate
+
+        :param features: A 2D numpy array of feature values
+        :param names: The names of the feature columns
+        :return: A boolean numpy array with one element per row
+        """
+        return self._evaluate(features, dict((n, i) for i, n in enumerate(
+            names)))
+
+    @abstractmethod
+    def _evaluate(self, features, index):
+        pass
+
+    @abstractmethod
+    def feature_names(self):
+        """
+        Get the set of names of the features used by this predicate
+        """
+        pass
+
+    def __and__(self, other):
+        return FeatureAnd(self, other)
+
+    def __or__(self, other):
+        return FeatureOr(self, other)
+
+    def __invert__(self):
+        return FeatureNot(self)
+
+
+class Feature(object):
+    """
+    A named feature, compare with a value or another Feature to create a
+    predicate
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def values(self, features, index):
+        try:
+            return features[:, index[self.name]]
+        except KeyError:
+            raise TableUsageException('Unknown feature: %s' % self.name)
+
+    def __lt__(self, value):
+        return FeatureCompare(self, operator.lt, value)
+
+    def __le__(self, value):
+        return FeatureCompare(self, operator.le, value)
+
+    def __gt__(self, value):
+        return FeatureCompare(self, operator.gt, value)
+
+    def __ge__(self, value):
+        return FeatureCompare(self, operator.ge, value)
+
+    def __eq__(self, value):
+        return FeatureCompare(self, operator.eq, value)
+
+    def __ne__(self, value):
+        return FeatureCompare(self, operator.ne, value)
+
+
+class FeatureCompare(FeaturePredicate):
+    """
+    Compare a feature with a value or another feature, all comparisons with
+    NaN except != are False
+    """
+
+    def __init__(self, feature, op, value):
+        self.feature = feature
+        self.op = op
+        self.value = value
+
+    def _evaluate(self, features, index):
+        value = self.value
+        if isinstance(value, Feature):
+            value = value.values(features, index)
+        return self.op(self.feature.values(features, index), value)
+
+    def feature_names(self):
+        names = set([self.feature.name])
+        if isinstance(self.value, Feature):
+            names.add(self.value.name)
+        return names
+
+
+class FeatureNot(FeaturePredicate):
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def _evaluate(self, features, index):
+        return ~self.predicate._evaluate(features, index)
+
+    def feature_names(self):
+        return self.predicate.feature_names()
+
+
+class FeatureAnd(FeaturePredicate):
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def _evaluate(self, features, index):
+        return reduce(operator.and_, (
+            p._evaluate(features, index) for p in self.predicates))
+
+    def feature_names(self):
+        return set().union(*(p.feature_names() for p in self.predicates))
+
+
+class FeatureOr(FeaturePredicate):
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def _evaluate(self, features, index):
+        return reduce(operator.or_, (
+            p._evaluate(features, index) for p in self.predicates))
+
+    def feature_names(self):
+        return set().union(*(p.feature_names() for p in self.predicates))
@@ -26,6 +26,11 @@ OMERO.features utility methods
 import omero
 from omero.rtypes import rdouble, rint, rstring, unwrap
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def create_roi_for_plane(session, iid, z, c, t, robject=False):
     """
@@ -173,3 +178,38 @@ def find_rois_for_plane(session, iid=None, z=None, c=None, t=None,
     else:
         rois = qs.findAllByQuery(q, params)
     return rois
+
+
+def fetch_features_for_rois(session, table, roi_column='RoiID', iid=None,
+                            z=None, c=None, t=None, chname=None,
+                            shapetype=None, fullplane=True, singleshape=True):
+    """
+    Find ROIs by properties and fetch their features from a feature table.
+    The ROI IDs are found with a single projection query and all rows are
+    found with one batched lookup (see :meth:`FeatureTable.fetch_many`)
+    instead of one query per ROI.
+
+    :param session: An active session
+    :param table: A :class:`OmeroTablesFeatureStore.FeatureTable`
+    :param roi_column: The name of the table metadata column holding the ROI
+        IDs
+    :param iid, z, c, t, chname, shapetype, fullplane, singleshape: ROI
+        query criteria, see :func:`find_rois_for_plane`
+    :return: A tuple of the list of ROI IDs and a 2D numpy array of
+        features with one row for each ROI. Rows are NaN for ROIs which
+        aren't in the table, if a ROI has several rows the last is used.
+    """
+    rois = find_rois_for_plane(
+        session, iid=iid, z=z, c=c, t=t, chname=chname, shapetype=shapetype,
+        fullplane=fullplane, singleshape=singleshape, projection=True)
+    rois = rois or []
+    meta, features = table.fetch_many(
+        [{roi_column: r} for r in rois], raw='numpy')
+
+    rows = dict((r, n) for n, r in enumerate(meta[roi_column].tolist()))
+    aligned = numpy.empty((len(rois), features.shape[1]))
+    aligned.fill(numpy.nan)
+    for n, r in enumerate(rois):
+        if r in rows:
+            aligned[n] = features[rows[r]]
+    return rois, aligned
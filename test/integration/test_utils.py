@@ -29,6 +29,7 @@ import omero
 import omero.gateway
 from omero.rtypes import rdouble, unwrap
 
+from features import OmeroTablesFeatureStore
 from features import utils
 
 
@@ -128,3 +129,34 @@ class TestUtils(object):
             self.sess, iid=iid, c=4, fullplane=False, singleshape=False,
             projection=projection)
         assert getIds(rs, not projection) == getIds([r2, r3, r4])
+
+    def test_fetch_features_for_rois(self):
+        im = self.create_image()
+        iid = unwrap(im.getId())
+        r1 = utils.create_roi_for_plane(self.sess, iid, 1, 2, 3)
+        r2 = utils.create_roi_for_plane(self.sess, iid, 1, 2, 3)
+        r3 = utils.create_roi_for_plane(self.sess, iid, 1, 3, 3)
+
+        uuid = self.cli.getSessionId()
+        store = OmeroTablesFeatureStore.new_table(
+            self.sess, 'name', '/test/features/%s' % uuid,
+            '/test/features/%s/source' % uuid, [('Roi', 'RoiID')], ['a', 'b'])
+        try:
+            store.store([r1], [1, 2])
+            store.store([r3], [5, 6])
+
+            rois, features = utils.fetch_features_for_rois(
+                self.sess, store, iid=iid, c=2)
+            assert sorted(rois) == sorted([r1, r2])
+            assert features.shape == (2, 2)
+            row1 = features[rois.index(r1)]
+            row2 = features[rois.index(r2)]
+            assert row1.tolist() == [1, 2]
+            assert numpy.isnan(row2).all()
+
+            rois, features = utils.fetch_features_for_rois(
+                self.sess, store, iid=iid, z=1000)
+            assert rois == []
+            assert features.shape == (0, 2)
+        finally:
+            store.close()
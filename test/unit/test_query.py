@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2014 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import numpy
+import pytest
+
+from features import OmeroTablesFeatureStore
+from features.query import (
+    And, Eq, Feature, FeaturePredicate, In, Not, Or, Query, Range)
+
+
+class TestQuery(object):
+
+    def test_eq(self):
+        assert Eq('a', 1).compile() == '(a==1)'
+        assert Eq('a', 2.5).compile() == '(a==2.5)'
+        assert Eq('b', 'x"y').compile() == '(b=="x\\"y")'
+
+    def test_in(self):
+        assert In('a', [3]).compile() == '(a==3)'
+        assert In('a', [7, 3, 3]).compile() == '((a==3) | (a==7))'
+        assert In('a', [1, 2, 3, 4, 10], ranges=True).compile() == (
+            '(((1<=a) & (a<5)) | (a==10))')
+        assert In('a', [1, 2, 5, 6, 7, 9], ranges=True).compile() == (
+            '(((a==1) | (a==2)) | (((5<=a) & (a<8)) | (a==9)))')
+        assert In('a', [1, 2, 3]).compile() == (
+            '((a==1) | ((a==2) | (a==3)))')
+        assert In('a', [1.0, 2.0, 3.0], ranges=True).compile() == (
+            '((a==1.0) | ((a==2.0) | (a==3.0)))')
+        assert In('b', ['x', 'y']).compile() == '((b=="x") | (b=="y"))'
+        assert In('a', []).compile() == '(a<a)'
+
+    def test_range(self):
+        assert Range('a', 1, 5).compile() == '((1<=a) & (a<5))'
+        assert Range('a', low=1).compile() == '(1<=a)'
+        assert Range('a', high=0.5).compile() == '(a<0.5)'
+        assert Range('a', 5, 5).compile() == '(a<a)'
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            Range('a')
+
+    def test_not(self):
+        assert (~Eq('a', 1)).compile() == '~(a==1)'
+        assert Not(In('a', [1, 2])).compile() == '~((a==1) | (a==2))'
+
+    def test_and(self):
+        assert (Eq('a', 1) & Eq('b', 2)).compile() == '((a==1) & (b==2))'
+        q = Range('a', 1, 10) & Eq('b', 2) & Range('a', low=3) & Range(
+            'a', high=8)
+        assert q.compile() == '(((3<=a) & (a<8)) & (b==2))'
+        assert (Range('a', 1, 3) & Range('a', 5, 8)).compile() == '(a<a)'
+        assert (Eq('a', 1) & Eq('a', 1)).compile() == '(a==1)'
+
+    def test_or(self):
+        q = Eq('a', 1) | Eq('b', 2) | In('a', [2, 3], ranges=True) | Range(
+            'c', 0, 1)
+        assert q.compile() == (
+            '(((1<=a) & (a<4)) | ((b==2) | ((0<=c) & (c<1))))')
+        q = Eq('a', 1) | Eq('a', 2) | Eq('a', 3)
+        assert q.compile() == '((a==1) | ((a==2) | (a==3)))'
+        q = Or(Eq('a', 1) & Eq('b', 2), Eq('a', 3) & Eq('b', 4))
+        assert q.compile() == '(((a==1) & (b==2)) | ((a==3) & (b==4)))'
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            Or()
+
+    def test_abstract(self):
+        class Incomplete(Query):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def test_balanced(self):
+        q = Or(*[Eq('b', str(n)) for n in xrange(1024)])
+        depth = 0
+        maxdepth = 0
+        for c in q.compile():
+            if c == '(':
+                depth += 1
+                maxdepth = max(depth, maxdepth)
+            elif c == ')':
+                depth -= 1
+        assert maxdepth == 11
+        assert str(And(Eq('a', 1))) == '(a==1)'
+
+
+class TestFeaturePredicate(object):
+
+    def test_evaluate(self):
+        names = ['area', 'intensity', 'perimeter']
+        features = numpy.array([
+            [100, 0.1, 50],
+            [600, 0.1, 700],
+            [700, 0.5, 10],
+            [800, numpy.nan, 900],
+        ])
+
+        p = Feature('area') > 500
+        assert p.evaluate(features, names).tolist() == [
+            False, True, True, True]
+        p = (Feature('area') > 500) & (Feature('intensity') < 0.2)
+        assert p.evaluate(features, names).tolist() == [
+            False, True, False, False]
+        p = (Feature('area') <= 100) | ~(Feature('intensity') != 0.5)
+        assert p.evaluate(features, names).tolist() == [
+            True, False, True, False]
+        p = Feature('perimeter') >= Feature('area')
+        assert p.evaluate(features, names).tolist() == [
+            False, True, False, True]
+        p = Feature('intensity') == 0.1
+        assert p.evaluate(features, names).tolist() == [
+            True, True, False, False]
+
+    def test_abstract(self):
+        class Incomplete(FeaturePredicate):
+            def feature_names(self):
+                return set()
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def test_unknown_feature(self):
+        p = Feature('x') > 1
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            p.evaluate(numpy.zeros((2, 1)), ['y'])
@@ -23,11 +23,14 @@ import pytest
 import mox
 import copy
 import itertools
+import numpy
+import random
 
 import omero
 from omero.rtypes import unwrap, wrap
 
 from features import OmeroTablesFeatureStore
+from features import query
 
 
 class TestLRUCache(object):
@@ -112,6 +115,9 @@ class MockUpdateService:
     def saveAndReturnObject(self, o):
         pass
 
+    def saveAndReturnArray(self, os):
+        pass
+
     def deleteObject(self, o):
         pass
 
@@ -181,6 +187,22 @@ class MockOriginalFile:
         return self.path
 
 
+class MockProperties:
+    def __init__(self, props):
+        self.props = props
+
+    def getPropertyAsIntWithDefault(self, key, default):
+        return self.props.get(key, default)
+
+
+class MockCommunicator:
+    def __init__(self, props):
+        self.props = MockProperties(props)
+
+    def getProperties(self):
+        return self.props
+
+
 class MockColumn:
     def __init__(self, name=None, values=None, size=None, desc=None):
         self.name = name
@@ -225,10 +247,16 @@ class MockTable:
     def initialize(self, desc):
         pass
 
+    def read(self, colNumbers, start, stop):
+        pass
+
     def readCoordinates(self):
         pass
 
-    def update(self):
+    def slice(self, colNumbers, rowNumbers):
+        pass
+
+    def update(self, data):
         pass
 
 
@@ -255,6 +283,203 @@ class MockFeatureTable(OmeroTablesFeatureStore.FeatureTable):
             '/test/features/ann_space')
 
 
+class TestChunkSizeTuner(object):
+
+    def test_observe(self):
+        tuner = OmeroTablesFeatureStore.ChunkSizeTuner(
+            100, 10, 1000, target_seconds=1.0, smoothing=0)
+        assert tuner.chunk_size == 100
+        tuner.observe(100, 0.5)
+        # Limited to a factor of 2 per observation
+        assert tuner.chunk_size == 200
+        tuner.observe(200, 0.8)
+        assert tuner.chunk_size == 250
+        tuner.observe(250, 100)
+        assert tuner.chunk_size == 125
+        tuner.observe(125, 0)
+        assert tuner.chunk_size == 125
+
+    def test_limits(self):
+        tuner = OmeroTablesFeatureStore.ChunkSizeTuner(
+            100, 60, 150, smoothing=0)
+        tuner.observe(100, 0.1)
+        assert tuner.chunk_size == 150
+        tuner.observe(100, 100)
+        assert tuner.chunk_size == 75
+        tuner.observe(100, 100)
+        assert tuner.chunk_size == 60
+
+    def test_smoothing(self):
+        tuner = OmeroTablesFeatureStore.ChunkSizeTuner(
+            100, smoothing=0.5)
+        tuner.observe(100, 1)
+        assert tuner.chunk_size == 100
+        tuner.observe(150, 0.5)
+        # rate = 0.5 * 100 + 0.5 * 300
+        assert tuner.chunk_size == 200
+
+
+class TestMetadataIndex(object):
+
+    def test_lookup(self):
+        index = OmeroTablesFeatureStore.MetadataIndex(['a', 'b'])
+        index.add([[1, 2, 1], ['x', 'y', 'z']])
+        index.add([[3, 1], ['x', 'x']])
+        assert len(index) == 5
+
+        assert index.lookup([('a', 1), ('b', 'x')]) == [0, 4]
+        assert index.lookup([('b', 'x'), ('a', 3)]) == [3]
+        assert index.lookup([('a', 2), ('b', 'x')]) == []
+        assert index.lookup([('a', 1), ('b', None)]) == [0, 2, 4]
+        assert index.lookup([('a', [2, 3]), ('b', ['x', 'y'])]) == [1, 3]
+        assert index.lookup([('b', 'z')]) == [2]
+        assert index.lookup([('a', None)]) == [0, 1, 2, 3, 4]
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            index.lookup([('c', 1)])
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            index.add([[1]])
+
+
+class TestPendingSpill(object):
+
+    def test_append_read(self, tmpdir):
+        cols = [omero.grid.LongColumn('a'), omero.grid.StringColumn(
+            'b', '', 4), omero.grid.DoubleArrayColumn('c', '', 2)]
+        cols[0].values = [1, 2, 3]
+        cols[1].values = ['x', u'caf\xe9', 'caf\xc3\xa9']
+        cols[2].values = [[1, 2], [3, 4], [5, 6]]
+        spill = OmeroTablesFeatureStore.PendingSpill(cols, str(tmpdir))
+        spill.append(cols)
+        assert len(spill) == 3
+
+        # Non-ASCII strings are read back UTF-8 encoded
+        read = copy.deepcopy(cols)
+        assert spill.read(read, 2) == 2
+        assert [c.values for c in read] == [
+            [1, 2], ['x', 'caf\xc3\xa9'], [[1, 2], [3, 4]]]
+        spill.advance(2)
+        assert spill.read(read, 2) == 1
+        assert [c.values for c in read] == [
+            [3], ['caf\xc3\xa9'], [[5, 6]]]
+        spill.advance(1)
+        assert len(spill) == 0
+        spill.close()
+        assert len(tmpdir.listdir()) == 0
+
+
+class TestRandomProjectionIndex(object):
+
+    def test_candidates(self):
+        rng = numpy.random.RandomState(1)
+        features = rng.standard_normal((100, 5))
+        index = OmeroTablesFeatureStore.RandomProjectionIndex(5, 32, seed=2)
+        index.add(features[:60])
+        index.add(features[60:])
+        assert len(index) == 100
+        assert index.codes.shape == (100, 4)
+        c = index.candidates(features[70], 5)
+        assert len(c) == 5
+        assert 70 in c
+        assert c == sorted(c)
+
+    def test_save_load(self, tmpdir):
+        features = numpy.arange(20, dtype=float).reshape(10, 2)
+        index = OmeroTablesFeatureStore.RandomProjectionIndex(2, 8, seed=2)
+        index.add(features)
+        path = str(tmpdir.join('index'))
+        index.save(path)
+        loaded = OmeroTablesFeatureStore.RandomProjectionIndex.load(path)
+        assert len(loaded) == 10
+        assert loaded.table_id is None
+        assert numpy.array_equal(loaded.planes, index.planes)
+        assert numpy.array_equal(loaded.mean, index.mean)
+        assert loaded.candidates(features[3], 3) == index.candidates(
+            features[3], 3)
+
+        index.table_id = 12
+        index.save(path)
+        loaded = OmeroTablesFeatureStore.RandomProjectionIndex.load(path)
+        assert loaded.table_id == 12
+
+    def test_replace(self):
+        features = numpy.arange(20, dtype=float).reshape(10, 2)
+        index = OmeroTablesFeatureStore.RandomProjectionIndex(2, 8, seed=2)
+        index.add(features)
+        index.replace([1, 4], -features[[1, 4]])
+        assert len(index) == 10
+        assert numpy.array_equal(
+            index.codes[[1, 4]], index._hash(-features[[1, 4]]))
+
+
+class TestFeatureStatistics(object):
+
+    def test_update(self):
+        rng = numpy.random.RandomState(1)
+        features = rng.standard_normal((50, 3)) * [1, 10, 100] + 1e6
+        features[[3, 7], 1] = numpy.nan
+        features[:, 2] = numpy.nan
+        stats = OmeroTablesFeatureStore.FeatureStatistics(3)
+        for n in xrange(0, 50, 7):
+            stats.update(features[n:n + 7])
+        stats.update(features[:0])
+
+        r = stats.results()
+        assert r['count'].tolist() == [50, 48, 0]
+        assert r['nan'].tolist() == [0, 2, 50]
+        assert numpy.allclose(r['mean'][:2], numpy.nanmean(
+            features[:, :2], axis=0))
+        assert numpy.allclose(r['std'][:2], numpy.nanstd(
+            features[:, :2], axis=0, ddof=1))
+        assert numpy.allclose(r['min'][:2], numpy.nanmin(
+            features[:, :2], axis=0))
+        assert numpy.allclose(r['max'][:2], numpy.nanmax(
+            features[:, :2], axis=0))
+        assert numpy.isnan([r[k][2] for k in (
+            'mean', 'std', 'min', 'max')]).all()
+
+    def test_histogram_merge(self):
+        features = numpy.array([[0, 1], [0.5, 2], [1, 3], [2, numpy.nan]])
+        a = OmeroTablesFeatureStore.FeatureStatistics(2, [0, 0.5, 1])
+        b = OmeroTablesFeatureStore.FeatureStatistics(
+            2, [[0, 0.5, 1], [1, 2, 3]])
+        a.update(features[:2])
+        b.update(features[2:])
+        assert a.histogram.tolist() == [[1, 1], [0, 1]]
+        assert b.histogram.tolist() == [[0, 1], [0, 1]]
+        a.merge(b)
+        assert a.histogram.tolist() == [[1, 2], [0, 2]]
+        assert a.count.tolist() == [4, 3]
+        assert numpy.allclose(a.mean, [0.875, 2])
+        assert numpy.allclose(a.variance(0), [0.546875, 2. / 3])
+
+
+class TestGroupedFeatureStatistics(object):
+
+    def test_update(self):
+        keys = numpy.array([(1, 7), (2, 7), (1, 7), (1, 8), (2, 7)],
+                           dtype=[('x', 'i8'), ('y', 'i8')])
+        features = numpy.array(
+            [[1, 10], [2, 20], [3, numpy.nan], [4, 40], [6, 60]])
+        stats = OmeroTablesFeatureStore.GroupedFeatureStatistics(2)
+        stats.update(keys[:3], features[:3])
+        stats.update(keys[3:], features[3:])
+        stats.update(keys[:0], features[:0])
+
+        r = stats.results()
+        assert r['keys'] == [(1, 7), (1, 8), (2, 7)]
+        assert r['size'].tolist() == [2, 1, 2]
+        assert r['count'].tolist() == [[2, 1], [1, 1], [2, 2]]
+        assert r['nan'].tolist() == [[0, 1], [0, 0], [0, 0]]
+        assert r['mean'].tolist() == [[2, 10], [4, 40], [4, 40]]
+        assert r['min'].tolist() == [[1, 10], [4, 40], [2, 20]]
+        assert r['max'].tolist() == [[3, 10], [4, 40], [6, 60]]
+        std = r['std']
+        assert numpy.allclose(std[0], [numpy.sqrt(2), numpy.nan],
+                              equal_nan=True)
+        assert numpy.isnan(std[1]).all()
+        assert numpy.allclose(std[2], [numpy.sqrt(8), numpy.sqrt(800)])
+
+
 class TestFeatureRow(object):
 
     def test_init(self):
@@ -477,6 +702,34 @@ class TestFeatureTable(object):
         assert store.cols == tcols
         self.mox.VerifyAll()
 
+    def test_new_table_digest(self):
+        table = self.mox.CreateMock(MockTable)
+        session = MockSession(1, table, None)
+        store = MockFeatureTable(session)
+
+        mf = MockOriginalFile(1, 'table-name', store.ft_space)
+        table.getOriginalFile().AndReturn(mf)
+
+        tcols = (
+            omero.grid.ImageColumn('ImageID', '{"columntype": "metadata"}'),
+            omero.grid.DoubleArrayColumn(
+                'x', '{"columntype": "multifeature"}', 1),
+            omero.grid.StringColumn(
+                '_digest', '{"columntype": "digest"}', 40),
+        )
+
+        table.initialize(mox.Func(lambda xs: self.columns_equal(xs, tcols)))
+        table.getHeaders().AndReturn(tcols)
+
+        self.mox.ReplayAll()
+
+        store.new_table([('Image', 'ImageID')], ['x'], digest=True)
+        assert store.metacols == (0,)
+        assert store.multiftcols == (1,)
+        assert store.digestcol == 2
+        assert store.metadata_names() == ('ImageID',)
+        self.mox.VerifyAll()
+
     def test_new_table_invalid_ftname(self):
         store = MockFeatureTable(None)
         with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
@@ -635,6 +888,12 @@ class TestFeatureTable(object):
         else:
             assert store.cols[2].values == [[2, 3]]
 
+        store.cols.append(MockColumn(name='_digest', values=[]))
+        store.digestcol = len(store.cols) - 1
+        store._vals_to_cols(store.cols, [1, 'abc'], [2, 3])
+        assert store.cols[-1].values == [
+            OmeroTablesFeatureStore._digest([2, 3])]
+
     @pytest.mark.parametrize('coltype', ['single', 'multi'])
     def test_colrow_to_vals(self, coltype):
         store = MockFeatureTable(None)
@@ -672,6 +931,29 @@ class TestFeatureTable(object):
         store.store(meta, values)
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('changed', [True, False])
+    def test_store_digest(self, changed):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.cols.append(MockColumn('_digest'))
+        store.digestcol = 3
+        self.mox.StubOutWithMock(table, 'slice')
+        digest = OmeroTablesFeatureStore._digest(values)
+
+        table.getNumberOfRows().AndReturn(100)
+        table.getWhereList('(a==12) & (b==-1)',
+                           {}, 0, 100, 0).AndReturn([20])
+        data = MockTableData()
+        data.columns = [MockColumn(values=['x' if changed else digest])]
+        table.slice([3], [20]).AndReturn(data)
+        if changed:
+            table.update(mox.Func(
+                lambda o: o.rowNumbers == [20] and
+                o.columns == expectedcols + [MockColumn('_digest', [digest])]))
+
+        self.mox.ReplayAll()
+        store.store(meta, values)
+        self.mox.VerifyAll()
+
     def test_store_unowned(self):
         owned = False
         perms = self.mox.CreateMock(MockPermissionsHandler)
@@ -710,206 +992,1611 @@ class TestFeatureTable(object):
         assert store.pendingcols is None
         self.mox.VerifyAll()
 
-    def test_fetch_by_metadata(self):
+    @pytest.mark.parametrize('metatype', ['list', 'array', 'structured'])
+    @pytest.mark.parametrize('coltype', ['single', 'multi'])
+    def test_arrays_to_cols(self, metatype, coltype):
         store = MockFeatureTable(None)
-        store.cols = [MockColumn(name='a')]
-        self.mox.StubOutWithMock(store, 'filter_raw')
-        self.mox.StubOutWithMock(store, 'feature_row')
+        store.cols = [MockColumn(name='a'), MockColumn(name='b')]
+        store.metacols = (0, 1)
+        if coltype == 'single':
+            store.cols.extend([MockColumn(name='c'), MockColumn(name='d')])
+            store.singleftcols = (2, 3)
+        else:
+            store.cols.append(MockColumn(name='c,d', size=2))
+            store.multiftcols = (2,)
 
-        meta = {'a': 1}
-        rs = (1, 2, [0])
-        r1 = object()
+        meta = [(1, 2), (3, 4), (5, 6)]
+        if metatype == 'array':
+            meta = numpy.array(meta)
+        elif metatype == 'structured':
+            meta = numpy.array(meta, dtype=[('a', int), ('b', int)])
+        values = numpy.arange(6).reshape(3, 2)
 
-        store.fetch_by_metadata_raw(meta).AndReturn([rs])
-        store.feature_row(rs).AndReturn(r1)
+        assert store._arrays_to_cols(store.cols, meta, values) == 3
+        assert store.cols[0].values == [1, 3, 5]
+        assert store.cols[1].values == [2, 4, 6]
+        if coltype == 'single':
+            assert store.cols[2].values == [0.0, 2.0, 4.0]
+            assert store.cols[3].values == [1.0, 3.0, 5.0]
+        else:
+            assert store.cols[2].values == [[0.0, 1.0], [2.0, 3.0],
+                                            [4.0, 5.0]]
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store._arrays_to_cols(store.cols, meta, values[:, :1])
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store._arrays_to_cols(store.cols, meta, values[:2])
+
+    def test_store_many(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        expectedcols = [MockColumn('a', [12, 13]), MockColumn('b', [-1, -2]),
+                        MockColumn('c', [[10, 20], [30, 40]], 2)]
+        table.addData(expectedcols)
 
         self.mox.ReplayAll()
-        assert store.fetch_by_metadata(meta) == [r1]
+        assert store.store_many(
+            [(12, -1), (13, -2)], [[10, 20], [30, 40]]) == 2
+        assert [col.values for col in store.cols] == [None, None, None]
         self.mox.VerifyAll()
 
-    @pytest.mark.parametrize('meta', [[1, 2], {'a': 1, 'b': 2}])
-    def test_fetch_by_metadata_raw(self, meta):
-        table = self.mox.CreateMock(MockTable)
-        store = MockFeatureTable(None)
-        store.table = table
-        store.cols = [
-            MockColumn(name='a'), MockColumn(name='b'),
-            MockColumn(name='c', size=1)]
-        store.metacols = (0, 1)
-        store.ftcols = (2,)
+    @pytest.mark.parametrize('exists', ['all', 'some', 'none'])
+    def test_store_many_replace(self, exists):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        self.mox.StubOutWithMock(store, '_find_offsets')
+        meta = [(12, -1), (13, -2)]
+        values = [[10, 20], [30, 40]]
+
+        if exists == 'all':
+            offsets = [5, 3]
+        elif exists == 'some':
+            offsets = [-1, 3]
+        else:
+            offsets = [-1, -1]
+        store._find_offsets(mox.Func(
+            lambda ks: list(ks) == meta)).AndReturn(offsets)
 
-        self.mox.StubOutWithMock(store, 'filter_raw')
-        rs = (1, 2, [0])
+        if exists == 'all':
+            table.update(mox.Func(
+                lambda o: o.rowNumbers == [5, 3] and o.columns == [
+                    MockColumn('a', [12, 13]), MockColumn('b', [-1, -2]),
+                    MockColumn('c', [[10, 20], [30, 40]], 2)]))
+        elif exists == 'some':
+            table.update(mox.Func(
+                lambda o: o.rowNumbers == [3] and o.columns == [
+                    MockColumn('a', [13]), MockColumn('b', [-2]),
+                    MockColumn('c', [[30, 40]], 2)]))
+            table.addData([MockColumn('a', [12]), MockColumn('b', [-1]),
+                           MockColumn('c', [[10, 20]], 2)])
+        else:
+            table.addData([
+                MockColumn('a', [12, 13]), MockColumn('b', [-1, -2]),
+                MockColumn('c', [[10, 20], [30, 40]], 2)])
+
+        self.mox.ReplayAll()
+        assert store.store_many(meta, values, replace=True) == 2
+        self.mox.VerifyAll()
 
-        store.filter_raw('(a==1) & (b==2)').AndReturn([rs])
+    def test_store_many_replace_repeated(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        self.mox.StubOutWithMock(store, '_find_offsets')
+        meta = [(12, -1), (13, -2), (12, -1)]
+        values = [[10, 20], [30, 40], [50, 60]]
+
+        # Only the last row with each key is stored
+        store._find_offsets([(13, -2), (12, -1)]).AndReturn([-1, 4])
+        table.update(mox.Func(
+            lambda o: o.rowNumbers == [4] and o.columns == [
+                MockColumn('a', [12]), MockColumn('b', [-1]),
+                MockColumn('c', [[50, 60]], 2)]))
+        table.addData([MockColumn('a', [13]), MockColumn('b', [-2]),
+                       MockColumn('c', [[30, 40]], 2)])
 
         self.mox.ReplayAll()
-        assert store.fetch_by_metadata_raw(meta) == [rs]
+        assert store.store_many(meta, values, replace=True) == 2
         self.mox.VerifyAll()
 
-    def test_fetch_by_metadata_raw_complex_query(self):
+    def test_read_metadata_columns(self):
         table = self.mox.CreateMock(MockTable)
         store = MockFeatureTable(None)
         store.table = table
-        store.cols = [
-            MockColumn(name='a'), omero.grid.StringColumn(name='b', size=8),
-            MockColumn(name='c', size=1)]
+        store.cols = [MockColumn('a'),
+                      omero.grid.DoubleArrayColumn('f', '', 1000),
+                      MockColumn('b')]
+        store.metacols = (0, 2)
+        self.mox.StubOutWithMock(store, 'get_max_message_size')
 
-        self.mox.StubOutWithMock(store, 'filter_raw')
-        rs = (1, 'string', [0])
+        data1 = MockTableData()
+        data1.columns = [MockColumn(values=[1, 2]), MockColumn(values=[3, 4])]
+        data2 = MockTableData()
+        data2.columns = [MockColumn(values=[5]), MockColumn(values=[6])]
 
-        meta = {'a': None, 'a': [1, 2, 4], 'b': 'str"ing'}
-        expected = '((a==1) | (a==2) | (a==4)) & (b=="str\\"ing")'
-        store.filter_raw(expected).AndReturn([rs])
+        table.getNumberOfRows().AndReturn(3)
+        # Chunks are sized from the metadata columns only, a full row with
+        # the feature array column would not fit
+        store.get_max_message_size().AndReturn(35)
+        table.read([0, 2], 0, 2).AndReturn(data1)
+        table.read([0, 2], 2, 3).AndReturn(data2)
 
         self.mox.ReplayAll()
-        assert store.fetch_by_metadata_raw(meta) == [rs]
+        assert store._read_metadata_columns() == [[1, 2, 5], [3, 4, 6]]
         self.mox.VerifyAll()
 
-    def test_filter(self):
+    def test_build_metadata_index(self):
+        table = self.mox.CreateMock(MockTable)
         store = MockFeatureTable(None)
-        self.mox.StubOutWithMock(store, 'filter_raw')
-        self.mox.StubOutWithMock(store, 'feature_row')
-        values1 = (0, 1, [5])
-        r1 = object()
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'), MockColumn('c')]
+        store.metacols = (0, 1)
+        self.mox.StubOutWithMock(store, '_read_metadata_columns')
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
 
-        store.filter_raw('RoiID==1').AndReturn([values1])
-        store.feature_row(values1).AndReturn(r1)
+        table.getNumberOfRows().AndReturn(3)
+        store._read_metadata_columns(0, 3).AndReturn(
+            [[1, 2, 1], ['x', 'y', 'x']])
+        store.chunked_table_read([0, 2]).AndReturn(
+            [[1, 1], ['x', 'x'], [10, 30]])
+        # New rows appended by another client
+        table.getNumberOfRows().AndReturn(4)
+        store._read_metadata_columns(3, 4).AndReturn([[1], ['y']])
+        store.chunked_table_read([0, 2, 3]).AndReturn(
+            [[1, 1, 1], ['x', 'x', 'y'], [10, 30, 40]])
 
         self.mox.ReplayAll()
-        assert store.filter('RoiID==1') == [r1]
+        index = store.build_metadata_index(refresh=False)
+        assert len(index) == 3
+        assert store.fetch_by_metadata_raw({'a': 1}) == [
+            (1, 'x', 10), (1, 'x', 30)]
+        store.metaindex_refresh = True
+        assert store.fetch_by_metadata_raw([1, None]) == [
+            (1, 'x', 10), (1, 'x', 30), (1, 'y', 40)]
         self.mox.VerifyAll()
 
-    @pytest.mark.parametrize('ncols', [1, 2])
-    @pytest.mark.parametrize('nrows', [0, 1, 2])
-    def test_filter_raw(self, ncols, nrows):
-        table = self.mox.CreateMock(MockTable)
-        store = MockFeatureTable(None)
-        store.table = table
-        store.cols = [MockColumn() for n in xrange(ncols)]
+    @pytest.mark.parametrize('threads', [1, 2])
+    def test_store_metadata_index(self, threads):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a', 'b'])
+        store.metaindex.add([[12], [-1]])
+        self.mox.StubOutWithMock(store, '_read_metadata_columns')
+        self.mox.StubOutWithMock(table, 'getHeaders')
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
 
-        offsets = [3, 7][:nrows]
+        cols = [MockColumn('a', [13, 12]), MockColumn('b', [-2, -2]),
+                MockColumn('c', [[10, 20], [30, 40]], 2)]
+        if threads > 1:
+            table.addData([MockColumn('a', [13]), MockColumn('b', [-2]),
+                           MockColumn('c', [[10, 20]], 2)]).InAnyOrder()
+            table.addData([MockColumn('a', [12]), MockColumn('b', [-2]),
+                           MockColumn('c', [[30, 40]], 2)]).InAnyOrder()
+            table.getNumberOfRows().AndReturn(3)
+            store._read_metadata_columns(1, 3).AndReturn(
+                [[12, 13], [-2, -2]])
+        else:
+            table.addData(cols)
+            table.getNumberOfRows().AndReturn(3)
 
-        self.mox.StubOutWithMock(table, 'getWhereList')
-        self.mox.StubOutWithMock(table, 'getNumberOfRows')
-        self.mox.StubOutWithMock(store, 'get_chunk_size')
-        self.mox.StubOutWithMock(store, 'chunked_table_read')
+        self.mox.ReplayAll()
+        store.store_pending([13, -2], [10, 20])
+        store.store_pending([12, -2], [30, 40])
+        if threads > 1:
+            store.max_message_size = 32
+        store.store_flush(threads=threads)
+        self.mox.VerifyAll()
 
-        table.getNumberOfRows().AndReturn(123)
-        table.getWhereList('(ImageID==99)', {}, 0, 123, 0).AndReturn(offsets)
+        assert len(store.metaindex) == 3
+        assert store.metaindex.lookup([('a', 12), ('b', None)]) == (
+            [0, 1] if threads > 1 else [0, 2])
 
-        data = None
-        if nrows > 0:
-            data = []
-            for c in xrange(ncols):
-                cvals = [[r * 10 + c] for r in xrange(1, nrows + 1)]
-                data.append(cvals)
+    def test_store_metadata_index_external_rows(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a', 'b'])
+        store.metaindex.add([[12], [-1]])
+        self.mox.StubOutWithMock(store, '_read_metadata_columns')
 
-        store.get_chunk_size().AndReturn(2)
-        store.chunked_table_read(offsets, 2).AndReturn(data)
+        table.addData(expectedcols)
+        table.getNumberOfRows().AndReturn(2)
+        # Another client appends a row before the next write
+        table.addData([MockColumn('a', [13]), MockColumn('b', [-2]),
+                       MockColumn('c', [[30, 40]], 2)])
+        table.getNumberOfRows().AndReturn(4)
+        table.getNumberOfRows().AndReturn(4)
+        store._read_metadata_columns(2, 4).AndReturn([[14, 13], [-3, -2]])
 
         self.mox.ReplayAll()
+        store.store(meta, values, replace=False)
+        store.store_many([(13, -2)], [[30, 40]])
+        self.mox.VerifyAll()
 
-        rvalues = store.filter_raw('(ImageID==99)')
+        assert len(store.metaindex) == 4
+        assert store.metaindex.lookup([('a', 12), ('b', None)]) == [0, 1]
+        assert store.metaindex.lookup([('a', 13), ('b', -2)]) == [3]
 
-        assert len(rvalues) == len(offsets)
-        if ncols == 1 and nrows == 1:
-            assert rvalues == [([10],)]
-        elif ncols == 1 and nrows == 2:
-            assert rvalues == [([10],), ([20],)]
-        elif ncols == 2 and nrows == 1:
-            assert rvalues == [([10], [11])]
-        elif ncols == 2 and nrows == 2:
-            assert rvalues == [([10], [11]), ([20], [21])]
-        else:
-            assert rvalues == []
-        self.mox.VerifyAll()
+    def test_balanced_join(self):
+        join = OmeroTablesFeatureStore._balanced_join
+        assert join(['a'], '|') == 'a'
+        assert join(['a', 'b'], '|') == '(a | b)'
+        assert join(['a', 'b', 'c', 'd', 'e'], '&') == (
+            '((a & b) & (c & (d & e)))')
 
-    def test_feature_row(self):
+    def test_get_batched_conditions(self):
         store = MockFeatureTable(None)
-        store.cols = (
-            MockColumn('ma'), MockColumn('mb'), MockColumn())
+        store.cols = [MockColumn('a'), omero.grid.StringColumn('b', '', 8)]
         store.metacols = (0, 1)
-        store.multiftcols = (2,)
-        self.mox.StubOutWithMock(store, 'metadata_names')
-        self.mox.StubOutWithMock(store, 'feature_names')
-        store.metadata_names().AndReturn(('ma', 'mb'))
-        store.feature_names().AndReturn(('a', 'b'))
-        row = [10, 20, (1, 2)]
+
+        assert store._get_batched_conditions(
+            [{'a': 1}, {'a': [2, 3]}, [1, None], {'a': 4}], 2) == [
+            '(a==1)', '((a==2) | (a==3))', '(a==4)']
+        assert store._get_batched_conditions(
+            [[1, 'x'], [[1, 2, 1], 'y'], [1, 'z']], 5) == [
+            '(((a==1) & (b=="x")) | (((a==1) | (a==2)) & (b=="y")))',
+            '((a==1) & (b=="z"))']
+        assert store._get_batched_conditions(
+            [{'a': [1, 2, 3], 'b': ['x', 'y']}], 4) == [
+            '(((a==1) | (a==2)) & ((b=="x") | (b=="y")))',
+            '((a==3) & ((b=="x") | (b=="y")))']
+        # The terms of a single key are limited, not just each column
+        assert store._get_batched_conditions(
+            [{'a': [1, 2, 3], 'b': ['x', 'y']}], 3) == [
+            '(((a==1) | (a==2)) & (b=="x"))',
+            '(((a==1) | (a==2)) & (b=="y"))',
+            '((a==3) & (b=="x"))',
+            '((a==3) & (b=="y"))']
+        assert store._get_batched_conditions([{'a': 1}, {'b': None}], 2) == [
+            '']
+        assert store._get_batched_conditions([], 2) == []
+
+    @pytest.mark.parametrize('threads', [1, 2])
+    def test_fetch_many(self, threads):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b')]
+        store.metacols = (0,)
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
+
+        table.getNumberOfRows().AndReturn(10)
+        table.getWhereList('((a==1) | (a==2))', {}, 0, 10, 0).InAnyOrder(
+            ).AndReturn([7, 2])
+        table.getWhereList('((a==3) | (a==4))', {}, 0, 10, 0).InAnyOrder(
+            ).AndReturn([5, 7])
+        store.chunked_table_read([2, 5, 7]).AndReturn(
+            [[2, 3, 1], [20, 50, 70]])
 
         self.mox.ReplayAll()
-        rv = store.feature_row(row)
-        assert rv.names == ('a', 'b')
-        assert rv.values == (1, 2)
-        assert rv.infonames == ('ma', 'mb')
-        assert rv.infovalues == (10, 20)
+        assert store.fetch_many(
+            [{'a': n} for n in (1, 2, 3, 4)], threads=threads,
+            max_terms=2) == [(2, 20), (3, 50), (1, 70)]
         self.mox.VerifyAll()
 
-    def test_get_chunk_size(self):
+    @pytest.mark.parametrize('max_terms', [256, 64])
+    def test_fetch_many_lists(self, max_terms):
         table = self.mox.CreateMock(MockTable)
         store = MockFeatureTable(None)
         store.table = table
-        store.cols = [MockColumn(size=2) for n in xrange(100)]
+        store.cols = [MockColumn('a'), MockColumn('b'), MockColumn('c')]
+        store.metacols = (0, 1)
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
+
+        # One OR group per column: 200 terms in one query, or each column
+        # split into parts of at most 32 terms giving 16 conditions of at
+        # most 64 terms, the last two of which share a query, not 100 * 100
+        # terms
+        table.getNumberOfRows().AndReturn(10)
+        for n in xrange(1 if max_terms == 256 else 15):
+            table.getWhereList(
+                mox.IgnoreArg(), {}, 0, 10, 0).AndReturn([3])
+        store.chunked_table_read([3]).AndReturn([[1], [2], [30]])
 
         self.mox.ReplayAll()
-        assert store.get_chunk_size() == 10485
+        assert store.fetch_many(
+            [{'a': range(100), 'b': range(100)}], threads=1,
+            max_terms=max_terms) == [(1, 2, 30)]
         self.mox.VerifyAll()
 
-    def test_chunked_table_read(self):
+    def test_fetch_many_index(self):
         table = self.mox.CreateMock(MockTable)
         store = MockFeatureTable(None)
         store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b')]
+        store.metacols = (0,)
+        store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a'])
+        store.metaindex.add([[1, 2, 3, 1]])
+        store.metaindex_refresh = False
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
 
-        self.mox.StubOutWithMock(table, 'readCoordinates')
+        store.chunked_table_read([0, 2, 3]).AndReturn(
+            [[1, 3, 1], [10, 30, 40]])
 
-        offsets = [2, 7, 5]
+        self.mox.ReplayAll()
+        assert store.fetch_many([[3], {'a': [1, 5]}]) == [
+            (1, 10), (3, 30), (1, 40)]
+        self.mox.VerifyAll()
 
-        data1 = MockTableData()
-        data1.columns = [MockColumn()]
-        data1.columns[0].values = [[1], [2]]
+    def test_find_offsets(self):
+        store = MockFeatureTable(None)
+        self.mox.StubOutWithMock(store, '_read_metadata_columns')
+        store._read_metadata_columns(digest=False).AndReturn(
+            [[1, 2, 1, 3], ['a', 'b', 'a', 'c']])
+        store._read_metadata_columns(digest=True).AndReturn(
+            [[1, 2, 1, 3], ['a', 'b', 'a', 'c'], ['d0', 'd1', 'd2', 'd3']])
 
-        data2 = MockTableData()
-        data2.columns = [MockColumn()]
-        data2.columns[0].values = [[3]]
+        self.mox.ReplayAll()
+        assert store._find_offsets(
+            [(1, 'a'), (3, 'c'), (2, 'a')]) == [2, 3, -1]
+        assert store._find_offsets(
+            [(1, 'a'), (3, 'c'), (2, 'a')], digests=True) == (
+            [2, 3, -1], ['d2', 'd3', None])
+        self.mox.VerifyAll()
 
-        table.readCoordinates([2, 7]).AndReturn(data1)
-        table.readCoordinates([5]).AndReturn(data2)
+    def test_find_offsets_indexed(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'),
+                      omero.grid.StringColumn('_digest', '', 40)]
+        store.metacols = (0, 1)
+        store.digestcol = 2
+        store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a', 'b'])
+        store.metaindex.add([[1, 2, 1, 3], ['a', 'b', 'a', 'c']])
+        self.mox.StubOutWithMock(table, 'slice')
+
+        table.getNumberOfRows().AndReturn(4)
+        table.getNumberOfRows().AndReturn(4)
+        data = MockTableData()
+        data.columns = [MockColumn(values=['d2', 'd3'])]
+        table.slice([2], [2, 3]).AndReturn(data)
 
         self.mox.ReplayAll()
+        assert store._find_offsets(
+            [(1, 'a'), (3, 'c'), (2, 'a')]) == [2, 3, -1]
+        assert store._find_offsets(
+            [(1, 'a'), (3, 'c'), (2, 'a')], digests=True) == (
+            [2, 3, -1], ['d2', 'd3', None])
+        self.mox.VerifyAll()
 
-        d = store.chunked_table_read(offsets, 2)
-        assert d == [[[1], [2], [3]]]
+    def test_digest(self):
+        d = OmeroTablesFeatureStore._digest([1, 2.5])
+        assert len(d) == 40
+        assert d == OmeroTablesFeatureStore._digest((1.0, 2.5))
+        assert d != OmeroTablesFeatureStore._digest([1, 2])
+        assert OmeroTablesFeatureStore._digest_rows(
+            numpy.array([[1, 2], [1, 2.5]])) == [
+            OmeroTablesFeatureStore._digest([1, 2]), d]
+
+    @pytest.mark.parametrize('changed', [True, False])
+    def test_store_many_replace_digest(self, changed):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.cols.append(MockColumn('_digest'))
+        store.digestcol = 3
+        self.mox.StubOutWithMock(store, '_find_offsets')
+        meta = [(12, -1), (13, -2)]
+        values = [[10, 20], [30, 40]]
+        digests = OmeroTablesFeatureStore._digest_rows(values)
+
+        olddigests = list(digests)
+        if changed:
+            olddigests[0] = 'x'
+        store._find_offsets(mox.Func(lambda ks: list(ks) == meta),
+                            digests=True).AndReturn(([5, 3], olddigests))
+        if changed:
+            table.update(mox.Func(
+                lambda o: o.rowNumbers == [5] and o.columns == [
+                    MockColumn('a', [12]), MockColumn('b', [-1]),
+                    MockColumn('c', [[10, 20]], 2),
+                    MockColumn('_digest', digests[:1])]))
+
+        self.mox.ReplayAll()
+        assert store.store_many(meta, values, replace=True) == (
+            1 if changed else 0)
         self.mox.VerifyAll()
 
-    def test_get_objects(self):
-        session = MockSession(None, None, None)
-        store = MockFeatureTable(session)
-        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+    def test_get_row_size(self):
+        store = MockFeatureTable(None)
+        store.cols = [
+            omero.grid.LongColumn('a'), omero.grid.StringColumn('b', '', 10),
+            omero.grid.BoolColumn('c'), omero.grid.DoubleArrayColumn(
+                'd', '', 3), omero.grid.FloatArrayColumn('e', '', 3)]
+        assert store._get_row_size() == 8 + 15 + 1 + 29 + 17
 
-        kvs = {'x': 'aaa', 'y.z': ['bbb', 'ccc']}
-        # Need to figure out which order the keys will be read
-        if kvs.keys() == ['x', 'y.z']:
-            q = "FROM ObjectType WHERE x = :x AND y.z in (:y_z)"
+    @pytest.mark.parametrize('limit', ['rows', 'bytes', 'age'])
+    def test_store_pending_auto_flush(self, limit):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        self.mox.StubOutWithMock(table, 'getHeaders')
+        self.mox.StubOutWithMock(store, '_get_row_size')
+        if limit == 'rows':
+            store.set_pending_limits(max_rows=2)
+        elif limit == 'bytes':
+            store.set_pending_limits(max_bytes=200)
         else:
-            q = "FROM ObjectType WHERE y.z in (:y_z) AND x = :x"
+            store.set_pending_limits(max_age=10)
 
-        params = omero.sys.ParametersI()
-        params.add('x', wrap('aaa'))
-        params.add('y_z', wrap(['bbb', 'ccc']))
-        m = object()
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
+        store._get_row_size().MultipleTimes().AndReturn(100)
+        expectedcols = [MockColumn('a', [12, 12]), MockColumn('b', [-1, -1]),
+                        MockColumn('c', [[10, 20], [10, 20]], 2)]
+        table.addData(expectedcols)
 
-        session.qs.findAllByQuery(q, mox.Func(
-            lambda o: self.parameters_equal(params, o))).AndReturn([m])
+        self.mox.ReplayAll()
+        store.store_pending(meta, values)
+        assert store.pendingcols is not None
+        if limit == 'age':
+            store.pendingtime -= 10
+        store.store_pending(meta, values)
+        assert store.pendingcols is None
+        assert store.pendingbytes == 0
+        assert store.pendingtime is None
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('spill', [True, False])
+    def test_store_pending_spill(self, spill, tmpdir):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.cols = [omero.grid.LongColumn('a'), omero.grid.StringColumn(
+            'b', '', 4), omero.grid.DoubleArrayColumn('c', '', 2)]
+        for col in store.cols:
+            col.values = None
+        self.mox.StubOutWithMock(table, 'getHeaders')
+        store.set_pending_limits(
+            max_rows=2, spill=spill, spill_dir=str(tmpdir))
+
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
+        table.addData(mox.IgnoreArg()).AndRaise(omero.ServerError())
 
         self.mox.ReplayAll()
+        store.store_pending([1, 'x'], [1, 2])
+        if not spill:
+            with pytest.raises(omero.ServerError):
+                store.store_pending([2, 'y'], [3, 4])
+            self.mox.VerifyAll()
+            return
 
-        assert store.get_objects('ObjectType', kvs) == [m]
+        store.store_pending([2, 'y'], [3, 4])
+        assert store.pendingcols is None
+        assert len(store.pendingspill) == 2
+        assert len(tmpdir.listdir()) == 1
         self.mox.VerifyAll()
 
-    @pytest.mark.parametrize('exists', [True, False])
-    def test_create_file_annotation(self, exists):
-        session = MockSession(None, None, None)
-        store = MockFeatureTable(session)
+        self.mox.ResetAll()
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
+        table.addData(mox.Func(lambda cols: [c.values for c in cols] == [
+            [1, 2], ['x', 'y'], [[1, 2], [3, 4]]]))
+        table.addData(mox.Func(lambda cols: [c.values for c in cols] == [
+            [3], ['z'], [[5, 6]]]))
+
+        self.mox.ReplayAll()
+        store.store_pending([3, 'z'], [5, 6])
+        assert store.store_flush() == 3
+        assert store.pendingspill is None
+        assert len(tmpdir.listdir()) == 0
+        self.mox.VerifyAll()
+
+    def test_store_pending_spill_timeout(self, tmpdir, monkeypatch):
+        clock = itertools.count()
+        monkeypatch.setattr(
+            OmeroTablesFeatureStore.time, 'time', lambda: next(clock))
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        store.cols = [omero.grid.LongColumn('a'), omero.grid.StringColumn(
+            'b', '', 4), omero.grid.DoubleArrayColumn('c', '', 2)]
+        for col in store.cols:
+            col.values = None
+        store.max_message_size = 70
+        self.mox.StubOutWithMock(table, 'getHeaders')
+        store.set_pending_limits(max_rows=3, spill=True,
+                                 spill_dir=str(tmpdir), spill_timeout=2)
+
+        # Each call to time() advances the clock by one second, the flush
+        # stops after the first chunk and the remaining row is spilled
+        # without the server raising an error
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
+        table.addData(mox.Func(lambda cols: [c.values for c in cols] == [
+            [1, 2], ['x', 'y'], [[1, 2], [3, 4]]]))
+
+        self.mox.ReplayAll()
+        store.store_pending([1, 'x'], [1, 2])
+        store.store_pending([2, 'y'], [3, 4])
+        store.store_pending([3, 'z'], [5, 6])
+        assert store.pendingcols is None
+        assert len(store.pendingspill) == 1
+        assert len(tmpdir.listdir()) == 1
+        self.mox.VerifyAll()
+        store.pendingspill.close()
+
+    def test_store_stream(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        rows = ([(n, -n), (n, 2 * n)] for n in xrange(5))
+
+        table.addData([MockColumn('a', [0, 1]), MockColumn('b', [0, -1]),
+                       MockColumn('c', [[0, 0], [1, 2]], 2)])
+        table.addData([MockColumn('a', [2, 3]), MockColumn('b', [-2, -3]),
+                       MockColumn('c', [[2, 4], [3, 6]], 2)])
+        table.addData([MockColumn('a', [4]), MockColumn('b', [-4]),
+                       MockColumn('c', [[4, 8]], 2)])
+
+        self.mox.ReplayAll()
+        stats = store.store_stream(rows, batch_size=2, queue_size=1)
+        assert stats['convert'].count == 5
+        assert stats['write'].count == 5
+        assert stats['total'].count == 5
+        self.mox.VerifyAll()
+
+    def test_store_stream_error(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+
+        def rows():
+            yield meta, values
+            raise ValueError('test')
+
+        self.mox.ReplayAll()
+        with pytest.raises(ValueError):
+            store.store_stream(rows(), batch_size=2)
+        self.mox.VerifyAll()
+
+    def test_get_row_sizes(self):
+        store = MockFeatureTable(None)
+        cols = [omero.grid.LongColumn('a', '', [1, 2]),
+                omero.grid.DoubleArrayColumn('c', '', 2, [[1, 2], [3, 4]])]
+        assert store._get_row_sizes(cols) == 8 + 21
+        cols.append(omero.grid.StringColumn('b', '', 10, ['x', 'yyy']))
+        assert store._get_row_sizes(cols) == [8 + 21 + 6, 8 + 21 + 8]
+
+    def test_get_write_ranges(self):
+        store = MockFeatureTable(None)
+        cols = [omero.grid.LongColumn('a', '', range(5))]
+        assert store._get_write_ranges(cols, 16) == [(0, 2), (2, 4), (4, 5)]
+        assert store._get_write_ranges(cols, 1) == [
+            (0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+
+        cols.append(omero.grid.StringColumn(
+            'b', '', 10, ['x', 'yyyy', '', 'zzzzzz', 'z']))
+        # Row sizes 14, 17, 13, 19, 14
+        assert store._get_write_ranges(cols, 31) == [
+            (0, 2), (2, 3), (3, 4), (4, 5)]
+        assert store._get_write_ranges(cols, 32) == [
+            (0, 2), (2, 4), (4, 5)]
+        assert store._get_write_ranges(cols, 10) == [
+            (0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+
+    @pytest.mark.parametrize('threads', [1, 2])
+    def test_write_ranges(self, threads):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        cols = [MockColumn('a', [1, 2, 3])]
+        e = omero.ServerError()
+
+        table.addData([MockColumn('a', [1])]).InAnyOrder()
+        table.addData([MockColumn('a', [2])]).InAnyOrder().AndRaise(e)
+        if threads > 1:
+            table.addData([MockColumn('a', [3])]).InAnyOrder()
+
+        self.mox.ReplayAll()
+        failed, error = store._write_ranges(
+            cols, [(0, 1), (1, 2), (2, 3)], threads)
+        if threads > 1:
+            assert failed == [(1, 2)]
+        else:
+            assert failed == [(1, 2), (2, 3)]
+        assert error is e
+        self.mox.VerifyAll()
+
+    def test_write_ranges_update(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.knnindex = OmeroTablesFeatureStore.RandomProjectionIndex(1)
+        cols = [MockColumn('a', [1, 2, 3])]
+
+        table.update(mox.Func(lambda o: o.rowNumbers == [7, 5] and
+                              o.columns == [MockColumn('a', [1, 2])]))
+        table.update(mox.Func(lambda o: o.rowNumbers == [9] and
+                              o.columns == [MockColumn('a', [3])]))
+
+        self.mox.ReplayAll()
+        assert store._write_ranges(
+            cols, [(0, 2), (2, 3)], rownumbers=[7, 5, 9]) == ([], None)
+        # Replaced rows are rehashed in the nearest neighbour index
+        assert store.knnindex_replaced == set([5, 7, 9])
+        self.mox.VerifyAll()
+
+    def test_store_flush_chunked(self):
+        store, table, meta, values, expectedcols = self.setup_test_store()
+        self.mox.StubOutWithMock(table, 'getHeaders')
+        store.max_message_size = 64
+        e = omero.ServerError()
+
+        table.getHeaders().AndReturn(copy.deepcopy(store.cols))
+        table.addData([MockColumn('a', [1, 2]), MockColumn('b', [-1, -2]),
+                       MockColumn('c', [[1, 1], [2, 2]], 2)])
+        table.addData([MockColumn('a', [3]), MockColumn('b', [-3]),
+                       MockColumn('c', [[3, 3]], 2)]).AndRaise(e)
+        table.addData([MockColumn('a', [3]), MockColumn('b', [-3]),
+                       MockColumn('c', [[3, 3]], 2)])
+
+        self.mox.ReplayAll()
+        for n in xrange(1, 4):
+            store.store_pending([n, -n], [n, n])
+        with pytest.raises(omero.ServerError):
+            store.store_flush()
+        assert [col.values for col in store.pendingcols] == [
+            [3], [-3], [[3, 3]]]
+        assert store.store_flush() == 1
+        assert store.pendingcols is None
+        self.mox.VerifyAll()
+
+    def test_fetch_by_metadata(self):
+        store = MockFeatureTable(None)
+        store.cols = [MockColumn(name='a')]
+        self.mox.StubOutWithMock(store, 'filter_raw')
+        self.mox.StubOutWithMock(store, 'feature_row')
+
+        meta = {'a': 1}
+        rs = (1, 2, [0])
+        r1 = object()
+
+        store.fetch_by_metadata_raw(meta).AndReturn([rs])
+        store.feature_row(rs).AndReturn(r1)
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_metadata(meta) == [r1]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('meta', [[1, 2], {'a': 1, 'b': 2}])
+    def test_fetch_by_metadata_raw(self, meta):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [
+            MockColumn(name='a'), MockColumn(name='b'),
+            MockColumn(name='c', size=1)]
+        store.metacols = (0, 1)
+        store.ftcols = (2,)
+
+        self.mox.StubOutWithMock(store, 'filter_raw')
+        rs = (1, 2, [0])
+
+        store.filter_raw('(a==1) & (b==2)', True).AndReturn([rs])
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_metadata_raw(meta) == [rs]
+        self.mox.VerifyAll()
+
+    def test_fetch_by_metadata_raw_complex_query(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [
+            MockColumn(name='a'), omero.grid.StringColumn(name='b', size=8),
+            MockColumn(name='c', size=1)]
+
+        self.mox.StubOutWithMock(store, 'filter_raw')
+        rs = (1, 'string', [0])
+
+        meta = {'a': None, 'a': [1, 2, 4], 'b': 'str"ing'}
+        expected = '((a==1) | (a==2) | (a==4)) & (b=="str\\"ing")'
+        store.filter_raw(expected, True).AndReturn([rs])
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_metadata_raw(meta) == [rs]
+        self.mox.VerifyAll()
+
+    def test_filter(self):
+        store = MockFeatureTable(None)
+        self.mox.StubOutWithMock(store, 'filter_raw')
+        self.mox.StubOutWithMock(store, 'feature_row')
+        values1 = (0, 1, [5])
+        r1 = object()
+
+        store.filter_raw('RoiID==1').AndReturn([values1])
+        store.feature_row(values1).AndReturn(r1)
+
+        self.mox.ReplayAll()
+        assert store.filter('RoiID==1') == [r1]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('raw', [True, 'numpy'])
+    def test_filter_features(self, raw):
+        store = MockFeatureTable(None)
+        store.cols = [
+            omero.grid.LongColumn('a', ''),
+            omero.grid.DoubleArrayColumn('x,y', '', 2),
+        ]
+        store.metacols = (0,)
+        store.multiftcols = (1,)
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        store.filter_iter('(a<10)', 'columns').AndReturn(iter([
+            [[1, 2], [[1, 5], [6, 1]]],
+            [[3, 4], [[7, 7], [0, 0]]],
+        ]))
+
+        self.mox.ReplayAll()
+        p = query.Feature('x') > query.Feature('y')
+        result = store.filter_features(
+            p | (query.Feature('x') > 6), '(a<10)', raw)
+        if raw == 'numpy':
+            assert result[0]['a'].tolist() == [2, 3]
+            assert result[1].tolist() == [[6, 1], [7, 7]]
+        else:
+            assert result == [(2, [6, 1]), (3, [7, 7])]
+        self.mox.VerifyAll()
+
+    def test_distances(self):
+        features = numpy.array([[0, 0], [3, 4], [1, numpy.nan], [-1, 0]])
+        query = numpy.array([1., 0.])
+        d = OmeroTablesFeatureStore._distances
+        assert d(features, query, 'euclidean').tolist() == [
+            1, numpy.sqrt(20), numpy.inf, 2]
+        assert d(features, query, 'sqeuclidean').tolist() == [
+            1, 20, numpy.inf, 4]
+        assert d(features, query, 'cityblock').tolist() == [
+            1, 6, numpy.inf, 2]
+        assert numpy.allclose(d(features, query, 'cosine'), [
+            numpy.inf, 0.4, numpy.inf, 2])
+
+    def setup_knn_store(self):
+        store = MockFeatureTable(None)
+        store.cols = [
+            omero.grid.LongColumn('a', ''),
+            omero.grid.DoubleArrayColumn('x,y', '', 2),
+        ]
+        store.metacols = (0,)
+        store.multiftcols = (1,)
+        return store
+
+    @pytest.mark.parametrize('raw', [True, 'numpy'])
+    def test_knn(self, raw):
+        store = self.setup_knn_store()
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        store.filter_iter('(a<10)', 'columns').AndReturn(iter([
+            [[1, 2, 3], [[0, 0], [5, 5], [1, 1]]],
+            [[4, 5], [[2, 2], [numpy.nan, 0]]],
+        ]))
+
+        self.mox.ReplayAll()
+        result = store.knn([1.2, 1], 2, conditions='(a<10)', raw=raw)
+        assert numpy.allclose(result[0], [0.2, numpy.sqrt(1.64)])
+        if raw == 'numpy':
+            assert result[1]['a'].tolist() == [3, 4]
+            assert result[2].tolist() == [[1, 1], [2, 2]]
+        else:
+            assert result[1] == [(3, [1, 1]), (4, [2, 2])]
+        self.mox.VerifyAll()
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.knn([1, 2, 3])
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.knn([1, 2], metric='unknown')
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.knn([1, 2], approximate=True)
+
+    def test_knn_approximate(self, tmpdir):
+        table = self.mox.CreateMock(MockTable)
+        store = self.setup_knn_store()
+        store.table = table
+        self.mox.StubOutWithMock(store, '_iter_rows')
+        features = numpy.array([[0, 0], [5, 5], [1, 1], [2, 2]], dtype=float)
+        meta = numpy.array([(1,), (2,), (3,), (4,)], dtype=[('a', 'i8')])
+        path = str(tmpdir.join('knn'))
+
+        table.getOriginalFile().AndReturn(MockOriginalFile(7))
+        table.getNumberOfRows().AndReturn(3)
+        store._iter_rows([0, 1, 2], 'numpy').AndReturn(
+            iter([(meta[:3], features[:3])]))
+        table.getNumberOfRows().AndReturn(4)
+        store._iter_rows([3], 'numpy').AndReturn(
+            iter([(meta[3:], features[3:])]))
+        store._iter_rows(mox.IsA(list), 'columns').AndReturn(iter([
+            [[1, 3, 4], [[0, 0], [1, 1], [2, 2]]],
+        ]))
+        table.getOriginalFile().AndReturn(MockOriginalFile(7))
+        table.getNumberOfRows().AndReturn(4)
+
+        self.mox.ReplayAll()
+        index = store.build_knn_index(8, seed=1, path=path)
+        assert len(index) == 3
+        d, rows = store.knn([1.2, 1], 1, approximate=True, candidates=4)
+        assert len(index) == 4
+        assert numpy.allclose(d, [0.2])
+        assert rows == [(3, [1, 1])]
+        # Reload the saved index
+        assert len(store.build_knn_index(path=path)) == 4
+        self.mox.VerifyAll()
+
+    def test_knn_index_replaced(self, tmpdir):
+        table = self.mox.CreateMock(MockTable)
+        store = self.setup_knn_store()
+        store.table = table
+        self.mox.StubOutWithMock(store, '_iter_rows')
+        features = numpy.array([[0, 0], [5, 5], [1, 1]], dtype=float)
+        meta = numpy.array([(1,), (2,), (3,)], dtype=[('a', 'i8')])
+        path = str(tmpdir.join('knn'))
+
+        table.getOriginalFile().AndReturn(MockOriginalFile(7))
+        table.getNumberOfRows().AndReturn(3)
+        store._iter_rows([0, 1, 2], 'numpy').AndReturn(
+            iter([(meta, features)]))
+        # Replaced rows are rehashed, rows appended since are added
+        table.getNumberOfRows().AndReturn(3)
+        store._iter_rows([0, 2], 'numpy').AndReturn(
+            iter([(meta[[0, 2]], -features[[1, 1]])]))
+        table.getNumberOfRows().AndReturn(3)
+        # An index saved for a different table is rejected
+        table.getOriginalFile().AndReturn(MockOriginalFile(8))
+
+        self.mox.ReplayAll()
+        index = store.build_knn_index(8, seed=1, path=path)
+        store._index_replaced([2, 0])
+        store._update_knn_index()
+        assert numpy.array_equal(index.codes[[0, 2]], index._hash(
+            -features[[1, 1]]))
+        assert store.knnindex_replaced == set()
+        store._update_knn_index()
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.build_knn_index(path=path)
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('bins', [None, 2, [0, 3, 6]])
+    def test_describe(self, bins):
+        store = self.setup_knn_store()
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        meta = numpy.zeros(3, dtype=[('a', 'i8')])
+        features = numpy.array([[1, 2], [3, numpy.nan], [5, 6]])
+        npasses = 2 if bins == 2 else 1
+        for n in xrange(npasses):
+            store.filter_iter('(a<10)', 'numpy').AndReturn(iter([
+                (meta[:2], features[:2]), (meta[2:], features[2:])]))
+
+        self.mox.ReplayAll()
+        d = store.describe('(a<10)', bins)
+        self.mox.VerifyAll()
+
+        assert sorted(d.keys()) == ['x', 'y']
+        assert d['x']['count'] == 3
+        assert d['x']['nan'] == 0
+        assert d['x']['mean'] == 3
+        assert d['x']['std'] == 2
+        assert (d['x']['min'], d['x']['max']) == (1, 5)
+        assert d['y']['count'] == 2
+        assert d['y']['nan'] == 1
+        assert d['y']['mean'] == 4
+        if bins is None:
+            assert 'histogram' not in d['x']
+        elif bins == 2:
+            assert d['x']['edges'].tolist() == [1, 3, 5]
+            assert d['x']['histogram'].tolist() == [1, 2]
+            assert d['y']['edges'].tolist() == [2, 4, 6]
+            assert d['y']['histogram'].tolist() == [1, 1]
+        else:
+            assert d['x']['histogram'].tolist() == [1, 2]
+            assert d['y']['histogram'].tolist() == [1, 1]
+
+    def test_groupby(self):
+        store = self.setup_knn_store()
+        store.cols = [
+            omero.grid.LongColumn('a', ''),
+            omero.grid.LongColumn('b', ''),
+            omero.grid.DoubleArrayColumn('x,y', '', 2),
+        ]
+        store.metacols = (0, 1)
+        store.multiftcols = (2,)
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        meta = numpy.array([(1, 5), (2, 5), (1, 6)],
+                           dtype=[('a', 'i8'), ('b', 'i8')])
+        features = numpy.array([[1, 2], [3, 4], [5, 6]], dtype=float)
+        for n in xrange(2):
+            store.filter_iter('(a<10)', 'numpy').AndReturn(iter([
+                (meta[:2], features[:2]), (meta[2:], features[2:])]))
+
+        self.mox.ReplayAll()
+        r = store.groupby('a', '(a<10)').agg('size', 'mean')
+        assert sorted(r.keys()) == ['keys', 'mean', 'size']
+        assert r['keys'] == [(1,), (2,)]
+        assert r['size'].tolist() == [2, 1]
+        assert r['mean'].tolist() == [[3, 4], [3, 4]]
+        r = store.groupby(['b', 'a'], '(a<10)').agg()
+        assert r['keys'] == [(5, 1), (5, 2), (6, 1)]
+        assert r['max'].tolist() == [[1, 2], [3, 4], [5, 6]]
+        self.mox.VerifyAll()
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.groupby('x')
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.groupby('a').agg('median')
+
+    @pytest.mark.parametrize('largest', [True, False])
+    @pytest.mark.parametrize('raw', [True, 'numpy'])
+    def test_top_k(self, largest, raw):
+        store = self.setup_knn_store()
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        store.filter_iter('(a<10)', 'columns').AndReturn(iter([
+            [[1, 2, 3], [[0, 0], [5, 5], [numpy.nan, 1]]],
+            [[4, 5, 6], [[2, 2], [7, 0], [3, 3]]],
+        ]))
+
+        self.mox.ReplayAll()
+        result = store.top_k('x', 2, '(a<10)', largest, raw=raw)
+        self.mox.VerifyAll()
+        if largest:
+            expected = [7, 5], [5, 2], [[7, 0], [5, 5]]
+        else:
+            expected = [0, 2], [1, 4], [[0, 0], [2, 2]]
+        assert result[0].tolist() == expected[0]
+        if raw == 'numpy':
+            assert result[1]['a'].tolist() == expected[1]
+            assert result[2].tolist() == expected[2]
+        else:
+            assert result[1] == zip(expected[1], expected[2])
+
+    def test_top_k_predicate(self):
+        store = self.setup_knn_store()
+        self.mox.StubOutWithMock(store, 'filter_iter')
+
+        store.filter_iter(None, 'columns').AndReturn(iter([
+            [[1, 2, 3, 4], [[0, 0], [5, 5], [6, 1], [2, 2]]],
+        ]))
+
+        self.mox.ReplayAll()
+        values, rows = store.top_k(
+            'x', 3, predicate=query.Feature('y') > 1)
+        self.mox.VerifyAll()
+        assert values.tolist() == [5, 2]
+        assert rows == [(2, [5, 5]), (4, [2, 2])]
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.top_k('z', 1)
+
+    def test_count(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+
+        table.getNumberOfRows().AndReturn(10)
+        table.getNumberOfRows().AndReturn(10)
+        table.getWhereList('(a==1)', {}, 0, 10, 0).AndReturn([2, 5])
+
+        self.mox.ReplayAll()
+        assert store.count() == 10
+        assert store.count(query.Eq('a', 1)) == 2
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('index', [True, False])
+    def test_count_metadata(self, index):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b')]
+        store.metacols = (0,)
+        self.mox.StubOutWithMock(table, 'getWhereList')
+
+        if index:
+            store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a'])
+            store.metaindex.add([[1, 2, 2]])
+            store.metaindex_refresh = False
+        else:
+            table.getNumberOfRows().AndReturn(10)
+            table.getWhereList('(a==2)', {}, 0, 10, 0).AndReturn([1, 2])
+            table.getNumberOfRows().AndReturn(10)
+            table.getWhereList('(a==3)', {}, 0, 10, 0).AndReturn([])
+
+        self.mox.ReplayAll()
+        assert store.count({'a': 2}) == 2
+        assert store.count([3]) == 0
+        self.mox.VerifyAll()
+
+    def test_count_predicate(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [
+            omero.grid.LongColumn('a', ''),
+            omero.grid.DoubleArrayColumn('x,y', '', 2),
+            omero.grid.DoubleArrayColumn('z', '', 1),
+        ]
+        store.metacols = (0,)
+        store.multiftcols = (1, 2)
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(table, 'slice')
+        self.mox.StubOutWithMock(store, '_plan_reads')
+
+        data1 = MockTableData()
+        data1.columns = [MockColumn(values=[[1, 2], [3, 4]])]
+        data2 = MockTableData()
+        data2.columns = [MockColumn(values=[[5, 1], [2, 6], [7, 0]])]
+
+        table.getNumberOfRows().AndReturn(10)
+        table.getWhereList('(a<5)', {}, 0, 10, 0).AndReturn([1, 4, 5, 6, 9])
+        # Only the x,y column is read, 21 bytes per row
+        store._plan_reads([1, 4, 5, 6, 9], 798915).AndReturn(
+            [[1, 9], (4, 7)])
+        table.slice([1], [1, 9]).AndReturn(data1)
+        table.read([1], 4, 7).AndReturn(data2)
+
+        self.mox.ReplayAll()
+        p = query.Feature('y') > query.Feature('x')
+        assert store.count('(a<5)', p) == 3
+        self.mox.VerifyAll()
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.count(predicate=query.Feature('w') > 1)
+
+    @pytest.mark.parametrize('index', [True, False])
+    def test_exists(self, index):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b')]
+        store.metacols = (0,)
+        self.mox.StubOutWithMock(table, 'getWhereList')
+
+        if index:
+            store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a'])
+            store.metaindex.add([[1, 2]])
+            store.metaindex_refresh = False
+        else:
+            table.getNumberOfRows().AndReturn(10)
+            table.getWhereList('(a==2)', {}, 0, 10, 0).AndReturn([1])
+            table.getNumberOfRows().AndReturn(10)
+            table.getWhereList('(a==3)', {}, 0, 10, 0).AndReturn([])
+
+        self.mox.ReplayAll()
+        assert store.exists({'a': 2})
+        assert not store.exists([3])
+        self.mox.VerifyAll()
+
+    def test_sample(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        samples = []
+        store._read_rows = lambda offsets, raw: samples.append(offsets)
+
+        table.getNumberOfRows().AndReturn(100)
+        table.getNumberOfRows().AndReturn(100)
+        table.getWhereList('(a<5)', {}, 0, 100, 0).AndReturn(range(0, 40, 2))
+        table.getNumberOfRows().AndReturn(100)
+
+        self.mox.ReplayAll()
+        store.sample(n=10, seed=1)
+        store.sample(fraction=0.25, conditions='(a<5)', raw='numpy')
+        store.sample(n=200)
+        self.mox.VerifyAll()
+
+        for sample in samples:
+            assert sample == sorted(set(sample))
+        assert len(samples[0]) == 10
+        assert len(samples[1]) == 5
+        assert set(samples[1]).issubset(range(0, 40, 2))
+        assert samples[2] == range(100)
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.sample()
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.sample(fraction=0.5, n=1)
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.sample(fraction=2)
+
+    @pytest.mark.parametrize('index', [True, False])
+    def test_sample_stratified(self, index):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn('a'), MockColumn('b'), MockColumn('c')]
+        store.metacols = (0, 1)
+        self.mox.StubOutWithMock(store, '_read_metadata_columns')
+        metavals = [[1, 2, 1, 1, 2, 3, 1, 1], [5, 5, 6, 6, 6, 6, 5, 6]]
+        samples = []
+        store._read_rows = lambda offsets, raw: samples.append(offsets)
+
+        if index:
+            store.metaindex = OmeroTablesFeatureStore.MetadataIndex(
+                ['a', 'b'])
+            store.metaindex.add(metavals)
+            store.metaindex_refresh = False
+        else:
+            store._read_metadata_columns().AndReturn(metavals)
+            store._read_metadata_columns().AndReturn(metavals)
+
+        self.mox.ReplayAll()
+        store.sample(fraction=0.4, stratify_by='a', seed=2)
+        store.sample(n=1, stratify_by=['b', 'a'], seed=2)
+        self.mox.VerifyAll()
+
+        groups = dict((k, [n for n in xrange(8) if metavals[0][n] == k])
+                      for k in (1, 2, 3))
+        assert samples[0] == sorted(samples[0])
+        assert [len(set(samples[0]).intersection(groups[k]))
+                for k in (1, 2, 3)] == [2, 1, 0]
+        keys = [(metavals[1][n], metavals[0][n]) for n in samples[1]]
+        assert sorted(keys) == [(5, 1), (5, 2), (6, 1), (6, 2), (6, 3)]
+
+        with pytest.raises(OmeroTablesFeatureStore.TableUsageException):
+            store.sample(n=1, stratify_by='c')
+
+    def test_sample_stratified_small(self):
+        store = MockFeatureTable(None)
+        store.cols = [MockColumn('a'), MockColumn('b'), MockColumn('c')]
+        store.metacols = (0, 1)
+        store.metaindex = OmeroTablesFeatureStore.MetadataIndex(['a', 'b'])
+        store.metaindex.add([[k for k in xrange(50) for r in xrange(3)],
+                             [0] * 150])
+        store.metaindex_refresh = False
+        samples = []
+        store._read_rows = lambda offsets, raw: samples.append(offsets)
+
+        # Each group has 0.3 expected rows, the 15 sampled rows must be
+        # spread across the groups instead of rounding each group to 0
+        store.sample(fraction=0.1, stratify_by='a', seed=3)
+        assert len(samples[0]) == 15
+        assert len(set(o // 3 for o in samples[0])) == 15
+
+    def test_allocate_sample(self):
+        rng = random.Random(1)
+        allocate = OmeroTablesFeatureStore._allocate_sample
+        assert allocate([5, 2, 1], 0.4, rng) == [2, 1, 0]
+        assert allocate([10, 10], 1, rng) == [10, 10]
+        assert allocate([10, 10], 0, rng) == [0, 0]
+        counts = allocate([1] * 10, 0.2, rng)
+        assert sorted(counts) == [0] * 8 + [1] * 2
+
+    def test_get_offsets_query(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+
+        table.getNumberOfRows().AndReturn(10)
+        table.getWhereList(
+            '(((1<=a) & (a<4)) & ~(b=="x"))', {}, 0, 10, 0).AndReturn([2])
+
+        self.mox.ReplayAll()
+        q = query.In('a', [1, 2, 3], ranges=True) & ~query.Eq('b', 'x')
+        assert store._get_offsets(q) == [2]
+        self.mox.VerifyAll()
+
+    def test_get_offsets_all(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+
+        table.getNumberOfRows().AndReturn(3)
+
+        self.mox.ReplayAll()
+        offsets = store._get_offsets('')
+        assert isinstance(offsets, xrange)
+        assert list(offsets) == [0, 1, 2]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('ncols', [1, 2])
+    @pytest.mark.parametrize('nrows', [0, 1, 2])
+    def test_filter_raw(self, ncols, nrows):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn() for n in xrange(ncols)]
+
+        offsets = [3, 7][:nrows]
+
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(table, 'getNumberOfRows')
+        self.mox.StubOutWithMock(store, 'chunked_table_read')
+
+        table.getNumberOfRows().AndReturn(123)
+        table.getWhereList('(ImageID==99)', {}, 0, 123, 0).AndReturn(offsets)
+
+        data = None
+        if nrows > 0:
+            data = []
+            for c in xrange(ncols):
+                cvals = [[r * 10 + c] for r in xrange(1, nrows + 1)]
+                data.append(cvals)
+
+        store.chunked_table_read(offsets).AndReturn(data)
+
+        self.mox.ReplayAll()
+
+        rvalues = store.filter_raw('(ImageID==99)')
+
+        assert len(rvalues) == len(offsets)
+        if ncols == 1 and nrows == 1:
+            assert rvalues == [([10],)]
+        elif ncols == 1 and nrows == 2:
+            assert rvalues == [([10],), ([20],)]
+        elif ncols == 2 and nrows == 1:
+            assert rvalues == [([10], [11])]
+        elif ncols == 2 and nrows == 2:
+            assert rvalues == [([10], [11]), ([20], [21])]
+        else:
+            assert rvalues == []
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('raw', [True, 'columns'])
+    def test_filter_iter(self, raw):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, '_iter_table_read')
+
+        table.getNumberOfRows().AndReturn(123)
+        table.getWhereList('(ImageID==99)', {}, 0, 123, 0).AndReturn(
+            [3, 7, 9])
+        store._iter_table_read([3, 7, 9]).AndReturn(iter([
+            [[1, 2], [[10], [20]]], [[3], [[30]]]]))
+
+        self.mox.ReplayAll()
+        chunks = store.filter_iter('(ImageID==99)', raw)
+        if raw == 'columns':
+            assert list(chunks) == [[[1, 2], [[10], [20]]], [[3], [[30]]]]
+        else:
+            assert [list(c) for c in chunks] == [
+                [(1, [10]), (2, [20])], [(3, [30])]]
+        self.mox.VerifyAll()
+
+    def test_filter_iter_all(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(store, '_iter_table_read')
+
+        table.getNumberOfRows().AndReturn(2)
+        store._iter_table_read(
+            mox.Func(lambda o: list(o) == [0, 1])).AndReturn(
+            iter([[[1, 2]]]))
+
+        self.mox.ReplayAll()
+        assert [list(c) for c in store.filter_iter('')] == [[(1,), (2,)]]
+        self.mox.VerifyAll()
+
+    def setup_numpy_store(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [
+            omero.grid.LongColumn('a'), omero.grid.StringColumn('b', '', 4),
+            omero.grid.DoubleArrayColumn('c', '', 2),
+            omero.grid.DoubleArrayColumn('d', '', 1)]
+        store.metacols = (0, 1)
+        store.multiftcols = (2, 3)
+        chunks = [
+            [[1, 2], ['x', 'yy'], [[1, 2], [3, 4]], [[5], [6]]],
+            [[3], ['z'], [[7, 8]], [[9]]]]
+        return store, table, chunks
+
+    def test_read_numpy(self):
+        store, table, chunks = self.setup_numpy_store()
+        self.mox.StubOutWithMock(store, '_iter_table_read')
+        store._iter_table_read([3, 7, 9]).AndReturn(iter(chunks))
+
+        self.mox.ReplayAll()
+        meta, features = store.read_numpy([3, 7, 9])
+        assert meta.dtype.names == ('a', 'b')
+        assert meta['a'].tolist() == [1, 2, 3]
+        assert meta['b'].tolist() == ['x', 'yy', 'z']
+        assert features.dtype == numpy.float64
+        assert features.tolist() == [[1, 2, 5], [3, 4, 6], [7, 8, 9]]
+        self.mox.VerifyAll()
+
+    def test_filter_iter_numpy(self):
+        store, table, chunks = self.setup_numpy_store()
+        self.mox.StubOutWithMock(store, '_iter_table_read')
+        table.getNumberOfRows().AndReturn(3)
+        store._iter_table_read(
+            mox.Func(lambda o: list(o) == [0, 1, 2])).AndReturn(
+            iter(chunks))
+
+        self.mox.ReplayAll()
+        rs = list(store.filter_iter('', 'numpy'))
+        assert len(rs) == 2
+        assert rs[0][0]['a'].tolist() == [1, 2]
+        assert rs[0][1].tolist() == [[1, 2, 5], [3, 4, 6]]
+        assert rs[1][0]['b'].tolist() == ['z']
+        assert rs[1][1].tolist() == [[7, 8, 9]]
+        self.mox.VerifyAll()
+
+    def test_filter_raw_numpy(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        self.mox.StubOutWithMock(table, 'getWhereList')
+        self.mox.StubOutWithMock(store, 'read_numpy')
+        r = object()
+
+        table.getNumberOfRows().AndReturn(123)
+        table.getWhereList('(a==1)', {}, 0, 123, 0).AndReturn([3, 7])
+        store.read_numpy([3, 7]).AndReturn(r)
+
+        self.mox.ReplayAll()
+        assert store.filter_raw('(a==1)', raw='numpy') == r
+        self.mox.VerifyAll()
+
+    def test_fetch_by_metadata_iter(self):
+        store = MockFeatureTable(None)
+        store.cols = [MockColumn(name='a'), MockColumn(name='b')]
+        store.metacols = (0, 1)
+        self.mox.StubOutWithMock(store, 'filter_iter')
+        r = object()
+        store.filter_iter('(a==1) & (b==2)', True).AndReturn(r)
+
+        self.mox.ReplayAll()
+        assert store.fetch_by_metadata_iter([1, 2]) == r
+        self.mox.VerifyAll()
+
+    def test_feature_row(self):
+        store = MockFeatureTable(None)
+        store.cols = (
+            MockColumn('ma'), MockColumn('mb'), MockColumn())
+        store.metacols = (0, 1)
+        store.multiftcols = (2,)
+        self.mox.StubOutWithMock(store, 'metadata_names')
+        self.mox.StubOutWithMock(store, 'feature_names')
+        store.metadata_names().AndReturn(('ma', 'mb'))
+        store.feature_names().AndReturn(('a', 'b'))
+        row = [10, 20, (1, 2)]
+
+        self.mox.ReplayAll()
+        rv = store.feature_row(row)
+        assert rv.names == ('a', 'b')
+        assert rv.values == (1, 2)
+        assert rv.infonames == ('ma', 'mb')
+        assert rv.infovalues == (10, 20)
+        self.mox.VerifyAll()
+
+    def test_get_chunk_size(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(size=2) for n in xrange(100)]
+
+        self.mox.ReplayAll()
+        assert store.get_chunk_size() == 10485
+        self.mox.VerifyAll()
+
+    def test_get_chunk_size_message_size(self):
+        store = MockFeatureTable(None)
+        store.session.ice_getCommunicator = lambda: MockCommunicator(
+            {'Ice.MessageSizeMax': 10})
+        store.cols = [
+            omero.grid.LongColumn('a', ''),
+            omero.grid.StringColumn('b', '', 95),
+        ]
+        assert store.get_max_message_size() == 9216
+        # Row size 8 + 100
+        assert store.get_chunk_size() == 85
+
+    def test_get_chunk_size_autotune(self, monkeypatch):
+        clock = itertools.count()
+        monkeypatch.setattr(
+            OmeroTablesFeatureStore.time, 'time', lambda: next(clock))
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn()]
+        store.max_message_size = 800
+        store.set_read_options(autotune=True, min_chunk_size=2,
+                               max_chunk_size=8, target_latency=0)
+        assert store.get_chunk_size() == 8
+
+        self.mox.StubOutWithMock(table, 'readCoordinates')
+        data = MockTableData()
+        data.columns = [MockColumn(values=[1, 2, 3])]
+        # A target latency of 0 halves the chunk size after each read until
+        # the minimum is reached
+        offsets = range(0, 28, 2)
+        table.readCoordinates(offsets[:8]).AndReturn(data)
+        table.readCoordinates(offsets[8:12]).AndReturn(data)
+        table.readCoordinates(offsets[12:14]).AndReturn(data)
+        # An explicit chunk size is not autotuned
+        table.readCoordinates(offsets[:5]).AndReturn(data)
+        table.readCoordinates(offsets[5:10]).AndReturn(data)
+        table.readCoordinates(offsets[10:]).AndReturn(data)
+
+        self.mox.ReplayAll()
+        store.chunked_table_read(offsets)
+        assert store.get_chunk_size() == 2
+        store.chunked_table_read(offsets, 5)
+        self.mox.VerifyAll()
+        assert store.get_chunk_size() == 2
+
+        store.set_read_options(autotune=False)
+        assert store.get_chunk_size() == 100
+
+    def test_chunked_table_read(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+
+        self.mox.StubOutWithMock(table, 'readCoordinates')
+
+        offsets = [2, 7, 5]
+
+        data1 = MockTableData()
+        data1.columns = [MockColumn()]
+        data1.columns[0].values = [[1], [2]]
+
+        data2 = MockTableData()
+        data2.columns = [MockColumn()]
+        data2.columns[0].values = [[3]]
+
+        table.readCoordinates([2, 7]).AndReturn(data1)
+        table.readCoordinates([5]).AndReturn(data2)
+
+        self.mox.ReplayAll()
+
+        d = store.chunked_table_read(offsets, 2)
+        assert d == [[[1], [2], [3]]]
+        assert store.read_stats['wait'].count == 3
+        assert store.read_stats['decode'].count == 3
+        self.mox.VerifyAll()
+
+    def test_plan_reads(self):
+        def plan(*args):
+            return list(
+                OmeroTablesFeatureStore.FeatureTable._plan_reads(*args))
+        assert plan([], 3) == []
+        assert plan([2, 7, 5], 2) == [[2, 7], [5]]
+        assert plan(range(10), 4) == [(0, 4), (4, 8), (8, 10)]
+        assert plan([1, 5, 6, 7, 8, 9, 3, 4], 10, 3) == [
+            [1], (5, 10), [3, 4]]
+        assert plan([1, 2, 3, 8, 9, 10, 11, 20], 2, 3) == [
+            (1, 3), (3, 4), (8, 10), (10, 12), [20]]
+        assert plan([1, 2, 5, 6, 9, 10], 3, 3) == [[1, 2, 5], [6, 9, 10]]
+
+    def test_plan_reads_variable_size(self):
+        sizes = [4, 2, 2, 1, 1]
+        plan = OmeroTablesFeatureStore.FeatureTable._plan_reads(
+            range(10), lambda: sizes[0])
+        chunks = []
+        for chunk in plan:
+            chunks.append(chunk)
+            sizes.pop(0)
+        assert chunks == [(0, 4), (4, 6), (6, 8), (8, 9), (9, 10)]
+
+    def test_chunked_table_read_ranges(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn(), MockColumn()]
+        self.mox.StubOutWithMock(table, 'readCoordinates')
+        self.mox.StubOutWithMock(store, '_plan_reads')
+
+        data1 = MockTableData()
+        data1.columns = [MockColumn(values=[1]), MockColumn(values=[2])]
+        data2 = MockTableData()
+        data2.columns = [MockColumn(values=[3, 5]),
+                         MockColumn(values=[4, 6])]
+
+        store._plan_reads([2, 5, 6], 2).AndReturn([[2], (5, 7)])
+        table.readCoordinates([2]).AndReturn(data1)
+        table.read([0, 1], 5, 7).AndReturn(data2)
+
+        self.mox.ReplayAll()
+        d = store.chunked_table_read([2, 5, 6], 2)
+        assert d == [[1, 3, 5], [2, 4, 6]]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('prefetch', [0, 1, 3])
+    def test_iter_table_read_prefetch(self, prefetch):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn()]
+        store.set_read_options(prefetch=prefetch)
+        self.mox.StubOutWithMock(table, 'readCoordinates')
+
+        datas = []
+        for n in xrange(4):
+            data = MockTableData()
+            data.columns = [MockColumn(values=[n])]
+            datas.append(data)
+            table.readCoordinates([n * 10]).AndReturn(data)
+
+        self.mox.ReplayAll()
+        chunks = list(store._iter_table_read([0, 10, 20, 30], 1))
+        assert chunks == [[[0]], [[1]], [[2]], [[3]]]
+        assert store.read_stats['wait'].count == 4
+        assert store.read_stats['decode'].count == 4
+        self.mox.VerifyAll()
+
+    def test_iter_table_read_prefetch_error(self):
+        table = self.mox.CreateMock(MockTable)
+        store = MockFeatureTable(None)
+        store.table = table
+        store.cols = [MockColumn()]
+        store.set_read_options(prefetch=2)
+        self.mox.StubOutWithMock(table, 'readCoordinates')
+
+        data = MockTableData()
+        data.columns = [MockColumn(values=[0])]
+        table.readCoordinates([0]).AndReturn(data)
+        table.readCoordinates([10]).AndRaise(omero.ServerError())
+
+        self.mox.ReplayAll()
+        it = store._iter_table_read([0, 10, 20], 1)
+        assert next(it) == [[0]]
+        with pytest.raises(omero.ServerError):
+            next(it)
+        self.mox.VerifyAll()
+
+    class ReadableTable(object):
+        """
+        Returns the requested offsets as the values of a single column
+        """
+        def __init__(self):
+            self.calls = 0
+            self.closed = False
+
+        def getOriginalFile(self):
+            return MockOriginalFile(1)
+
+        def readCoordinates(self, offsets):
+            self.calls += 1
+            data = MockTableData()
+            data.columns = [MockColumn(values=list(offsets))]
+            return data
+
+        def read(self, colnums, start, stop):
+            return self.readCoordinates(range(start, stop))
+
+        def close(self):
+            self.closed = True
+
+    @pytest.mark.parametrize('prefetch', [0, 2])
+    def test_iter_table_read_handles(self, prefetch):
+        table1 = self.ReadableTable()
+        table2 = self.ReadableTable()
+        session = MockSession(1, table2, None)
+        store = MockFeatureTable(session)
+        store.table = table1
+        store.cols = [MockColumn()]
+        store.set_read_options(handles=2, prefetch=prefetch)
+
+        offsets = range(0, 200, 2)
+        chunks = list(store._iter_table_read(offsets, 3))
+        assert len(chunks) == 34
+        assert sum((c[0] for c in chunks), []) == offsets
+        assert table1.calls + table2.calls == 34
+        assert store.read_tables == [table2]
+
+        store.close()
+        assert table1.closed
+        assert table2.closed
+        assert store.read_tables is None
+
+    def test_get_objects(self):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+
+        kvs = {'x': 'aaa', 'y.z': ['bbb', 'ccc']}
+        # Need to figure out which order the keys will be read
+        if kvs.keys() == ['x', 'y.z']:
+            q = "FROM ObjectType WHERE x = :x AND y.z in (:y_z)"
+        else:
+            q = "FROM ObjectType WHERE y.z in (:y_z) AND x = :x"
+
+        params = omero.sys.ParametersI()
+        params.add('x', wrap('aaa'))
+        params.add('y_z', wrap(['bbb', 'ccc']))
+        m = object()
+
+        session.qs.findAllByQuery(q, mox.Func(
+            lambda o: self.parameters_equal(params, o))).AndReturn([m])
+
+        self.mox.ReplayAll()
+
+        assert store.get_objects('ObjectType', kvs) == [m]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', [True, False])
+    def test_create_file_annotation(self, exists):
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
         self.mox.StubOutWithMock(store, 'get_objects')
         self.mox.StubOutWithMock(store, '_file_annotation_exists')
         self.mox.StubOutWithMock(session.us, 'saveAndReturnObject')
@@ -941,6 +2628,119 @@ class TestFeatureTable(object):
                 'Image', 3, 'ns', ofile) == mocklink
         self.mox.VerifyAll()
 
+    def test_get_objects_chunked(self, monkeypatch):
+        monkeypatch.setattr(OmeroTablesFeatureStore, 'QUERY_CHUNK_SIZE', 2)
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+
+        q = "FROM ObjectType WHERE id in (:id)"
+        for ids, r in (([1, 2], [10, 20]), ([3, 4], [30]), ([5], [50])):
+            params = omero.sys.ParametersI()
+            params.add('id', wrap(ids))
+            session.qs.findAllByQuery(q, mox.Func(
+                lambda o, params=params: self.parameters_equal(params, o))
+            ).AndReturn(r)
+
+        self.mox.ReplayAll()
+        assert store.get_objects('ObjectType', {'id': [1, 2, 3, 4, 5]}) == [
+            10, 20, 30, 50]
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('exists', ['all', 'some'])
+    def test_create_file_annotations(self, exists, monkeypatch):
+        monkeypatch.setattr(OmeroTablesFeatureStore, 'QUERY_CHUNK_SIZE', 2)
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(store, 'get_objects')
+        self.mox.StubOutWithMock(store, '_file_annotations_exist')
+
+        ofile = omero.model.OriginalFileI(2)
+        images = [omero.model.ImageI(n) for n in (3, 5, 6)]
+        link4 = MockOmeroObject(24)
+
+        if exists == 'all':
+            existing = dict((n, MockOmeroObject(20 + n)) for n in (3, 4))
+            store._file_annotations_exist(
+                'Image', [3, 4, 3], 'ns', 2).AndReturn(existing)
+        else:
+            store._file_annotations_exist(
+                'Image', [4, 6, 3, 5], 'ns', 2).AndReturn({4: link4})
+            store.get_objects('Image', mox.Func(
+                lambda kvs: kvs == {'id': [3, 5, 6]} and all(
+                    isinstance(i, long) for i in kvs['id']))).AndReturn(
+                images)
+
+        saves = []
+
+        def save(ls):
+            saves.append(ls)
+            saved = []
+            for lnk in ls:
+                out = omero.model.ImageAnnotationLinkI(
+                    unwrap(lnk.getParent().getId()) + 30)
+                out.setParent(lnk.getParent())
+                out.setChild(omero.model.FileAnnotationI(7))
+                saved.append(out)
+            return saved
+
+        session.us.saveAndReturnArray = save
+
+        self.mox.ReplayAll()
+        if exists == 'all':
+            assert store.create_file_annotations(
+                'Image', [3, 4, 3], 'ns', ofile) == existing
+        else:
+            links = store.create_file_annotations(
+                'Image', [4, 6, 3, 5], 'ns', ofile)
+            assert sorted(links.keys()) == [3, 4, 5, 6]
+            assert links[4] == link4
+            assert [unwrap(links[n].getId()) for n in (3, 5, 6)] == [
+                33, 35, 36]
+
+            # Links are saved in batches of QUERY_CHUNK_SIZE with unloaded
+            # parents, the new annotation is saved with the first batch
+            assert [[unwrap(lnk.getParent().getId()) for lnk in ls]
+                    for ls in saves] == [[3, 5], [6]]
+            for ls in saves:
+                assert not any(lnk.getParent().isLoaded() for lnk in ls)
+            ann = saves[0][0].getChild()
+            assert ann.getId() is None
+            assert ann.getNs() == wrap('ns')
+            assert ann.getFile() == ofile
+            assert all(lnk.getChild() is ann for lnk in saves[0])
+            assert unwrap(saves[1][0].getChild().getId()) == 7
+            assert not saves[1][0].getChild().isLoaded()
+        self.mox.VerifyAll()
+
+    def test_file_annotations_exist(self, monkeypatch):
+        monkeypatch.setattr(OmeroTablesFeatureStore, 'QUERY_CHUNK_SIZE', 2)
+        session = MockSession(None, None, None)
+        store = MockFeatureTable(session)
+        self.mox.StubOutWithMock(session.qs, 'findAllByQuery')
+
+        def link(pid):
+            lnk = omero.model.ImageAnnotationLinkI(pid + 10)
+            lnk.setParent(omero.model.ImageI(pid, False))
+            return lnk
+
+        q = ('FROM ImageAnnotationLink ial WHERE ial.parent.id IN '
+             '(:parents) AND ial.child.ns=:ns AND ial.child.file.id=:file')
+        links = [link(1), link(3), link(3)]
+        for ids, r in (([1, 2], links[:1]), ([3], links[1:])):
+            params = omero.sys.ParametersI()
+            params.add('parents', wrap([long(i) for i in ids]))
+            params.addString('ns', 'ns')
+            params.addLong('file', 5)
+            session.qs.findAllByQuery(q, mox.Func(
+                lambda o, params=params: self.parameters_equal(params, o))
+            ).AndReturn(r)
+
+        self.mox.ReplayAll()
+        assert store._file_annotations_exist('Image', [1, 2, 3], 'ns', 5) == {
+            1: links[0], 3: links[1]}
+        self.mox.VerifyAll()
+
     def test_file_annotation_exists(self):
         session = MockSession(None, None, None)
         store = MockFeatureTable(session)
@@ -1177,7 +2977,8 @@ class TestFeatureTableManager(object):
         assert fts.ft_space == 'y'
         assert fts.ann_space == 'z'
 
-    def test_create(self):
+    @pytest.mark.parametrize('digest', [False, True])
+    def test_create(self, digest):
         ownerid = 123
         session = MockSession(None, None, ownerid)
         fs = MockFeatureTable(None)
@@ -1191,14 +2992,14 @@ class TestFeatureTableManager(object):
             session, fsname, 'x/features', ownerid=ownerid).AndReturn([])
 
         OmeroTablesFeatureStore.new_table(
-            session, fsname, 'x/features', 'x/source', meta, colnames
-            ).AndReturn(fs)
+            session, fsname, 'x/features', 'x/source', meta, colnames,
+            digest=digest).AndReturn(fs)
 
         self.mox.ReplayAll()
 
         fts = OmeroTablesFeatureStore.FeatureTableManager(
             session, namespace='x')
-        assert fts.create(fsname, meta, colnames) == fs
+        assert fts.create(fsname, meta, colnames, digest=digest) == fs
 
         assert len(fts.fss) == 1
         assert fts.fss.get((fsname, ownerid)) == fs
@@ -1242,3 +3043,30 @@ class TestFeatureTableManager(object):
 
         assert fts.get(fsname, ownerid) == fs
         self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('processes', [0, 2])
+    def test_compute_and_store(self, processes):
+        session = MockSession(None, None, 123)
+        fs = MockFeatureTable(session)
+        fts = OmeroTablesFeatureStore.FeatureTableManager(session)
+        self.mox.StubOutWithMock(fts, 'get')
+        self.mox.StubOutWithMock(fs, 'store_many')
+
+        fts.get('fsname', None).AndReturn(fs)
+        fs.store_many(
+            [(1, 1), (1, 2), (2, 2), (2, 4)],
+            [[1, 1], [1, 2], [2, 2], [2, 4]])
+        fs.store_many([(3, 3), (3, 6)], [[3, 3], [3, 6]])
+
+        self.mox.ReplayAll()
+        stats = fts.compute_and_store(
+            'fsname', _compute_features, [1, 2, 3], processes=processes,
+            ordered=True, batch_size=3)
+        assert stats['compute'].count == 3
+        assert stats['write'].count == 6
+        assert stats['total'].count == 6
+        self.mox.VerifyAll()
+
+
+def _compute_features(iid):
+    return [((iid, n * iid), [iid, n * iid]) for n in (1, 2)]